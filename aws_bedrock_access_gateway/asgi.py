@@ -8,9 +8,31 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
 import os
+import asyncio
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'aws_bedrock_access_gateway.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    # Django does not handle lifespan events. Servers send the startup event in
+    # every worker process once it runs, also when the application was preloaded
+    # before forking, which is when the clients can be warmed up.
+    if scope['type'] != 'lifespan':
+        return await django_application(scope, receive, send)
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if settings.WARM_UP_CLIENTS:
+                from gandhi_ai.clients import warm_up_clients
+
+                await asyncio.to_thread(warm_up_clients)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
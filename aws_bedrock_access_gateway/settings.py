@@ -10,9 +10,6 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 import os
-import boto3
-import chromadb
-import google.generativeai as genai
 
 from pathlib import Path
 from decouple import config
@@ -172,24 +169,186 @@ LOGGING = {
 }
 
 
-BEDROCK_CLIENT = boto3.client(
-    'bedrock-runtime', region_name='us-east-1', 
-    aws_access_key_id=config('AWS_ACCESS_KEY'), aws_secret_access_key=config('AWS_SECRET_ACCESS_KEY')
-)
+# The Bedrock, chroma and Gemini clients are created lazily by gandhi_ai.clients.
+BEDROCK_REGION_NAME = 'us-east-1'
+
+AWS_ACCESS_KEY = config('AWS_ACCESS_KEY')
+
+AWS_SECRET_ACCESS_KEY = config('AWS_SECRET_ACCESS_KEY')
 
 LLAMA_MODEL_ID = 'meta.llama3-8b-instruct-v1:0'
 
 COHERE_EMBED_ENGLISH_MODEL_ID = 'cohere.embed-english-v3'
 
+# On-disk cache of document embeddings used by ingestion, set to an empty value to disable.
+EMBEDDING_CACHE_PATH = config('EMBEDDING_CACHE_PATH', default=os.path.join(BASE_DIR, 'resources/embedding_cache.sqlite3'))
+
 
-CHROMA_DB_CLIENT = chromadb.PersistentClient(path="./gandhi_ai_vector_store")
+CHROMA_DB_PATH = "./gandhi_ai_vector_store"
 
 CWOG_COLLECTION_NAME = 'collected_works_of_gandhi'
 
-CWOG_COLLECTION = CHROMA_DB_CLIENT.get_collection(CWOG_COLLECTION_NAME)
+# BM25 index over the chunks of the vector store, written by build_lexical_index
+# and memory-mapped by the workers.
+LEXICAL_INDEX_DIR = os.path.join(BASE_DIR, 'resources/lexical_index')
+
+# Quantized copy of the vector store's embeddings, partitioned around k-means
+# centroids, written by export_vector_index and memory-mapped by the workers.
+# With VECTOR_STORE_BACKEND='numpy' questions are searched in it instead of
+# chroma, scanning the vectors of the VECTOR_INDEX_PROBES closest centroids
+# (0 scans every vector). With VECTOR_INDEX_RESCORE_CANDIDATES that many of
+# the best quantized hits are scored again exactly, against a float32 copy of
+# the vectors that is only exported, and mapped, when it is set.
+VECTOR_INDEX_DIR = os.path.join(BASE_DIR, 'resources/vector_index')
+VECTOR_INDEX_QUANTIZATION = config('VECTOR_INDEX_QUANTIZATION', default='int8')
+VECTOR_INDEX_PROBES = config('VECTOR_INDEX_PROBES', default=8, cast=int)
+VECTOR_INDEX_RESCORE_CANDIDATES = config('VECTOR_INDEX_RESCORE_CANDIDATES', default=0, cast=int)
+VECTOR_STORE_BACKEND = config('VECTOR_STORE_BACKEND', default='chroma')
+
+# 'hybrid' fuses the vector store and lexical index hits by reciprocal rank,
+# 'vector' and 'lexical' only use one of them. 'lexical' needs no Bedrock call.
+RETRIEVAL_MODE = config('RETRIEVAL_MODE', default='hybrid')
+RETRIEVAL_N_RESULTS = config('RETRIEVAL_N_RESULTS', default=3, cast=int)
+RETRIEVAL_FUSION_CANDIDATES = config('RETRIEVAL_FUSION_CANDIDATES', default=20, cast=int)
+RETRIEVAL_RRF_K = 60
+
+# 'packed' answers with a single Gemini call from the best chunks and the text
+# around them, fitted to PACKED_CONTEXT_TOKEN_BUDGET tokens as counted by the
+# CONTEXT_TOKENIZER, a tokenizer.json file written by the save_context_tokenizer
+# command (or a Hugging Face tokenizer name, downloaded by every worker).
+# 'map_reduce' first asks Gemini about every slice of the retrieved sections,
+# for questions that need very wide context. Requests can pick either one with
+# a 'context_mode' field.
+CONTEXT_MODE = config('CONTEXT_MODE', default='packed')
+PACKED_CONTEXT_CANDIDATES = config('PACKED_CONTEXT_CANDIDATES', default=10, cast=int)
+PACKED_CONTEXT_TOKEN_BUDGET = config('PACKED_CONTEXT_TOKEN_BUDGET', default=24000, cast=int)
+CONTEXT_TOKENIZER = config('CONTEXT_TOKENIZER', default=os.path.join(BASE_DIR, 'resources/context_tokenizer.json'))
+
+# In hybrid mode a question is answered from the lexical index alone when embedding
+# it fails or takes longer than this many seconds.
+QUERY_EMBEDDING_TIMEOUT = config('QUERY_EMBEDDING_TIMEOUT', default=5.0, cast=float)
 
 CWOG_CACHE_KEY_FORMAT = "vol:{vol}-section:{section}"
 
+# Cleaned sections, pages and titles of every volume, compiled once from the .docx
+# files by compile_cwog_corpus and read by both ingestion commands.
+CWOG_COMPILED_CORPUS_DIR = os.path.join(BASE_DIR, 'resources/compiled_cwog')
+
+# Reader used to extract the text of the .docx volumes: 'iterparse' streams
+# word/document.xml with lxml, 'python-docx' builds the full python-docx document.
+CWOG_DOCX_READER = config('CWOG_DOCX_READER', default='iterparse')
+
+# Sections are stored zlib compressed in redis by load_sections_from_cwog, set to
+# 'none' to store raw strings. Both formats are read transparently.
+CWOG_SECTION_COMPRESSION = config('CWOG_SECTION_COMPRESSION', default='zlib')
+CWOG_SECTION_COMPRESSION_LEVEL = config('CWOG_SECTION_COMPRESSION_LEVEL', default=6, cast=int)
+
+# Title and page of every section, computed once by load_sections_from_cwog.
+CWOG_SECTION_META_KEY_FORMAT = "vol:{vol}-section:{section}-meta"
+
+# Hash of the .docx file and corpus format version a volume was last loaded from,
+# see load_sections_from_cwog --changed-only.
+CWOG_VOLUME_HASH_KEY_FORMAT = "vol:{vol}-source-hash"
+
+# In-process cache of hot CWOG sections in front of redis, bounded by entries and bytes.
+# Entries expire so that workers pick up sections reloaded by load_sections_from_cwog.
+SECTION_CACHE_MAX_ENTRIES = config('SECTION_CACHE_MAX_ENTRIES', default=2048, cast=int)
+SECTION_CACHE_MAX_BYTES = config('SECTION_CACHE_MAX_BYTES', default=64*1024*1024, cast=int)
+SECTION_CACHE_TIMEOUT = config('SECTION_CACHE_TIMEOUT', default=60*60, cast=int)
+
+# Size of the shared thread pool the async chat pipeline uses for blocking
+# Bedrock, Redis and Chroma calls.
+BACKEND_EXECUTOR_MAX_WORKERS = config('BACKEND_EXECUTOR_MAX_WORKERS', default=64, cast=int)
+
+# Process-wide limits for calls to each LLM backend. Calls beyond max_concurrency
+# wait in a queue; once max_queue_size calls are waiting new calls wait up to
+# queue_timeout seconds for room before failing. A streamed answer holds its
+# gemini_stream slot until it was streamed, so answers get their own budget
+# instead of taking the slots of the map calls under the gemini cap.
+LLM_SCHEDULERS = {
+    'gemini': {
+        'max_concurrency': config('GEMINI_MAX_CONCURRENCY', default=16, cast=int),
+        'max_queue_size': config('GEMINI_MAX_QUEUE_SIZE', default=64, cast=int),
+        'queue_timeout': config('GEMINI_QUEUE_TIMEOUT', default=10, cast=float),
+    },
+    'gemini_stream': {
+        'max_concurrency': config('GEMINI_STREAM_MAX_CONCURRENCY', default=64, cast=int),
+        'max_queue_size': config('GEMINI_STREAM_MAX_QUEUE_SIZE', default=256, cast=int),
+        'queue_timeout': config('GEMINI_STREAM_QUEUE_TIMEOUT', default=10, cast=float),
+    },
+    'bedrock': {
+        'max_concurrency': config('BEDROCK_MAX_CONCURRENCY', default=16, cast=int),
+        'max_queue_size': config('BEDROCK_MAX_QUEUE_SIZE', default=64, cast=int),
+        'queue_timeout': config('BEDROCK_QUEUE_TIMEOUT', default=10, cast=float),
+    },
+}
+
+# Transient backend errors (throttling, 5xx, connection failures) are retried up to
+# max_attempts times with exponentially growing, jittered delays between base_delay
+# and max_delay seconds. After failure_threshold consecutive transient failures the
+# backend's circuit opens and calls fail fast for reset_timeout seconds, a
+# failure_threshold of None never opens it.
+BACKEND_RESILIENCE = {
+    'bedrock': {
+        'max_attempts': config('BEDROCK_MAX_ATTEMPTS', default=3, cast=int),
+        'base_delay': 0.2,
+        'max_delay': 2.0,
+        'failure_threshold': config('BEDROCK_FAILURE_THRESHOLD', default=5, cast=int),
+        'reset_timeout': config('BEDROCK_RESET_TIMEOUT', default=30, cast=float),
+    },
+    'gemini': {
+        'max_attempts': config('GEMINI_MAX_ATTEMPTS', default=3, cast=int),
+        'base_delay': 0.5,
+        'max_delay': 4.0,
+        'failure_threshold': config('GEMINI_FAILURE_THRESHOLD', default=5, cast=int),
+        'reset_timeout': config('GEMINI_RESET_TIMEOUT', default=30, cast=float),
+    },
+    # Embedding the corpus is not waited on by a user, so it rides out Bedrock
+    # throttling bursts with long backoffs instead of failing fast.
+    'bedrock_ingestion': {
+        'max_attempts': config('BEDROCK_INGESTION_MAX_ATTEMPTS', default=10, cast=int),
+        'base_delay': 1.0,
+        'max_delay': 60.0,
+        'failure_threshold': None,
+        'reset_timeout': 0,
+    },
+}
+
+# Seconds a chat may spend on backend calls, retries included, before its answer starts streaming.
+REQUEST_DEADLINE = config('REQUEST_DEADLINE', default=60, cast=float)
+
+BEDROCK_CONNECT_TIMEOUT = 5
+BEDROCK_READ_TIMEOUT = config('BEDROCK_READ_TIMEOUT', default=30, cast=float)
+
+# Maximum number of per-section map calls a single chat request runs at once.
+MAP_STEP_PER_REQUEST_CONCURRENCY = config('MAP_STEP_PER_REQUEST_CONCURRENCY', default=4, cast=int)
+
+# Query embeddings are cached in-process and in redis, keyed on the normalized query text.
+QUERY_EMBEDDING_CACHE_KEY_FORMAT = "query-embedding:{model}:{fingerprint}"
+QUERY_EMBEDDING_CACHE_MAX_ENTRIES = config('QUERY_EMBEDDING_CACHE_MAX_ENTRIES', default=2048, cast=int)
+QUERY_EMBEDDING_CACHE_TIMEOUT = config('QUERY_EMBEDDING_CACHE_TIMEOUT', default=60*60*24*7, cast=int)
+
+# Full answers are replayed for questions whose embedding is at least this similar
+# (cosine) to an already answered question. Requests can skip the lookup by
+# sending "bypass_cache": true.
+SEMANTIC_ANSWER_CACHE_ENABLED = config('SEMANTIC_ANSWER_CACHE_ENABLED', default=True, cast=bool)
+SEMANTIC_ANSWER_CACHE_SIMILARITY_THRESHOLD = config('SEMANTIC_ANSWER_CACHE_SIMILARITY_THRESHOLD', default=0.95, cast=float)
+SEMANTIC_ANSWER_CACHE_MAX_ENTRIES = config('SEMANTIC_ANSWER_CACHE_MAX_ENTRIES', default=1024, cast=int)
+SEMANTIC_ANSWER_CACHE_TIMEOUT = config('SEMANTIC_ANSWER_CACHE_TIMEOUT', default=60*60*24, cast=int)
+SEMANTIC_ANSWER_CACHE_GENERATION_KEY = "semantic-answer-cache:generation"
+
+# Partial answers of the per-section map step, keyed by normalized question,
+# section cache key, character offset and a hash of the sub-section text, so
+# that reloaded sections with changed text are answered again.
+MAP_ANSWER_CACHE_KEY_FORMAT = "map-answer:{fingerprint}:{section_key}:{offset}:{content_hash}"
+MAP_ANSWER_CACHE_TIMEOUT = config('MAP_ANSWER_CACHE_TIMEOUT', default=60*60*24, cast=int)
+
+GOOGLE_GEMINI_API_KEY = config("GOOGLE_GEMINI_API_KEY")
+GENAI_MODEL_NAME = "gemini-1.5-flash"
+
+# Create the backend clients when a worker starts instead of on its first request.
+WARM_UP_CLIENTS = config('WARM_UP_CLIENTS', default=True, cast=bool)
 
-genai.configure(api_key=config("GOOGLE_GEMINI_API_KEY"))
-GENAI_MODEL = genai.GenerativeModel("gemini-1.5-flash")
\ No newline at end of file
+# Log the stage timings of every chat as a JSON record, the same timings are always
+# exported as histograms on /metrics.
+REQUEST_TIMING_LOG = config('REQUEST_TIMING_LOG', default=False, cast=bool)
@@ -8,9 +8,18 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/wsgi/
 """
 
 import os
+import logging
 
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'aws_bedrock_access_gateway.settings')
 
 application = get_wsgi_application()
+
+# The answers of /chat/completions are streamed by an async view, which WSGI
+# servers buffer until the whole answer was generated.
+logging.getLogger(__name__).warning(
+    "Serving over WSGI, streamed answers are only sent once complete. Serve "
+    "aws_bedrock_access_gateway.asgi:application with an ASGI server, see gunicorn.conf.py.")
+
+# WSGI has no startup event, the clients are warmed up by the post_worker_init hook of gunicorn.conf.py.
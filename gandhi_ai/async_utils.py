@@ -0,0 +1,42 @@
+import os
+import asyncio
+import functools
+import threading
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+
+_backend_executor = None
+_backend_executor_lock = threading.Lock()
+
+
+def _reset_backend_executor_after_fork():
+    # Executor threads do not survive a fork, so forked workers start their own pool.
+    global _backend_executor, _backend_executor_lock
+    _backend_executor = None
+    _backend_executor_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_backend_executor_after_fork)
+
+
+def get_backend_executor():
+    """Return the shared, bounded pool that blocking backend clients (boto3, Redis, Chroma) run on.
+
+    The event loop is never blocked while a chat is waiting on them.
+    """
+    global _backend_executor
+    with _backend_executor_lock:
+        if _backend_executor is None:
+            _backend_executor = ThreadPoolExecutor(
+                max_workers=settings.BACKEND_EXECUTOR_MAX_WORKERS, thread_name_prefix='gandhi-ai-backend')
+        return _backend_executor
+
+
+async def run_in_backend_executor(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_backend_executor(), functools.partial(context.run, func, *args, **kwargs))
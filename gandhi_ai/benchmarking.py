@@ -0,0 +1,176 @@
+import io
+import enum
+import json
+import time
+import types
+import asyncio
+import hashlib
+import numpy as np
+
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+
+from . import clients
+from .caches import encode_section
+from .utils import get_chunk_id, split_section, CWOG_SOURCE_URL_FORMAT
+
+
+EMBEDDING_DIMENSIONS = 1024
+
+SECTION_WORDS = (
+    "truth non-violence satyagraha swaraj khadi village ahimsa the people of india must learn to serve "
+    "one another with patience and courage and the spinning wheel is a symbol of that service"
+).split()
+
+
+def get_fake_embedding(text):
+    """A unit vector derived from the text, so that the same question always gets the same embedding."""
+    seed = int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:8], 'little')
+    embedding = np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSIONS).astype(np.float32)
+    return (embedding / np.linalg.norm(embedding)).tolist()
+
+
+def get_fake_section(volume, section, length):
+    rng = np.random.default_rng(volume * 100000 + section)
+    words = []
+    size = 0
+    while size < length:
+        words.append(SECTION_WORDS[rng.integers(len(SECTION_WORDS))])
+        size += len(words[-1]) + 1
+    return "\n{0}. FAKE SECTION {1} OF VOLUME {2}\n".format(section, section, volume) + " ".join(words)
+
+
+class FakeBedrockClient:
+    """Stand-in for the Bedrock runtime client, answering Cohere embedding requests after ``latency`` seconds."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def invoke_model(self, modelId, body, accept, contentType):
+        time.sleep(self.latency)
+        texts = json.loads(body)['texts']
+        response = {'embeddings': {'float': [get_fake_embedding(text) for text in texts]}}
+        return {'body': io.BytesIO(json.dumps(response).encode('utf-8'))}
+
+
+class FakeCollection:
+    """Stand-in for the chroma collection, returning chunks of the fake sections after ``latency`` seconds."""
+
+    def __init__(self, latency, chunks):
+        self.latency = latency
+        self.chunks = chunks
+
+    def query(self, query_embeddings, n_results, **kwargs):
+        time.sleep(self.latency)
+        seed = int(abs(query_embeddings[0][0]) * 1e9)
+        positions = np.random.default_rng(seed).choice(len(self.chunks), min(n_results, len(self.chunks)), replace=False)
+        chunks = [self.chunks[position] for position in positions]
+        return {
+            'ids': [[chunk_id for chunk_id, metadata in chunks]],
+            'metadatas': [[metadata for chunk_id, metadata in chunks]],
+            'distances': [[0.5 for chunk in chunks]],
+        }
+
+
+class FakeFinishReason(enum.Enum):
+    FINISH_REASON_UNSPECIFIED = 0
+    STOP = 1
+
+
+class FakeGenerativeModel:
+    """Stand-in for the Gemini model, streaming ``tokens`` words after a first token latency."""
+
+    def __init__(self, first_token_latency, token_latency, tokens):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.tokens = tokens
+
+    def get_chunk(self, text, finish_reason=FakeFinishReason.FINISH_REASON_UNSPECIFIED, usage_metadata=None):
+        return types.SimpleNamespace(
+            parts=[text] if text else [], text=text, usage_metadata=usage_metadata,
+            candidates=[types.SimpleNamespace(finish_reason=finish_reason)])
+
+    async def generate_content_async(self, message, stream=False, **kwargs):
+        await asyncio.sleep(self.first_token_latency)
+        if not stream:
+            await asyncio.sleep(self.token_latency * (self.tokens - 1))
+            return types.SimpleNamespace(text=" ".join(SECTION_WORDS[:self.tokens]))
+
+        async def chunks():
+            for i in range(self.tokens):
+                if i:
+                    await asyncio.sleep(self.token_latency)
+                yield self.get_chunk(SECTION_WORDS[i % len(SECTION_WORDS)] + " ")
+            yield self.get_chunk("", FakeFinishReason.STOP, types.SimpleNamespace(
+                prompt_token_count=len(message) // 4, candidates_token_count=self.tokens,
+                total_token_count=len(message) // 4 + self.tokens))
+
+        return chunks()
+
+
+class LatencyLocMemCache(LocMemCache):
+    """Local memory cache standing in for redis, adding ``OPTIONS['LATENCY']`` seconds to every round trip."""
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self.latency = params.get('OPTIONS', {}).get('LATENCY', 0)
+
+    def get(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return super().get(*args, **kwargs)
+
+    def get_many(self, keys, version=None):
+        time.sleep(self.latency)
+        values = {}
+        for key in keys:
+            value = super().get(key, version=version)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return super().set(*args, **kwargs)
+
+    def set_many(self, data, timeout=None, version=None):
+        time.sleep(self.latency)
+        for key, value in data.items():
+            super().set(key, value, timeout=timeout, version=version)
+        return []
+
+
+def get_fake_cache_settings(latency):
+    return {
+        'default': {
+            'BACKEND': 'gandhi_ai.benchmarking.LatencyLocMemCache',
+            'LOCATION': 'benchmark',
+            'OPTIONS': {'LATENCY': latency, 'MAX_ENTRIES': 1000000},
+        }
+    }
+
+
+def install_fake_backends(cache, embed_latency, vector_store_latency, first_token_latency, token_latency, tokens,
+                          volumes, sections_per_volume, section_length):
+    """Replace the Bedrock, Gemini and chroma clients with fakes and store their sections in ``cache``."""
+    chunks = []
+    sections = {}
+    for volume in range(1, volumes + 1):
+        for section_number in range(1, sections_per_volume + 1):
+            section = get_fake_section(volume, section_number, section_length)
+            sections[settings.CWOG_CACHE_KEY_FORMAT.format(vol=volume, section=section_number)] = encode_section(section)
+            for offset, chunk in enumerate(split_section(section)):
+                chunks.append((get_chunk_id(volume, section_number, offset, chunk), {
+                    'source': CWOG_SOURCE_URL_FORMAT.format(volume),
+                    'page': section_number,
+                    'section': section_number,
+                    'volume': volume,
+                    'title': "{0}. FAKE SECTION {1} OF VOLUME {2}".format(section_number, section_number, volume),
+                }))
+    cache.set_many(sections, timeout=None)
+
+    with clients._CLIENTS_LOCK:
+        clients._CLIENTS.update({
+            'bedrock': FakeBedrockClient(embed_latency),
+            'cwog_collection': FakeCollection(vector_store_latency, chunks),
+            'genai_model': FakeGenerativeModel(first_token_latency, token_latency, tokens),
+        })
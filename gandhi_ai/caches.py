@@ -0,0 +1,357 @@
+import re
+import sys
+import time
+import uuid
+import zlib
+import hashlib
+import logging
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with optional expiry and hit/miss counters.
+
+    The cache is bounded by ``max_entries`` and, when given, by ``max_bytes`` of
+    stored values as measured by ``sys.getsizeof``.
+    """
+
+    def __init__(self, name, max_entries, timeout=None, max_bytes=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry[2]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                if entry is not None:
+                    self._pop(key)
+                self._misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.timeout if self.timeout is not None else None
+        size = sys.getsizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (expires_at, value, size)
+            self._size += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and self._size > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+                self._evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'name': self.name,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_ratio': self._hits / lookups if lookups else 0.0,
+            }
+
+
+def normalize_query_text(query_text):
+    """Fold case, punctuation and whitespace so trivially different questions share cache entries."""
+    return " ".join(re.sub(r"[^\w\s]", " ", query_text.lower()).split())
+
+
+def query_fingerprint(query_text):
+    return hashlib.sha1(normalize_query_text(query_text).encode('utf-8')).hexdigest()
+
+
+def embedding_to_bytes(embedding):
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+
+def embedding_from_bytes(value):
+    return np.frombuffer(value, dtype=np.float32).tolist()
+
+
+QUERY_EMBEDDING_CACHE = LRUCache(
+    'query_embedding', settings.QUERY_EMBEDDING_CACHE_MAX_ENTRIES, timeout=settings.QUERY_EMBEDDING_CACHE_TIMEOUT)
+
+_redis_stats = {
+    'query_embedding': {'hits': 0, 'misses': 0},
+    'map_answer': {'hits': 0, 'misses': 0},
+    'section': {'hits': 0, 'misses': 0},
+}
+_redis_stats_lock = threading.Lock()
+
+
+def _count_redis_lookups(name, hits, misses):
+    with _redis_stats_lock:
+        _redis_stats[name]['hits'] += hits
+        _redis_stats[name]['misses'] += misses
+
+
+def get_query_embedding_cache_key(query_text):
+    return settings.QUERY_EMBEDDING_CACHE_KEY_FORMAT.format(
+        model=settings.COHERE_EMBED_ENGLISH_MODEL_ID, fingerprint=query_fingerprint(query_text))
+
+
+def get_cached_query_embeddings(query_text):
+    """Return the cached embeddings for a query in the shape of ``get_query_embeddings``, or None."""
+    key = get_query_embedding_cache_key(query_text)
+
+    value = QUERY_EMBEDDING_CACHE.get(key)
+    if value is None:
+        value = cache.get(key)
+        _count_redis_lookups('query_embedding', int(value is not None), int(value is None))
+        if value is None:
+            return None
+        QUERY_EMBEDDING_CACHE.set(key, value)
+
+    return [embedding_from_bytes(value)]
+
+
+def cache_query_embeddings(query_text, query_embeddings):
+    key = get_query_embedding_cache_key(query_text)
+    value = embedding_to_bytes(query_embeddings[0])
+
+    QUERY_EMBEDDING_CACHE.set(key, value)
+    cache.set(key, value, timeout=settings.QUERY_EMBEDDING_CACHE_TIMEOUT)
+
+
+class SemanticAnswerCache:
+    """In-process cache of full answers, looked up by similarity of the question embeddings.
+
+    Entries expire after ``timeout`` seconds and the least recently used entry is
+    evicted once ``max_entries`` answers are stored. The cache is cleared whenever
+    the generation stored in redis changes, see ``invalidate_semantic_answer_cache``.
+    Answers are only matched to questions asked with the same ``variant``, e.g.
+    the retrieval and context modes the answer was generated with.
+    """
+
+    def __init__(self, max_entries, timeout, similarity_threshold):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.similarity_threshold = similarity_threshold
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._matrix_keys = []
+        self._matrix_variants = []
+        self._generation = None
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _clear(self):
+        self._entries.clear()
+        self._matrix = None
+        self._matrix_keys = []
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            self._clear()
+            self._generation = generation
+
+    def _similarity_matrix(self):
+        if self._matrix is None:
+            self._matrix_keys = list(self._entries.keys())
+            self._matrix_variants = [self._entries[key]['variant'] for key in self._matrix_keys]
+            self._matrix = np.stack([self._entries[key]['embedding'] for key in self._matrix_keys])
+        return self._matrix
+
+    def get(self, embedding, variant, generation):
+        query = np.array(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        with self._lock:
+            self._check_generation(generation)
+
+            now = time.monotonic()
+            expired_keys = [key for key, entry in self._entries.items() if entry['expires_at'] < now]
+            for key in expired_keys:
+                del self._entries[key]
+            if expired_keys:
+                self._matrix = None
+
+            if not self._entries:
+                self._misses += 1
+                return None
+
+            similarities = self._similarity_matrix() @ query
+            similarities[[entry_variant != variant for entry_variant in self._matrix_variants]] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                self._misses += 1
+                return None
+
+            key = self._matrix_keys[best]
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return self._entries[key]['answer']
+
+    def set(self, embedding, variant, answer, generation):
+        vector = np.array(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+
+        with self._lock:
+            self._check_generation(generation)
+
+            self._entries[uuid.uuid4().hex] = {
+                'embedding': vector,
+                'variant': variant,
+                'answer': answer,
+                'expires_at': time.monotonic() + self.timeout,
+            }
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'name': 'semantic_answer',
+                'entries': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_ratio': self._hits / lookups if lookups else 0.0,
+            }
+
+
+SEMANTIC_ANSWER_CACHE = SemanticAnswerCache(
+    settings.SEMANTIC_ANSWER_CACHE_MAX_ENTRIES, settings.SEMANTIC_ANSWER_CACHE_TIMEOUT,
+    settings.SEMANTIC_ANSWER_CACHE_SIMILARITY_THRESHOLD)
+
+
+def get_semantic_answer_cache_generation():
+    return cache.get(settings.SEMANTIC_ANSWER_CACHE_GENERATION_KEY)
+
+
+def get_cached_answer(query_embeddings, variant):
+    if not settings.SEMANTIC_ANSWER_CACHE_ENABLED:
+        return None
+    return SEMANTIC_ANSWER_CACHE.get(query_embeddings[0], variant, get_semantic_answer_cache_generation())
+
+
+def cache_answer(query_embeddings, variant, answer):
+    if not settings.SEMANTIC_ANSWER_CACHE_ENABLED:
+        return
+    SEMANTIC_ANSWER_CACHE.set(query_embeddings[0], variant, answer, get_semantic_answer_cache_generation())
+
+
+def invalidate_semantic_answer_cache():
+    """Drop the cached answers of every worker, e.g. after the vector store or section cache is repopulated."""
+    cache.set(settings.SEMANTIC_ANSWER_CACHE_GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def get_map_answer_cache_key(query_text, section_key, offset, sub_section):
+    return settings.MAP_ANSWER_CACHE_KEY_FORMAT.format(
+        fingerprint=query_fingerprint(query_text), section_key=section_key, offset=offset,
+        content_hash=hashlib.sha1(sub_section.encode('utf-8')).hexdigest())
+
+
+def get_cached_map_answers(cache_keys):
+    map_answers = cache.get_many(cache_keys)
+    _count_redis_lookups('map_answer', len(map_answers), len(cache_keys) - len(map_answers))
+    return map_answers
+
+
+def cache_map_answers(map_answers):
+    cache.set_many(map_answers, timeout=settings.MAP_ANSWER_CACHE_TIMEOUT)
+
+
+SECTION_COMPRESSION_HEADER = b"CWZ1"
+
+
+def encode_section(section):
+    """Encode a section for redis, compressing it when ``CWOG_SECTION_COMPRESSION`` is enabled."""
+    if settings.CWOG_SECTION_COMPRESSION == 'zlib':
+        return SECTION_COMPRESSION_HEADER + zlib.compress(
+            section.encode('utf-8'), settings.CWOG_SECTION_COMPRESSION_LEVEL)
+    return section
+
+
+def decode_section(value):
+    if isinstance(value, bytes) and value.startswith(SECTION_COMPRESSION_HEADER):
+        return zlib.decompress(value[len(SECTION_COMPRESSION_HEADER):]).decode('utf-8')
+    return value
+
+
+SECTION_CACHE = LRUCache(
+    'section', settings.SECTION_CACHE_MAX_ENTRIES, timeout=settings.SECTION_CACHE_TIMEOUT,
+    max_bytes=settings.SECTION_CACHE_MAX_BYTES)
+
+
+def get_sections(cache_keys):
+    """Fetch CWOG sections from the in-process cache, reading all the missing ones from redis in one round trip."""
+    sections = {}
+    missing_keys = []
+    for key in cache_keys:
+        section = SECTION_CACHE.get(key)
+        if section is None:
+            missing_keys.append(key)
+        else:
+            sections[key] = section
+
+    if missing_keys:
+        fetched_sections = cache.get_many(missing_keys)
+        _count_redis_lookups('section', len(fetched_sections), len(missing_keys) - len(fetched_sections))
+        for key, value in fetched_sections.items():
+            section = decode_section(value)
+            SECTION_CACHE.set(key, section)
+            sections[key] = section
+
+    return sections
+
+
+def get_redis_cache_stats():
+    with _redis_stats_lock:
+        return {name: dict(stats) for name, stats in _redis_stats.items()}
+
+
+def log_cache_stats():
+    redis_stats = get_redis_cache_stats()
+    logger.info("Query embedding cache stats: local=%s redis=%s",
+                QUERY_EMBEDDING_CACHE.stats(), redis_stats['query_embedding'])
+    logger.info("Map answer cache stats: redis=%s", redis_stats['map_answer'])
+    logger.info("Section cache stats: local=%s redis=%s", SECTION_CACHE.stats(), redis_stats['section'])
+    logger.info("Semantic answer cache stats: %s", SEMANTIC_ANSWER_CACHE.stats())
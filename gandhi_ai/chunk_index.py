@@ -0,0 +1,137 @@
+import os
+import json
+import uuid
+import shutil
+import logging
+import threading
+import numpy as np
+
+from array import array
+
+from .utils import get_volume_from_source, CWOG_SOURCE_URL_FORMAT
+
+
+logger = logging.getLogger(__name__)
+
+
+def iter_collection_chunks(collection, include, batch_size):
+    """Yield ``(id, *include)`` tuples of every chunk of a chroma collection, reading ``batch_size`` at a time."""
+    offset = 0
+    while True:
+        batch = collection.get(include=include, limit=batch_size, offset=offset)
+        if not len(batch['ids']):
+            return
+        yield from zip(batch['ids'], *[batch[name] for name in include])
+        offset += len(batch['ids'])
+
+
+class ChunkArrays:
+    """Collects the ids and metadata of the chunks of an index, stored as arrays next to it."""
+
+    def __init__(self):
+        self.chunk_ids = []
+        self.volumes = array('i')
+        self.sections = array('i')
+        self.pages = array('i')
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    def append(self, chunk_id, metadata):
+        self.chunk_ids.append(chunk_id)
+        self.volumes.append(int(metadata.get('volume') or get_volume_from_source(metadata['source'])))
+        self.sections.append(metadata['section'])
+        self.pages.append(metadata['page'] if metadata.get('page') is not None else -1)
+
+    def get_arrays(self, order=None):
+        """The arrays to store, with the chunks in ``order`` when given."""
+        arrays = {
+            'chunk_ids': np.array(self.chunk_ids, dtype=bytes),
+            'volumes': np.frombuffer(self.volumes, dtype=np.int32),
+            'sections': np.frombuffer(self.sections, dtype=np.int32),
+            'pages': np.frombuffer(self.pages, dtype=np.int32),
+        }
+        if order is not None:
+            arrays = {name: values[order] for name, values in arrays.items()}
+        return arrays
+
+
+def write_index_build(index_dir, arrays, manifest):
+    """Write ``arrays`` as .npy files and ``manifest`` to a new build directory and make it the current one.
+
+    Workers memory-map the build the ``current`` file of ``index_dir`` names,
+    which is only switched once the build is complete.
+    """
+    build_dir = os.path.join(index_dir, uuid.uuid4().hex)
+    os.makedirs(build_dir)
+    for name, values in arrays.items():
+        np.save(os.path.join(build_dir, name + '.npy'), values)
+    with open(os.path.join(build_dir, 'manifest.json'), 'w') as fp:
+        json.dump(manifest, fp)
+
+    current_path = os.path.join(index_dir, 'current')
+    with open(current_path + '.tmp', 'w') as fp:
+        fp.write(os.path.basename(build_dir))
+    os.replace(current_path + '.tmp', current_path)
+
+    # Workers still mapping an older build keep reading it until they notice the switch.
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        if os.path.isdir(path) and path != build_dir:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class ChunkIndex:
+    """Read-only index over the memory-mapped arrays of a build, see ``write_index_build``.
+
+    Subclasses list the names of their own arrays in ``ARRAYS``.
+    """
+
+    ARRAYS = ()
+
+    def __init__(self, build_dir):
+        self.build_dir = build_dir
+        with open(os.path.join(build_dir, 'manifest.json')) as fp:
+            self.manifest = json.load(fp)
+
+        for name in self.ARRAYS + ('chunk_ids', 'volumes', 'sections', 'pages'):
+            setattr(self, name, np.load(os.path.join(build_dir, name + '.npy'), mmap_mode='r'))
+
+    def get_chunk_id(self, document):
+        return self.chunk_ids[document].decode('utf-8')
+
+    def get_metadata(self, document):
+        volume = int(self.volumes[document])
+        page = int(self.pages[document])
+        return {
+            'source': CWOG_SOURCE_URL_FORMAT.format(volume),
+            'volume': volume,
+            'section': int(self.sections[document]),
+            'page': page if page >= 0 else None,
+        }
+
+
+class CurrentIndex:
+    """The current build of an index directory, loaded once and reloaded after a rebuild switched builds."""
+
+    def __init__(self, index_class):
+        self.index_class = index_class
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get(self, index_dir):
+        """Return the index, or None when none was built."""
+        try:
+            with open(os.path.join(index_dir, 'current')) as fp:
+                build_dir = os.path.join(index_dir, fp.read().strip())
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            if self._index is None or self._index.build_dir != build_dir:
+                try:
+                    self._index = self.index_class(build_dir)
+                except FileNotFoundError:
+                    # The build was replaced again while loading, keep serving the one already mapped.
+                    logger.warning("%s build %s disappeared while loading it.", self.index_class.__name__, build_dir)
+            return self._index
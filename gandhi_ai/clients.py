@@ -0,0 +1,118 @@
+import os
+import time
+import logging
+import threading
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_bedrock_client():
+    import boto3
+    from botocore.config import Config
+
+    # Retries are left to gandhi_ai.resilience, which knows the time left for the request.
+    return boto3.client(
+        'bedrock-runtime', region_name=settings.BEDROCK_REGION_NAME,
+        aws_access_key_id=settings.AWS_ACCESS_KEY, aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        config=Config(retries={'total_max_attempts': 1}, connect_timeout=settings.BEDROCK_CONNECT_TIMEOUT,
+                      read_timeout=settings.BEDROCK_READ_TIMEOUT)
+    )
+
+
+def create_chroma_db_client():
+    import chromadb
+
+    return chromadb.PersistentClient(path=settings.CHROMA_DB_PATH)
+
+
+def create_cwog_collection():
+    return get_chroma_db_client().get_collection(settings.CWOG_COLLECTION_NAME)
+
+
+def create_genai_model():
+    import google.generativeai as genai
+
+    genai.configure(api_key=settings.GOOGLE_GEMINI_API_KEY)
+    return genai.GenerativeModel(settings.GENAI_MODEL_NAME)
+
+
+def create_context_tokenizer():
+    from .context_packing import load_context_tokenizer
+
+    return load_context_tokenizer()
+
+
+CLIENT_FACTORIES = {
+    'bedrock': create_bedrock_client,
+    'chroma_db': create_chroma_db_client,
+    'cwog_collection': create_cwog_collection,
+    'genai_model': create_genai_model,
+    'context_tokenizer': create_context_tokenizer,
+}
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.RLock()
+_warmed_up = False
+
+
+def _reset_clients_after_fork():
+    # Sockets, sqlite connections and gRPC channels must not be shared with the parent process.
+    global _CLIENTS_LOCK, _warmed_up
+    _CLIENTS.clear()
+    _CLIENTS_LOCK = threading.RLock()
+    _warmed_up = False
+
+
+os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+
+def get_client(name):
+    """Return the process-wide client ``name`` of ``CLIENT_FACTORIES``, creating it on first use."""
+    client = _CLIENTS.get(name)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(name)
+            if client is None:
+                client = _CLIENTS[name] = CLIENT_FACTORIES[name]()
+    return client
+
+
+def get_bedrock_client():
+    return get_client('bedrock')
+
+
+def get_chroma_db_client():
+    return get_client('chroma_db')
+
+
+def get_cwog_collection():
+    return get_client('cwog_collection')
+
+
+def get_genai_model():
+    return get_client('genai_model')
+
+
+def warm_up_clients():
+    """Create every client up front, so that the first request of a worker does not pay for it.
+
+    Call it once a worker process was forked, clients created before a fork are
+    dropped in the child. Failures are logged and left to the first request
+    that needs the client. Only the first call of a process does anything.
+    """
+    global _warmed_up
+    if _warmed_up:
+        return
+    _warmed_up = True
+
+    for name in CLIENT_FACTORIES:
+        start_time = time.perf_counter()
+        try:
+            get_client(name)
+        except Exception:
+            logger.exception("Could not warm up the %s client", name)
+        else:
+            logger.info("Warmed up the %s client in %.3fs", name, time.perf_counter() - start_time)
@@ -0,0 +1,147 @@
+import os
+import time
+import logging
+
+from django.conf import settings
+
+from .utils import split_section
+
+
+logger = logging.getLogger(__name__)
+
+# Used when the tokenizer cannot be loaded, English text averages about four characters per token.
+CHARACTERS_PER_TOKEN_ESTIMATE = 4
+
+# Seconds before loading a tokenizer that failed to load is tried again.
+TOKENIZER_RETRY_INTERVAL = 5 * 60
+
+_tokenizer_failed_at = None
+
+
+def load_context_tokenizer():
+    """Load the ``tokenizers`` tokenizer of ``settings.CONTEXT_TOKENIZER``, a tokenizer.json path or a hub name."""
+    from tokenizers import Tokenizer
+
+    if os.path.exists(settings.CONTEXT_TOKENIZER):
+        return Tokenizer.from_file(settings.CONTEXT_TOKENIZER)
+    if os.path.splitext(settings.CONTEXT_TOKENIZER)[1] == '.json':
+        raise FileNotFoundError(
+            "{0} does not exist, create it with the save_context_tokenizer command".format(settings.CONTEXT_TOKENIZER))
+    return Tokenizer.from_pretrained(settings.CONTEXT_TOKENIZER)
+
+
+def get_context_tokenizer():
+    """Return the context tokenizer, loaded once per worker with the clients, or None when it cannot be loaded.
+
+    A failed load is retried after ``TOKENIZER_RETRY_INTERVAL`` seconds, token
+    counts are estimated from characters meanwhile.
+    """
+    global _tokenizer_failed_at
+    from .clients import get_client
+
+    if _tokenizer_failed_at is not None and time.monotonic() - _tokenizer_failed_at < TOKENIZER_RETRY_INTERVAL:
+        return None
+    try:
+        tokenizer = get_client('context_tokenizer')
+    except Exception:
+        logger.exception("Could not load the %s tokenizer, estimating token counts from characters.",
+                         settings.CONTEXT_TOKENIZER)
+        _tokenizer_failed_at = time.monotonic()
+        return None
+    _tokenizer_failed_at = None
+    return tokenizer
+
+
+def count_tokens(text):
+    tokenizer = get_context_tokenizer()
+    if tokenizer is None:
+        return -(-len(text) // CHARACTERS_PER_TOKEN_ESTIMATE)
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def get_section_chunk_spans(section):
+    """Character spans of the chunks ``split_section`` makes of a section, None for a chunk it cannot locate."""
+    spans = []
+    position = 0
+    for chunk in split_section(section):
+        start = section.find(chunk, position)
+        if start == -1:
+            spans.append(None)
+            continue
+        spans.append((start, start + len(chunk)))
+        position = start + 1
+    return spans
+
+
+def iter_chunk_neighbours(ranked_chunks, section_spans):
+    """Yield the ``(section_key, offset)`` of every chunk, then of their neighbours one step further away at a time."""
+    distance = 0
+    while True:
+        in_range = False
+        for section_key, chunk_offset in ranked_chunks:
+            for offset in (chunk_offset - distance, chunk_offset + distance):
+                if 0 <= offset < len(section_spans[section_key]):
+                    in_range = True
+                    yield section_key, offset
+
+        if not in_range:
+            return
+        distance += 1
+
+
+def pack_context(ranked_chunks, sections, token_budget):
+    """Select the text of the best chunks and their neighbours that fits in ``token_budget`` tokens.
+
+    ``ranked_chunks`` are ``(section_key, chunk_offset)`` pairs, best first, and
+    ``sections`` maps section keys to their text. Every chunk is taken first,
+    then their neighbours one step further away at a time, so the context grows
+    around all of the chunks evenly. Returns ``(section_key, text)`` pairs in the
+    order the sections were ranked, consecutive chunks of a section merged.
+    """
+    section_spans = {}
+    for section_key, chunk_offset in ranked_chunks:
+        if section_key in sections and section_key not in section_spans:
+            section_spans[section_key] = get_section_chunk_spans(sections[section_key])
+    ranked_chunks = [(section_key, chunk_offset) for section_key, chunk_offset in ranked_chunks
+                     if section_key in section_spans]
+
+    selected_chunks = set()
+    rejected_chunks = set()
+    used_tokens = 0
+    smallest_chunk_tokens = None
+    for section_key, offset in iter_chunk_neighbours(ranked_chunks, section_spans):
+        # Chunks are about the same size, once the budget left is smaller than every
+        # chunk counted so far the remaining neighbours are not worth counting.
+        if smallest_chunk_tokens is not None and token_budget - used_tokens < smallest_chunk_tokens:
+            break
+        if section_spans[section_key][offset] is None or (section_key, offset) in selected_chunks \
+                or (section_key, offset) in rejected_chunks:
+            continue
+
+        start, end = section_spans[section_key][offset]
+        tokens = count_tokens(sections[section_key][start:end])
+        smallest_chunk_tokens = tokens if smallest_chunk_tokens is None else min(smallest_chunk_tokens, tokens)
+        if used_tokens + tokens <= token_budget:
+            selected_chunks.add((section_key, offset))
+            used_tokens += tokens
+        else:
+            rejected_chunks.add((section_key, offset))
+
+    packed_context = []
+    for section_key in section_spans:
+        offsets = sorted(offset for key, offset in selected_chunks if key == section_key)
+        if not offsets:
+            continue
+
+        spans = section_spans[section_key]
+        runs = [[spans[offsets[0]][0], spans[offsets[0]][1]]]
+        for previous_offset, offset in zip(offsets, offsets[1:]):
+            if offset == previous_offset + 1:
+                runs[-1][1] = max(runs[-1][1], spans[offset][1])
+            else:
+                runs.append([spans[offset][0], spans[offset][1]])
+        packed_context.append(
+            (section_key, " ... ".join(sections[section_key][start:end] for start, end in runs)))
+
+    logger.info("Packed %d chunks of %d sections in %d tokens.", len(selected_chunks), len(packed_context), used_tokens)
+    return packed_context
@@ -1,20 +1,20 @@
-import time
+import functools
+import asyncio
 
+from .resilience import call_with_retry, call_with_retry_async
 
-def botocore_backoff(delay=2, retries=3):
+
+def retry_backend_call(backend):
+    """Retry transient failures of a sync or async backend call, see ``resilience.call_with_retry``."""
     def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                return await call_with_retry_async(backend, func, *args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            current_retry = 0
-            current_delay = delay
-            while current_retry < retries:
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    current_retry += 1
-                    if current_retry >= retries:
-                        raise e
-                    print(f"Failed to execute function '{func.__name__}'. Retrying in {current_delay} seconds...")
-                    time.sleep(current_delay)
-                    current_delay *= 2
+            return call_with_retry(backend, func, *args, **kwargs)
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -0,0 +1,65 @@
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+
+
+class EmbeddingCache:
+    """Persistent content-hash -> float32 vector cache backed by SQLite.
+
+    Vectors are keyed by a hash of the model, input type and text, so that
+    rebuilding the vector store or changing the chunking only pays Bedrock for
+    text that was never embedded before.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def get_key(model_id, input_type, text):
+        return hashlib.sha256("\0".join([model_id, input_type, text]).encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+
+        rows = self._connection().execute(
+            "SELECT key, vector FROM embeddings WHERE key IN ({0})".format(",".join("?" * len(keys))), keys
+        ).fetchall()
+        vectors = {key: np.frombuffer(vector, dtype=np.float32).tolist() for key, vector in rows}
+
+        with self._lock:
+            self._hits += len(vectors)
+            self._misses += len(set(keys)) - len(vectors)
+        return vectors
+
+    def set_many(self, vectors):
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in vectors.items()]
+            )
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': self._hits / lookups if lookups else 0.0,
+            }
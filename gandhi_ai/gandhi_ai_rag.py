@@ -1,14 +1,30 @@
-import re
 import json
+import time
+import asyncio
+import logging
 import requests
 
 from django.conf import settings
-from django.core.cache import cache
-from concurrent.futures import ThreadPoolExecutor
 
-from .decorators import botocore_backoff
+from .utils import get_volume_from_source, get_section_title, get_chunk_offset, split_section
+from .clients import get_bedrock_client, get_cwog_collection, get_genai_model
+from .lexical_index import get_lexical_index, reciprocal_rank_fusion
+from .vector_index import get_vector_index
+from .context_packing import pack_context
+from .async_utils import run_in_backend_executor
+from .scheduler import get_scheduler, log_scheduler_stats
+from .resilience import call_with_retry_async
+from .metrics import (track_stage, record_stage, track_backend_call, count_backend_error, count_llm_tokens,
+                      set_request_timing_field)
+from .caches import (get_cached_query_embeddings, cache_query_embeddings, get_cached_answer, cache_answer,
+                     get_map_answer_cache_key, get_cached_map_answers, cache_map_answers, get_sections,
+                     log_cache_stats)
 
 
+logger = logging.getLogger(__name__)
+
+
+@track_backend_call('bedrock')
 def get_query_embeddings(query_text):
     request_body = json.dumps({
         'texts': [query_text],
@@ -16,7 +32,7 @@ def get_query_embeddings(query_text):
         'embedding_types': ["float"]
     })
 
-    response = settings.BEDROCK_CLIENT.invoke_model(
+    response = get_bedrock_client().invoke_model(
         modelId=settings.COHERE_EMBED_ENGLISH_MODEL_ID, 
         body=request_body,
         accept = '*/*',
@@ -25,100 +41,263 @@ def get_query_embeddings(query_text):
     return json.loads(response['body'].read().decode('utf-8'))['embeddings']['float'] 
 
 
+def get_chunk_section_key(metadata, key_format=None):
+    # Chunks embedded before the volume was stored in the metadata only carry the source url.
+    doc_vol = metadata.get('volume') or get_volume_from_source(metadata['source'])
+    return (key_format or settings.CWOG_CACHE_KEY_FORMAT).format(vol=doc_vol, section=metadata['section'])
+
+
 def get_relevant_sections_with_metadata(relevant_document_chunks):
     metadatas = relevant_document_chunks['metadatas'][0]
-    documents = relevant_document_chunks['documents'][0]
-    title_patterns = [
-        r"(\n1. SPEECH AT WORKING COMMITTEE MEETING, )",
-        r"(\n\s*[0-9]+\s*\.\s*[^a-z]+\s*\n)",
-        r"(\n\s*CHAPTER\s*[IVXLCDM]+\s*\n)",
-        r"(\n\s*APPENDIX\s*[IVXLCDM]+\s*\n)"
-    ]
+
+    chunk_keys = []
+    section_meta_keys = {}
+    for i in range(len(metadatas)):
+        cache_key = get_chunk_section_key(metadatas[i])
+        # The title is read from the meta key only for chunks stored before titles were added to their metadata.
+        if cache_key not in chunk_keys and metadatas[i].get('title') is None:
+            section_meta_keys[cache_key] = get_chunk_section_key(metadatas[i], settings.CWOG_SECTION_META_KEY_FORMAT)
+        chunk_keys.append(cache_key)
+
+    cached_sections = get_sections(list(dict.fromkeys(chunk_keys)) + list(section_meta_keys.values()))
 
     sections = []
+    section_keys = []
     sections_meta = []
     visited_keys = set()
-    for i in range(len(documents)):
-        source_pattern = r'https://www.gandhiashramsevagram.org/gandhi-literature/mahatma-gandhi-collected-works-volume-(\d+).pdf'
-        doc_vol = re.findall(source_pattern, metadatas[i]['source'])[0]
-        doc_section = metadatas[i]['section']
+    for i, cache_key in enumerate(chunk_keys):
+        if cache_key not in visited_keys:
+            visited_keys.add(cache_key)
 
-        cache_key = settings.CWOG_CACHE_KEY_FORMAT.format(vol=doc_vol, section=doc_section)
+            section = cached_sections.get(cache_key)
+            if section is None:
+                logger.warning("Section %s is missing from the cache.", cache_key)
+                continue
 
-        if cache_key not in visited_keys:
-            section = cache.get(cache_key)
-            title = ""
-            for title_pattern in title_patterns:
-                split_titles = re.split(title_pattern, section)
-                if len(split_titles) > 1:
-                    title = split_titles[1].strip()
-                    break
+            title = metadatas[i].get('title')
+            if title is None:
+                section_meta = cached_sections.get(section_meta_keys[cache_key])
+                title = section_meta['title'] if section_meta else get_section_title(section)
 
             sections.append(section)
+            section_keys.append(cache_key)
             sections_meta.append({
                 'title': title,
                 'page': metadatas[i]['page'], 
                 'source': metadatas[i]['source'],
             })
 
-            visited_keys.add(cache_key)
+    return sections, section_keys, sections_meta
+
 
+def format_sources(sections_meta):
     sources = []
     for i, section_meta in enumerate(sections_meta):
             sources.append('''{num}. "{title}"     Page: {page}
                            {source}'''.format(
                  num=i+1, title=section_meta['title'], page=section_meta['page'], source=section_meta['source']))
 
-    return sections, sources
-
-def gemini_converse(message, aggregate_response=False):
-    converse_response = settings.GENAI_MODEL.generate_content(message)
+    return sources
 
-    if aggregate_response == True:
-        return converse_response.text   
-
-    response = {
-        'stream': []
-    }
-
-    response['stream'].append({"messageStart": {"role": "assistant"}})
-    
-    for i in range(0, len(converse_response.text), 3):
-        response['stream'].append({
-            "contentBlockDelta": {
-                "delta": {
-                    "text": converse_response.text[i:i+3]
-                }, 
-                "contentBlockIndex": 0
-            }
-        })
-
-    response['stream'].append({"contentBlockStop": {"contentBlockIndex": 11}})
-    response['stream'].append({"messageStop": {"stopReason": "end_turn"}})
-    response['stream'].append({"metadata": {"usage": {"inputTokens": 0, "outputTokens": 0, "totalTokens": 0}, "metrics": {"latencyMs": 0}}})
-
-    return response
+@track_backend_call('gemini')
+async def generate_gemini_content(message, **kwargs):
+    # Awaited on the event loop, so a streamed answer does not hold a thread while Gemini generates it.
+    return await get_genai_model().generate_content_async(message, **kwargs)
 
 
-def concurrent_gemini_converse(sections, aggregate_response=False, max_workers=4):
-    with ThreadPoolExecutor(max_workers = max_workers) as executor:
-         results = executor.map(gemini_converse, sections, [True for i in range(len(sections))])
+@track_backend_call('vector_store')
+def query_cwog_collection(query_embeddings, n_results):
+    if settings.VECTOR_STORE_BACKEND == 'numpy':
+        vector_index = get_vector_index()
+        if vector_index is not None:
+            return vector_index.query(
+                query_embeddings, n_results, settings.VECTOR_INDEX_PROBES, settings.VECTOR_INDEX_RESCORE_CANDIDATES)
+        logger.warning("No vector index was exported, querying chroma instead.")
 
-    return results
+    return get_cwog_collection().query(query_embeddings=query_embeddings, n_results=n_results)
 
 
-def get_gandhi_ai_rag_response(request):
-    message = request.data['messages'][-1]
+async def gemini_converse(message, aggregate_response=False):
+    if aggregate_response == True:
+        # Every attempt waits for its own slot, so backing off between attempts holds none.
+        converse_response = await call_with_retry_async(
+            'gemini', get_scheduler('gemini').call, generate_gemini_content, message)
+        usage = getattr(converse_response, 'usage_metadata', None)
+        if usage:
+            count_llm_tokens('gemini', usage.prompt_token_count, usage.candidates_token_count)
+        return converse_response.text
+
+    stream = gemini_response_stream(message)
+    # Starting the answer raises its errors here, before anything was streamed to the client.
+    first_chunk = await stream.__anext__()
+
+    return {
+        'stream': resumed_stream(first_chunk, stream)
+    }
 
-    query_embeddings = get_query_embeddings(message['content'])
 
-    relevant_document_chunks = settings.CWOG_COLLECTION.query(query_embeddings=query_embeddings, n_results=3)
+async def resumed_stream(first_chunk, stream):
+    try:
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.aclose()
+
+
+async def start_gemini_stream(scheduler, message):
+    """Start streaming the answer once a slot of ``scheduler`` is free, which the caller releases after streaming it.
+
+    A failed attempt releases its slot, so backing off before the next one holds none.
+    """
+    await scheduler.acquire()
+    try:
+        return await generate_gemini_content(message, stream=True)
+    except BaseException:
+        scheduler.release()
+        raise
+
+
+async def gemini_response_stream(message):
+    """Stream the Gemini answer to ``message`` as Bedrock converse stream chunks.
+
+    Text deltas are yielded as soon as Gemini produces them instead of after
+    the whole answer has been generated. The answer holds a slot of the
+    gemini_stream scheduler until it was streamed completely or the stream is
+    closed.
+    """
+    scheduler = get_scheduler('gemini_stream')
+    # Only starting the stream is retried, an answer that fails halfway cannot be taken back.
+    converse_response = await call_with_retry_async('gemini', start_gemini_stream, scheduler, message)
+    try:
+        start_time = time.time()
+        stop_reason = "end_turn"
+        usage = {"inputTokens": 0, "outputTokens": 0, "totalTokens": 0}
+
+        yield {"messageStart": {"role": "assistant"}}
+
+        try:
+            async for chunk in converse_response:
+                if chunk.parts:
+                    yield {
+                        "contentBlockDelta": {
+                            "delta": {
+                                "text": chunk.text
+                            },
+                            "contentBlockIndex": 0
+                        }
+                    }
+
+                if chunk.candidates and chunk.candidates[0].finish_reason:
+                    stop_reason = chunk.candidates[0].finish_reason.name
+
+                if chunk.usage_metadata:
+                    usage = {
+                        "inputTokens": chunk.usage_metadata.prompt_token_count,
+                        "outputTokens": chunk.usage_metadata.candidates_token_count,
+                        "totalTokens": chunk.usage_metadata.total_token_count,
+                    }
+        except Exception as e:
+            # Errors of an answer failing halfway are raised here, after the tracked call that started it returned.
+            count_backend_error('gemini', e)
+            raise
+
+        record_stage('synthesis_stream', time.time() - start_time)
+        count_llm_tokens('gemini', usage['inputTokens'], usage['outputTokens'])
+    finally:
+        scheduler.release()
+
+    yield {"contentBlockStop": {"contentBlockIndex": 0}}
+    yield {"messageStop": {"stopReason": stop_reason}}
+    yield {"metadata": {"usage": usage, "metrics": {"latencyMs": int((time.time() - start_time) * 1000)}}}
+
+
+async def cached_answer_stream(answer):
+    yield {"messageStart": {"role": "assistant"}}
+    yield {"contentBlockDelta": {"delta": {"text": answer}, "contentBlockIndex": 0}}
+    yield {"contentBlockStop": {"contentBlockIndex": 0}}
+    yield {"messageStop": {"stopReason": "end_turn"}}
+    yield {"metadata": {"usage": {"inputTokens": 0, "outputTokens": 0, "totalTokens": 0}, "metrics": {"latencyMs": 0}}}
+
+
+async def caching_answer_stream(stream, query_embeddings, answer_variant):
+    """Pass the answer stream through and cache the answer once it completed normally."""
+    answer = []
+    stop_reason = None
+    async for chunk in stream:
+        if "contentBlockDelta" in chunk:
+            answer.append(chunk["contentBlockDelta"]["delta"].get("text", ""))
+        if "messageStop" in chunk:
+            stop_reason = chunk["messageStop"]["stopReason"]
+        yield chunk
+
+    if stop_reason in ("STOP", "end_turn") and answer and query_embeddings is not None:
+        await run_in_backend_executor(cache_answer, query_embeddings, answer_variant, "".join(answer))
+
+
+async def concurrent_gemini_converse(sections, aggregate_response=False, max_workers=None):
+    # The Gemini scheduler caps concurrency across the whole process, this caps a single request.
+    semaphore = asyncio.Semaphore(max_workers or settings.MAP_STEP_PER_REQUEST_CONCURRENCY)
+
+    async def converse(section):
+        async with semaphore:
+            return await gemini_converse(section, aggregate_response)
+
+    return await asyncio.gather(*[converse(section) for section in sections])
+
+
+async def embed_query(query_text):
+    with track_stage('embed_query'):
+        query_embeddings = await run_in_backend_executor(get_cached_query_embeddings, query_text)
+        if query_embeddings is None:
+            query_embeddings = await call_with_retry_async(
+                'bedrock', get_scheduler('bedrock').run, get_query_embeddings, query_text)
+            await run_in_backend_executor(cache_query_embeddings, query_text, query_embeddings)
+    return query_embeddings
+
+
+async def embed_query_for_retrieval(query_text, lexical_index):
+    """Embed the question, or return None when the lexical index answers alone.
+
+    With a lexical index to fall back on, embedding the question may take at
+    most ``QUERY_EMBEDDING_TIMEOUT`` seconds and failures are not raised.
+    """
+    if lexical_index is None:
+        return await embed_query(query_text)
+    if settings.RETRIEVAL_MODE == 'lexical':
+        return None
+
+    try:
+        return await asyncio.wait_for(embed_query(query_text), settings.QUERY_EMBEDDING_TIMEOUT)
+    except Exception:
+        logger.exception("Could not embed the question, retrieving from the lexical index only.")
+        return None
+
+
+async def retrieve_relevant_chunks(query_text, query_embeddings, lexical_index, n_results):
+    """Query the vector store, the lexical index or both, in the shape of a chroma query result.
+
+    Without embeddings only the lexical index is used, without a lexical index only the vector store.
+    """
+    if query_embeddings is None:
+        return await run_in_backend_executor(lexical_index.query, query_text, n_results)
+    if lexical_index is None:
+        return await run_in_backend_executor(query_cwog_collection, query_embeddings, n_results)
+
+    candidates = max(n_results, settings.RETRIEVAL_FUSION_CANDIDATES)
+    vector_results, lexical_results = await asyncio.gather(
+        run_in_backend_executor(query_cwog_collection, query_embeddings, candidates),
+        run_in_backend_executor(lexical_index.query, query_text, candidates),
+    )
+    return reciprocal_rank_fusion([vector_results, lexical_results], n_results, settings.RETRIEVAL_RRF_K)
 
-    relevant_sections, sources = get_relevant_sections_with_metadata(relevant_document_chunks)
 
+async def get_map_reduce_prompt(question, relevant_sections, section_keys, sources):
+    """Answer the question from every slice of the sections first, then prompt for the final answer from those."""
     request_sections = []
+    map_cache_keys = []
     PER_SECTION_CHAR_LIMIT = 30000
-    for section in relevant_sections:
+    for section, section_key in zip(relevant_sections, section_keys):
 
         prompt = """Model Instructions:
             - Respond to questions with clarity and brevity, ensuring that your answers reflect the principles of truth, non-violence, and compassion.
@@ -135,12 +314,33 @@ def get_gandhi_ai_rag_response(request):
         request_sub_sections = []
         for i in range(0, len(section), PER_SECTION_CHAR_LIMIT):
             sub_section = section[i:i+PER_SECTION_CHAR_LIMIT]
-            sub_section_prompt = prompt.format(question=message['content'], context=sub_section)
+            sub_section_prompt = prompt.format(question=question, context=sub_section)
             request_sub_sections.append(sub_section_prompt)
+            map_cache_keys.append(get_map_answer_cache_key(question, section_key, i, sub_section))
 
         request_sections += request_sub_sections
 
-    per_section_responses = concurrent_gemini_converse(request_sections, aggregate_response=True)
+    # Only the sub-sections without a cached partial answer for this question are sent to Gemini.
+    cached_map_answers = await run_in_backend_executor(get_cached_map_answers, map_cache_keys)
+    missing_map_keys = [key for key in map_cache_keys if key not in cached_map_answers]
+    missing_map_sections = [
+        request_section
+        for key, request_section in zip(map_cache_keys, request_sections)
+        if key not in cached_map_answers
+    ]
+
+    with track_stage('map_step'):
+        generated_map_answers = dict(zip(
+            missing_map_keys,
+            await concurrent_gemini_converse(missing_map_sections, aggregate_response=True)
+        ))
+    if generated_map_answers:
+        await run_in_backend_executor(cache_map_answers, generated_map_answers)
+
+    per_section_responses = [
+        cached_map_answers[key] if key in cached_map_answers else generated_map_answers[key]
+        for key in map_cache_keys
+    ]
 
     full_context = "\n\n".join([
         per_section_response
@@ -159,8 +359,135 @@ def get_gandhi_ai_rag_response(request):
 
         Context: {context}
         
-        # Also add following references in the end of the answer:""".format(question=message['content'], context=full_context)
+        # Also add following references in the end of the answer:""".format(question=question, context=full_context)
 
     prompt += "\n".join(sources)
 
-    return gemini_converse(message=prompt)
\ No newline at end of file
+    return prompt
+
+
+def get_ranked_chunks(relevant_document_chunks, sections):
+    """Return the ``(section_key, chunk_offset)`` pairs of the retrieved chunks for ``pack_context``, best first.
+
+    Chunks embedded before their ids carried the offset are located by their
+    text. Returns None when one of them cannot be located either.
+    """
+    ids = relevant_document_chunks['ids'][0]
+    metadatas = relevant_document_chunks['metadatas'][0]
+    documents = relevant_document_chunks['documents'][0] if relevant_document_chunks.get('documents') else []
+
+    ranked_chunks = []
+    section_chunks = {}
+    for i, (chunk_id, metadata) in enumerate(zip(ids, metadatas)):
+        section_key = get_chunk_section_key(metadata)
+        if section_key not in sections:
+            continue
+
+        chunk_offset = get_chunk_offset(chunk_id)
+        if chunk_offset is None:
+            document = documents[i] if i < len(documents) else None
+            if section_key not in section_chunks:
+                section_chunks[section_key] = split_section(sections[section_key])
+            if document is None or document not in section_chunks[section_key]:
+                return None
+            chunk_offset = section_chunks[section_key].index(document)
+        ranked_chunks.append((section_key, chunk_offset))
+
+    return ranked_chunks
+
+
+def get_packed_prompt(question, ranked_chunks, relevant_sections, section_keys, sections_meta):
+    """Prompt for the answer from the best chunks and the text around them, packed into a token budget."""
+    sections = dict(zip(section_keys, relevant_sections))
+    packed_context = pack_context(ranked_chunks, sections, settings.PACKED_CONTEXT_TOKEN_BUDGET)
+
+    packed_sections_meta = dict(zip(section_keys, sections_meta))
+    context = []
+    for i, (section_key, text) in enumerate(packed_context):
+        context.append("[{num}]\n{text}".format(num=i+1, text=text))
+
+    prompt = """Model Instructions:
+        - Respond to questions with clarity and brevity, ensuring that your answers reflect the principles of truth, non-violence, and compassion.
+        - For yes/no questions, provide thoughtful insights and context that align with Gandhian philosophy.
+        - When multi-hop reasoning is required, draw from relevant information to present a coherent and logical answer that embodies Gandhi's values.
+        - If the search results do not contain sufficient information to answer the question, state: "I could not find an exact answer to the question."
+        - Always respond in the first person, embodying the spirit and wisdom of Mahatma Gandhi.
+        - The context holds excerpts of the Collected Works of Mahatma Gandhi, each one starting with the number of its reference.
+
+        Question: {question}
+
+        Context: {context}
+
+        # Also add following references in the end of the answer:""".format(question=question, context="\n\n".join(context))
+
+    prompt += "\n".join(format_sources([packed_sections_meta[section_key] for section_key, text in packed_context]))
+    return prompt
+
+
+async def get_gandhi_ai_rag_response(request_data):
+    message = request_data['messages'][-1]
+
+    lexical_index = None
+    if settings.RETRIEVAL_MODE != 'vector':
+        lexical_index = await run_in_backend_executor(get_lexical_index)
+        if lexical_index is None:
+            logger.warning("No lexical index was built, retrieving from the vector store only.")
+
+    query_embeddings = await embed_query_for_retrieval(message['content'], lexical_index)
+
+    context_mode = request_data.get('context_mode')
+    if context_mode not in ('packed', 'map_reduce'):
+        context_mode = settings.CONTEXT_MODE
+
+    set_request_timing_field('context_mode', context_mode)
+
+    # Answers are only reused for questions retrieved and answered the same way.
+    answer_variant = (settings.RETRIEVAL_MODE if lexical_index is not None else 'vector', context_mode)
+    if query_embeddings is not None and not request_data.get('bypass_cache'):
+        with track_stage('answer_cache_lookup'):
+            cached_answer = await run_in_backend_executor(get_cached_answer, query_embeddings, answer_variant)
+        if cached_answer is not None:
+            set_request_timing_field('answer_cache', 'hit')
+            return {
+                'stream': cached_answer_stream(cached_answer)
+            }
+
+    with track_stage('retrieve'):
+        relevant_document_chunks = await retrieve_relevant_chunks(
+            message['content'], query_embeddings, lexical_index,
+            settings.PACKED_CONTEXT_CANDIDATES if context_mode == 'packed' else settings.RETRIEVAL_N_RESULTS)
+
+    with track_stage('section_fetch'):
+        relevant_sections, section_keys, sections_meta = await run_in_backend_executor(
+            get_relevant_sections_with_metadata, relevant_document_chunks)
+
+    ranked_chunks = None
+    if context_mode == 'packed':
+        ranked_chunks = await run_in_backend_executor(
+            get_ranked_chunks, relevant_document_chunks, dict(zip(section_keys, relevant_sections)))
+        if ranked_chunks is None:
+            logger.warning("Retrieved chunks could not be located in their sections, answering with map_reduce "
+                           "until the vector store is re-populated.")
+            context_mode = 'map_reduce'
+            set_request_timing_field('context_mode', context_mode)
+            # Only as many sections as map_reduce retrieves are mapped.
+            relevant_sections, section_keys, sections_meta = (
+                relevant_sections[:settings.RETRIEVAL_N_RESULTS], section_keys[:settings.RETRIEVAL_N_RESULTS],
+                sections_meta[:settings.RETRIEVAL_N_RESULTS])
+
+    if context_mode == 'packed':
+        with track_stage('context_packing'):
+            prompt = await run_in_backend_executor(
+                get_packed_prompt, message['content'], ranked_chunks, relevant_sections, section_keys, sections_meta)
+    else:
+        prompt = await get_map_reduce_prompt(
+            message['content'], relevant_sections, section_keys, format_sources(sections_meta))
+    log_scheduler_stats()
+    log_cache_stats()
+
+    with track_stage('synthesis_first_token'):
+        response = await gemini_converse(message=prompt)
+
+    return {
+        'stream': caching_answer_stream(response['stream'], query_embeddings, answer_variant)
+    }
\ No newline at end of file
@@ -0,0 +1,166 @@
+import re
+import math
+import logging
+import numpy as np
+
+from array import array
+from collections import Counter
+from django.conf import settings
+
+from .chunk_index import ChunkArrays, ChunkIndex, CurrentIndex, write_index_build
+
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_INDEX_FORMAT_VERSION = 1
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+MAX_TERM_LENGTH = 32
+
+STOP_WORDS = frozenset(
+    "a an and are as at be been but by for from had has have he her him his i if in into is it its me my no not "
+    "of on or our she so than that the their them there these they this those to was we were what when which who "
+    "will with would you your".split()
+)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text):
+    return [
+        token[:MAX_TERM_LENGTH]
+        for token in TOKEN_PATTERN.findall(text.lower())
+        if token not in STOP_WORDS
+    ]
+
+
+def build_lexical_index(chunks, index_dir):
+    """Build a BM25 index of ``(id, document, metadata)`` chunks and make it the current one in ``index_dir``.
+
+    See ``write_index_build`` for how builds are stored. Returns the number of
+    indexed chunks.
+    """
+    vocabulary = {}
+    posting_terms = array('i')
+    posting_frequencies = array('i')
+    document_lengths = array('i')
+    document_terms = array('i')
+    chunk_arrays = ChunkArrays()
+
+    for chunk_id, document, metadata in chunks:
+        tokens = tokenize(document)
+        term_frequencies = Counter(tokens)
+        for term, frequency in term_frequencies.items():
+            posting_terms.append(vocabulary.setdefault(term, len(vocabulary)))
+            posting_frequencies.append(frequency)
+        document_lengths.append(len(tokens))
+        document_terms.append(len(term_frequencies))
+
+        chunk_arrays.append(chunk_id, metadata)
+
+    terms = np.array(list(vocabulary), dtype='U{0}'.format(MAX_TERM_LENGTH))
+    term_order = np.argsort(terms, kind='stable')
+    term_ranks = np.empty_like(term_order)
+    term_ranks[term_order] = np.arange(len(term_order))
+
+    # Postings are grouped by term in the sorted term order, documents stay in ascending order.
+    document_lengths = np.frombuffer(document_lengths, dtype=np.int32)
+    posting_documents = np.repeat(
+        np.arange(len(document_lengths), dtype=np.int32), np.frombuffer(document_terms, dtype=np.int32))
+    posting_terms = term_ranks[np.frombuffer(posting_terms, dtype=np.int32)]
+    posting_order = np.argsort(posting_terms, kind='stable')
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(posting_terms, minlength=len(terms)), out=term_offsets[1:])
+
+    arrays = {
+        'terms': terms[term_order],
+        'term_offsets': term_offsets,
+        'posting_documents': posting_documents[posting_order],
+        'posting_frequencies': np.frombuffer(posting_frequencies, dtype=np.int32)[posting_order],
+        'document_lengths': document_lengths,
+    }
+    arrays.update(chunk_arrays.get_arrays())
+    write_index_build(index_dir, arrays, {
+        'format_version': LEXICAL_INDEX_FORMAT_VERSION,
+        'documents': len(chunk_arrays),
+        'terms': len(terms),
+        'average_document_length': float(document_lengths.mean()) if len(chunk_arrays) else 0.0,
+    })
+
+    return len(chunk_arrays)
+
+
+class LexicalIndex(ChunkIndex):
+    """Read-only BM25 index over memory-mapped arrays, see ``build_lexical_index``."""
+
+    ARRAYS = ('terms', 'term_offsets', 'posting_documents', 'posting_frequencies', 'document_lengths')
+
+    def __init__(self, build_dir):
+        super().__init__(build_dir)
+        self.length_norms = (1 - BM25_B) + BM25_B * (
+            np.asarray(self.document_lengths, dtype=np.float32) / (self.manifest['average_document_length'] or 1.0))
+
+    def search(self, query_text, n_results):
+        """Return the ``(document, score)`` pairs of the best matching chunks, best first."""
+        documents = self.manifest['documents']
+        scores = np.zeros(documents, dtype=np.float32)
+        for term in set(tokenize(query_text)):
+            position = int(np.searchsorted(self.terms, term))
+            if position == len(self.terms) or self.terms[position] != term:
+                continue
+
+            start, end = self.term_offsets[position], self.term_offsets[position + 1]
+            posting_documents = self.posting_documents[start:end]
+            frequencies = np.asarray(self.posting_frequencies[start:end], dtype=np.float32)
+            idf = math.log(1 + (documents - (end - start) + 0.5) / ((end - start) + 0.5))
+            scores[posting_documents] += idf * frequencies * (BM25_K1 + 1) / (
+                frequencies + BM25_K1 * self.length_norms[posting_documents])
+
+        matches = np.flatnonzero(scores)
+        if len(matches) > n_results:
+            matches = matches[np.argpartition(scores[matches], -n_results)[-n_results:]]
+        matches = matches[np.argsort(-scores[matches], kind='stable')]
+        return [(int(document), float(scores[document])) for document in matches]
+
+    def query(self, query_text, n_results):
+        """Search the index, returning the ids and metadatas in the shape of a chroma query result."""
+        matches = self.search(query_text, n_results)
+        return {
+            'ids': [[self.get_chunk_id(document) for document, score in matches]],
+            'metadatas': [[self.get_metadata(document) for document, score in matches]],
+            'distances': [[-score for document, score in matches]],
+        }
+
+
+_current_lexical_index = CurrentIndex(LexicalIndex)
+
+
+def get_lexical_index():
+    """Return the current lexical index, reloading it after a rebuild, or None when none was built."""
+    return _current_lexical_index.get(settings.LEXICAL_INDEX_DIR)
+
+
+def reciprocal_rank_fusion(query_results, n_results, k=60):
+    """Fuse chroma-shaped query results by reciprocal rank, keeping the metadata of the first result of a chunk.
+
+    The text of a chunk is kept from the first result that has it, None when none does.
+    """
+    scores = Counter()
+    metadatas = {}
+    documents = {}
+    for query_result in query_results:
+        result_documents = query_result['documents'][0] if query_result.get('documents') else []
+        for rank, (chunk_id, metadata) in enumerate(zip(query_result['ids'][0], query_result['metadatas'][0])):
+            scores[chunk_id] += 1 / (k + rank + 1)
+            metadatas.setdefault(chunk_id, metadata)
+            if rank < len(result_documents) and documents.get(chunk_id) is None:
+                documents[chunk_id] = result_documents[rank]
+
+    chunk_ids = [chunk_id for chunk_id, score in scores.most_common(n_results)]
+    return {
+        'ids': [chunk_ids],
+        'metadatas': [[metadatas[chunk_id] for chunk_id in chunk_ids]],
+        'documents': [[documents.get(chunk_id) for chunk_id in chunk_ids]],
+    }
@@ -0,0 +1,292 @@
+import json
+import time
+import asyncio
+import logging
+import resource
+import numpy as np
+
+from collections import Counter
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from gandhi_ai.benchmarking import get_fake_cache_settings, install_fake_backends
+from gandhi_ai.streaming_utils import ERROR_RESPONSE_STREAM
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUESTIONS = [
+    "What is truth?",
+    "What did you think of the salt tax?",
+    "How should we treat those who oppose us?",
+    "Why did you spin khadi every day?",
+    "What is the meaning of swaraj?",
+]
+
+# The text of the answer streamed when generating the response failed.
+ERROR_RESPONSE_TEXT = "".join(
+    chunk['contentBlockDelta']['delta']['text'] for chunk in ERROR_RESPONSE_STREAM if 'contentBlockDelta' in chunk)
+
+
+def get_rss_bytes():
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * resource.getpagesize()
+
+
+class Command(BaseCommand):
+    help = ('Load test /chat/completions with fake Bedrock, Gemini, chroma and redis backends of configurable '
+            'latency, reporting time to first byte, latency percentiles, requests/sec and worker memory.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--replay',
+            help='JSONL file of chat completion request bodies. Lines without messages use their "content" or '
+                 '"body" field as the question. By default a few built-in questions are asked.')
+        parser.add_argument(
+            '--requests', type=int, default=200,
+            help='Number of requests sent, cycling through the replayed ones.')
+        parser.add_argument(
+            '--concurrency', type=int, default=16,
+            help='Number of requests in flight at a time.')
+        parser.add_argument(
+            '--url',
+            help='Send the requests to a running server instead, e.g. http://127.0.0.1:8000. The fakes and '
+                 'memory reporting then do not apply.')
+        parser.add_argument(
+            '--use-answer-cache', action='store_true',
+            help='Let repeated questions be answered from the semantic answer cache.')
+        parser.add_argument('--embed-latency', type=float, default=0.15, help='Seconds per Bedrock embedding call.')
+        parser.add_argument('--vector-store-latency', type=float, default=0.02, help='Seconds per chroma query.')
+        parser.add_argument('--redis-latency', type=float, default=0.001, help='Seconds per redis round trip.')
+        parser.add_argument(
+            '--first-token-latency', type=float, default=0.8, help='Seconds before Gemini returns the first token.')
+        parser.add_argument('--token-latency', type=float, default=0.01, help='Seconds per following Gemini token.')
+        parser.add_argument('--tokens', type=int, default=200, help='Number of tokens per Gemini answer.')
+        parser.add_argument('--volumes', type=int, default=10, help='Number of fake volumes.')
+        parser.add_argument('--sections-per-volume', type=int, default=20, help='Number of fake sections per volume.')
+        parser.add_argument('--section-length', type=int, default=20000, help='Characters per fake section.')
+        parser.add_argument(
+            '--max-p99-ttfb', type=float,
+            help='Fail when the p99 time to first byte exceeds this many seconds.')
+        parser.add_argument(
+            '--max-p99-latency', type=float,
+            help='Fail when the p99 total latency exceeds this many seconds.')
+        parser.add_argument('--report', help='Also write the report to this JSON file.')
+
+    def get_request_bodies(self, options):
+        if not options['replay']:
+            records = [{'content': question} for question in DEFAULT_QUESTIONS]
+        else:
+            with open(options['replay']) as fp:
+                records = [json.loads(line) for line in fp if line.strip()]
+
+        request_bodies = []
+        for record in records:
+            if 'messages' not in record:
+                question = record.pop('content', None) or record.pop('body')
+                record.pop('body', None)
+                record['messages'] = [{'role': 'user', 'content': question}]
+            record.setdefault('model', 'gandhi-ai-v1:0')
+            record.setdefault('stream', True)
+            if not options['use_answer_cache']:
+                record['bypass_cache'] = True
+            request_bodies.append(record)
+        if not request_bodies:
+            raise CommandError('No requests to replay.')
+        return request_bodies
+
+    async def send_asgi_request(self, application, body):
+        """Call the ASGI application directly, returning the status, body and times of the first and last byte."""
+        request_body = json.dumps(body).encode('utf-8')
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST', 'scheme': 'http',
+            'path': '/chat/completions', 'raw_path': b'/chat/completions', 'query_string': b'', 'root_path': '',
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(request_body)).encode())],
+            'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+        }
+        received = False
+        disconnected = asyncio.Event()
+        response = {'status': None, 'body': b'', 'first_byte': None, 'last_byte': None}
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {'type': 'http.request', 'body': request_body, 'more_body': False}
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                if message.get('body') and response['first_byte'] is None:
+                    response['first_byte'] = time.perf_counter()
+                response['body'] += message.get('body', b'')
+                if not message.get('more_body'):
+                    response['last_byte'] = time.perf_counter()
+                    disconnected.set()
+
+        await application(scope, receive, send)
+        return response
+
+    async def send_http_request(self, client, url, body):
+        import httpx
+
+        response = {'status': None, 'body': b'', 'first_byte': None, 'last_byte': None}
+        async with client.stream('POST', url + '/chat/completions', json=body, timeout=httpx.Timeout(300)) as http_response:
+            response['status'] = http_response.status_code
+            async for data in http_response.aiter_bytes():
+                if data and response['first_byte'] is None:
+                    response['first_byte'] = time.perf_counter()
+                response['body'] += data
+        response['last_byte'] = time.perf_counter()
+        return response
+
+    async def run_load(self, send_request, request_bodies, n_requests, concurrency):
+        results = []
+        next_request = iter(range(n_requests))
+
+        async def worker():
+            for i in next_request:
+                start_time = time.perf_counter()
+                try:
+                    response = await send_request(request_bodies[i % len(request_bodies)])
+                except Exception:
+                    logger.exception("Benchmark request failed")
+                    response = {'status': None, 'body': b'', 'first_byte': None, 'last_byte': None}
+                results.append((start_time, response))
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return results, time.perf_counter() - start_time
+
+    async def run_benchmark(self, request_bodies, options):
+        if options['url']:
+            import httpx
+
+            async with httpx.AsyncClient(limits=httpx.Limits(max_connections=options['concurrency'])) as client:
+                return await self.run_load(
+                    lambda body: self.send_http_request(client, options['url'].rstrip('/'), body),
+                    request_bodies, options['requests'], options['concurrency'])
+
+        # No lifespan startup event is sent, so the real clients are not warmed up over the fakes.
+        from aws_bedrock_access_gateway.asgi import application
+
+        # The first request pays for loading the tokenizer and other lazy state, it is not measured.
+        await self.send_asgi_request(application, request_bodies[0])
+        return await self.run_load(
+            lambda body: self.send_asgi_request(application, body),
+            request_bodies, options['requests'], options['concurrency'])
+
+    def get_response_error(self, response):
+        """Return why a chat completion failed, or None when it streamed a complete answer.
+
+        The view answers 200 before the answer is generated, so failures are
+        only visible in the stream: the error answer, a stream that ended
+        without a stop reason or without the final [DONE] event.
+        """
+        if response['status'] != 200:
+            return 'status {0}'.format(response['status'])
+
+        events = [event[len('data: '):] for event in response['body'].decode('utf-8').split('\n\n')
+                  if event.startswith('data: ')]
+        if not events or events[-1] != '[DONE]':
+            return 'no [DONE]'
+
+        content = []
+        finish_reasons = set()
+        for event in events[:-1]:
+            for choice in json.loads(event).get('choices') or []:
+                content.append(choice['delta'].get('content') or '')
+                finish_reasons.add(choice.get('finish_reason'))
+        if ERROR_RESPONSE_TEXT in ''.join(content):
+            return 'error answer'
+        if 'stop' not in finish_reasons:
+            return 'no stop finish reason'
+        return None
+
+    def get_percentiles(self, values):
+        if not values:
+            return {}
+        return {
+            'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)),
+            'p99': float(np.percentile(values, 99)),
+            'max': float(np.max(values)),
+        }
+
+    def handle(self, *args, **options):
+        request_bodies = self.get_request_bodies(options)
+
+        if options['url']:
+            results, elapsed_time = asyncio.run(self.run_benchmark(request_bodies, options))
+            memory = None
+        else:
+            with override_settings(
+                    CACHES=get_fake_cache_settings(options['redis_latency']), RETRIEVAL_MODE='vector',
+                    VECTOR_STORE_BACKEND='chroma'):
+                install_fake_backends(
+                    cache, options['embed_latency'], options['vector_store_latency'],
+                    options['first_token_latency'], options['token_latency'], options['tokens'],
+                    options['volumes'], options['sections_per_volume'], options['section_length'])
+
+                rss_before = get_rss_bytes()
+                results, elapsed_time = asyncio.run(self.run_benchmark(request_bodies, options))
+                memory = {
+                    'rss_before': rss_before,
+                    'rss_after': get_rss_bytes(),
+                    'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                }
+
+        succeeded = []
+        errors = Counter()
+        for start_time, response in results:
+            error = self.get_response_error(response)
+            if error:
+                errors[error] += 1
+            else:
+                succeeded.append((start_time, response))
+        report = {
+            'requests': len(results),
+            'errors': len(results) - len(succeeded),
+            'error_reasons': dict(errors),
+            'concurrency': options['concurrency'],
+            'elapsed_time': elapsed_time,
+            'requests_per_second': len(succeeded) / elapsed_time if elapsed_time else 0.0,
+            'ttfb': self.get_percentiles([
+                response['first_byte'] - start_time for start_time, response in succeeded
+                if response['first_byte'] is not None]),
+            'latency': self.get_percentiles([response['last_byte'] - start_time for start_time, response in succeeded]),
+            'memory': memory,
+        }
+
+        self.stdout.write("{0} requests, {1} errors, concurrency {2}, {3:.1f} requests/sec".format(
+            report['requests'], report['errors'], report['concurrency'], report['requests_per_second']))
+        if errors:
+            self.stdout.write("errors: {0}".format(", ".join(
+                "{0} {1}".format(count, error) for error, count in errors.most_common())))
+        for name in ('ttfb', 'latency'):
+            self.stdout.write("{0}: {1}".format(name, ", ".join(
+                "{0} {1:.3f}s".format(percentile, value) for percentile, value in report[name].items())))
+        if memory:
+            self.stdout.write("worker memory: rss {0:.1f}MB before, {1:.1f}MB after, {2:.1f}MB peak".format(
+                memory['rss_before'] / 2 ** 20, memory['rss_after'] / 2 ** 20, memory['max_rss'] / 2 ** 20))
+
+        if options['report']:
+            with open(options['report'], 'w') as fp:
+                json.dump(report, fp, indent=2)
+
+        if report['errors']:
+            raise CommandError('{0} requests failed.'.format(report['errors']))
+        if options['max_p99_ttfb'] is not None and report['ttfb'].get('p99', 0) > options['max_p99_ttfb']:
+            raise CommandError('p99 time to first byte {0:.3f}s exceeds {1}s.'.format(
+                report['ttfb']['p99'], options['max_p99_ttfb']))
+        if options['max_p99_latency'] is not None and report['latency'].get('p99', 0) > options['max_p99_latency']:
+            raise CommandError('p99 latency {0:.3f}s exceeds {1}s.'.format(
+                report['latency']['p99'], options['max_p99_latency']))
+
+        self.stdout.write(
+            self.style.SUCCESS('Sucessfully benchmarked /chat/completions.')
+        )
@@ -0,0 +1,76 @@
+import os
+import time
+import logging
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gandhi_ai import legacy_parsing
+from gandhi_ai.utils import (read_word_file_with_python_docx, read_word_file_with_iterparse,
+                             split_file_content_into_sections, clean_the_split_sections, get_volume_from_docx_file)
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Time the CWOG parsing stages against their original implementations and check the output is identical.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--volumes', type=int, nargs='+',
+            help='Only benchmark these volume numbers.')
+        parser.add_argument(
+            '--repeat', type=int, default=3,
+            help='Number of runs per stage, the fastest one is reported.')
+
+    def time_stage(self, stage, legacy_function, function, *args):
+        legacy_times = []
+        times = []
+        for _ in range(self.repeat):
+            start_time = time.perf_counter()
+            legacy_output = legacy_function(*args)
+            legacy_times.append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            output = function(*args)
+            times.append(time.perf_counter() - start_time)
+
+        self.legacy_times[stage] += min(legacy_times)
+        self.times[stage] += min(times)
+        if output != legacy_output:
+            self.mismatches.append((stage, self.docx_file))
+        return output
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        self.legacy_times = defaultdict(float)
+        self.times = defaultdict(float)
+        self.mismatches = []
+
+        for docx_file in sorted(os.listdir('./resources/collected_works_of_gandhi')):
+            if options['volumes'] and int(get_volume_from_docx_file(docx_file)) not in options['volumes']:
+                continue
+
+            self.docx_file = docx_file
+            print(docx_file)
+            content = self.time_stage(
+                'read', read_word_file_with_python_docx, read_word_file_with_iterparse,
+                "./resources/collected_works_of_gandhi/{0}".format(docx_file))
+            split_sections = self.time_stage(
+                'split', legacy_parsing.split_file_content_into_sections, split_file_content_into_sections, content)
+            self.time_stage('clean', legacy_parsing.clean_the_split_sections, clean_the_split_sections, split_sections)
+
+        for stage, legacy_time in self.legacy_times.items():
+            self.stdout.write(
+                "{0}: {1:.3f}s original, {2:.3f}s current ({3:.1f}x)".format(
+                    stage, legacy_time, self.times[stage], legacy_time / self.times[stage] if self.times[stage] else 0)
+            )
+
+        if self.mismatches:
+            raise CommandError('Output differs from the original implementation: {0}'.format(self.mismatches))
+
+        self.stdout.write(
+            self.style.SUCCESS('Sucessfully benchmarked CWOG parsing, output is identical.')
+        )
@@ -0,0 +1,133 @@
+import time
+import random
+import itertools
+import logging
+import numpy as np
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from gandhi_ai.chunk_index import iter_collection_chunks
+from gandhi_ai.clients import get_cwog_collection
+from gandhi_ai.gandhi_ai_rag import get_query_embeddings
+from gandhi_ai.vector_index import get_vector_index
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Compare the recall@k and latency of the vector index and chroma against an exact search of the '
+            'float32 embeddings of the store.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--questions',
+            help='File of questions, one per line, embedded with Bedrock. By default the embeddings of '
+                 'randomly sampled chunks of the store are used as queries.')
+        parser.add_argument(
+            '--sample', type=int, default=200,
+            help='Number of chunks sampled as queries when no questions are given.')
+        parser.add_argument(
+            '--n-results', type=int, default=10,
+            help='The k of recall@k.')
+        parser.add_argument(
+            '--probes', type=int, default=settings.VECTOR_INDEX_PROBES,
+            help='Number of lists of the vector index searched per query.')
+        parser.add_argument(
+            '--rescore-candidates', type=int, default=settings.VECTOR_INDEX_RESCORE_CANDIDATES,
+            help='Number of the best quantized hits re-scored with the float32 vectors, when they were exported.')
+        parser.add_argument(
+            '--batch-size', type=int, default=32,
+            help='Number of queries per call when timing batched search.')
+
+    def get_queries(self, collection, vector_index, options):
+        if options['questions']:
+            with open(options['questions']) as fp:
+                questions = [line.strip() for line in fp if line.strip()]
+            return np.array([get_query_embeddings(question)[0] for question in questions], dtype=np.float32)
+
+        documents = random.Random(0).sample(
+            range(vector_index.manifest['documents']), min(options['sample'], vector_index.manifest['documents']))
+        chunk_ids = [vector_index.get_chunk_id(document) for document in documents]
+        return np.array(collection.get(ids=chunk_ids, include=['embeddings'])['embeddings'], dtype=np.float32)
+
+    def get_exact_ids(self, collection, queries, batch_size):
+        """Find the exact neighbours of the queries among the float32 embeddings of the store, a batch at a time."""
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        best_ids = np.empty((len(queries), 0), dtype=object)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        chunks = iter_collection_chunks(collection, ['embeddings'], batch_size)
+        while batch := list(itertools.islice(chunks, batch_size)):
+            ids = np.array([chunk_id for chunk_id, embedding in batch], dtype=object)
+            embeddings = np.array([embedding for chunk_id, embedding in batch], dtype=np.float32)
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+            scores = np.concatenate([best_scores, queries @ embeddings.T], axis=1)
+            ids = np.concatenate([best_ids, np.broadcast_to(ids, (len(queries), len(ids)))], axis=1)
+            best = np.argsort(-scores, axis=1, kind='stable')[:, :self.n_results]
+            best_ids = np.take_along_axis(ids, best, axis=1)
+            best_scores = np.take_along_axis(scores, best, axis=1)
+        return [set(query_ids) for query_ids in best_ids]
+
+    def time_queries(self, name, search, queries, exact_ids):
+        latencies = []
+        recalls = []
+        for query, query_exact_ids in zip(queries, exact_ids):
+            start_time = time.perf_counter()
+            ids = search(query)
+            latencies.append(time.perf_counter() - start_time)
+            recalls.append(len(set(ids) & query_exact_ids) / len(query_exact_ids) if query_exact_ids else 1.0)
+
+        self.stdout.write(
+            "{0}: recall@{1} {2:.4f}, p50 {3:.2f}ms, p99 {4:.2f}ms".format(
+                name, self.n_results, float(np.mean(recalls)), np.percentile(latencies, 50) * 1000,
+                np.percentile(latencies, 99) * 1000)
+        )
+
+    def handle(self, *args, **options):
+        vector_index = get_vector_index()
+        if vector_index is None:
+            raise CommandError('No vector index was exported, run export_vector_index first.')
+        if not vector_index.manifest['documents']:
+            raise CommandError('The vector index is empty.')
+
+        self.n_results = options['n_results']
+        collection = get_cwog_collection()
+        queries = self.get_queries(collection, vector_index, options)
+        self.stdout.write("{0} queries over {1} chunks, {2} quantization, {3} lists".format(
+            len(queries), vector_index.manifest['documents'], vector_index.manifest['quantization'],
+            vector_index.manifest['lists']))
+
+        exact_ids = self.get_exact_ids(collection, queries, 5000)
+
+        self.time_queries(
+            'chroma', lambda query: collection.query(query_embeddings=[query.tolist()], n_results=self.n_results)['ids'][0],
+            queries, exact_ids)
+        self.time_queries(
+            'vector index, every list', lambda query: vector_index.query([query], self.n_results)['ids'][0],
+            queries, exact_ids)
+        if options['probes']:
+            self.time_queries(
+                'vector index, {0} lists'.format(options['probes']),
+                lambda query: vector_index.query([query], self.n_results, options['probes'])['ids'][0],
+                queries, exact_ids)
+        if options['rescore_candidates'] and vector_index.vectors is not None:
+            self.time_queries(
+                'vector index, {0} lists, {1} re-scored'.format(options['probes'], options['rescore_candidates']),
+                lambda query: vector_index.query(
+                    [query], self.n_results, options['probes'], options['rescore_candidates'])['ids'][0],
+                queries, exact_ids)
+
+        start_time = time.perf_counter()
+        for start in range(0, len(queries), options['batch_size']):
+            vector_index.query(
+                queries[start:start + options['batch_size']], self.n_results, options['probes'],
+                options['rescore_candidates'])
+        elapsed_time = time.perf_counter() - start_time
+        self.stdout.write("vector index, batches of {0}: {1:.0f} queries/sec".format(
+            options['batch_size'], len(queries) / elapsed_time if elapsed_time else 0))
+
+        self.stdout.write(
+            self.style.SUCCESS('Sucessfully benchmarked the vector index.')
+        )
@@ -0,0 +1,35 @@
+import sys
+import time
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from gandhi_ai.chunk_index import iter_collection_chunks
+from gandhi_ai.clients import get_cwog_collection
+from gandhi_ai.lexical_index import build_lexical_index
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Build the BM25 lexical index over the chunks of the collected_works_of_gandhi vector store.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Number of chunks read from chroma per call.')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        try:
+            indexed_chunks = build_lexical_index(
+                iter_collection_chunks(get_cwog_collection(), ['documents', 'metadatas'], options['batch_size']),
+                settings.LEXICAL_INDEX_DIR)
+        except RuntimeError:
+            raise CommandError('Error building the lexical index.').with_traceback(sys.exception().__traceback__)
+
+        self.stdout.write(
+            self.style.SUCCESS('Sucessfully indexed {0} chunks in {1:.1f}s.'.format(indexed_chunks, time.time() - start_time))
+        )
@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+import logging
+
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from gandhi_ai.utils import compile_cwog_volume
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Parse every CWOG .docx volume once into the compiled corpus read by the ingestion commands.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Number of processes parsing .docx volumes.')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        try:
+            collected_works_of_gandhi = os.listdir('./resources/collected_works_of_gandhi')
+            file_paths = [
+                "./resources/collected_works_of_gandhi/{0}".format(docx_file)
+                for docx_file in collected_works_of_gandhi
+            ]
+
+            with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+                for artifact_path in executor.map(
+                        partial(compile_cwog_volume, corpus_dir=settings.CWOG_COMPILED_CORPUS_DIR), file_paths):
+                    print(artifact_path)
+        except RuntimeError:
+            raise CommandError('Error compiling the CWOG corpus.').with_traceback(sys.exception().__traceback__)
+
+        self.stdout.write(
+            self.style.SUCCESS('Sucessfully compiled the CWOG corpus in {0:.1f}s.'.format(time.time() - start_time))
+        )
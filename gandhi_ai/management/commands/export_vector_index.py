@@ -0,0 +1,49 @@
+import sys
+import argparse
+import time
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from gandhi_ai.chunk_index import iter_collection_chunks
+from gandhi_ai.clients import get_cwog_collection
+from gandhi_ai.vector_index import build_vector_index, QUANTIZATIONS
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Export the embeddings of the collected_works_of_gandhi vector store to the partitioned, quantized vector index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Number of chunks read from chroma per call.')
+        parser.add_argument(
+            '--quantization', choices=QUANTIZATIONS, default=settings.VECTOR_INDEX_QUANTIZATION,
+            help='How the vectors are stored, int8 takes half the space of float16.')
+        parser.add_argument(
+            '--lists', type=int,
+            help='Number of k-means lists the vectors are partitioned into, by default about the square root of '
+                 'the number of chunks.')
+        parser.add_argument(
+            '--rescore-vectors', action=argparse.BooleanOptionalAction,
+            default=bool(settings.VECTOR_INDEX_RESCORE_CANDIDATES),
+            help='Also store a float32 copy of the vectors to re-score the best quantized hits with, by default '
+                 'when VECTOR_INDEX_RESCORE_CANDIDATES is set.')
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        try:
+            exported_chunks = build_vector_index(
+                iter_collection_chunks(get_cwog_collection(), ['embeddings', 'metadatas'], options['batch_size']),
+                settings.VECTOR_INDEX_DIR, options['quantization'], options['lists'],
+                options['rescore_vectors'])
+        except RuntimeError:
+            raise CommandError('Error exporting the vector index.').with_traceback(sys.exception().__traceback__)
+
+        self.stdout.write(
+            self.style.SUCCESS('Sucessfully exported {0} chunks in {1:.1f}s.'.format(exported_chunks, time.time() - start_time))
+        )
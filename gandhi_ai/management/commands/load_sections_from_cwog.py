@@ -1,14 +1,18 @@
-import re
 import os
 import sys
+import time
+import itertools
 import logging
 
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from django.core.cache import cache
+from django_redis import get_redis_connection
 
-from gandhi_ai.utils import (read_word_file, clean_the_split_sections, split_file_content_into_sections)
+from gandhi_ai.caches import invalidate_semantic_answer_cache, encode_section
+from gandhi_ai.utils import (compile_cwog_volume, read_compiled_cwog_volume, get_volume_from_docx_file,
+                             get_compiled_volume_hash)
 
 
 logger = logging.getLogger(__name__)
@@ -16,25 +20,121 @@ logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of cache entries written per set_many (redis pipeline) call.')
+        parser.add_argument(
+            '--volumes', type=int, nargs='+',
+            help='Only load these volume numbers.')
+        parser.add_argument(
+            '--changed-only', action='store_true',
+            help='Skip volumes whose .docx file and corpus format are unchanged since they were last loaded.')
+
+    def get_redis_used_memory(self):
+        try:
+            return get_redis_connection("default").info('memory')['used_memory']
+        except NotImplementedError:
+            # The configured cache backend is not django_redis.
+            return None
+
+    def flush(self, pending_entries):
+        if pending_entries:
+            cache.set_many(pending_entries, timeout=None)
+            pending_entries.clear()
+
+    def delete_stale_sections(self, vol, section_count, batch_size):
+        """Delete the sections of a volume numbered from ``section_count`` on, left by a load of an older version.
+
+        Sections are numbered from 0 without gaps, so the stale ones are read a
+        batch at a time until a batch finds none. Returns the number deleted.
+        """
+        deleted_sections = 0
+        for start in itertools.count(section_count, batch_size):
+            sections = range(start, start + batch_size)
+            section_keys = [settings.CWOG_CACHE_KEY_FORMAT.format(vol=vol, section=section) for section in sections]
+            stale_sections = cache.get_many(section_keys)
+            if not stale_sections:
+                return deleted_sections
+
+            meta_keys = [settings.CWOG_SECTION_META_KEY_FORMAT.format(vol=vol, section=section) for section in sections]
+            cache.delete_many(section_keys + meta_keys)
+            deleted_sections += len(stale_sections)
+
     def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        raw_bytes = 0
+        stored_bytes = 0
+        loaded_sections = 0
+        deleted_sections = 0
+        start_time = time.time()
+        used_memory_before = self.get_redis_used_memory()
         try:
             collected_works_of_gandhi = os.listdir('./resources/collected_works_of_gandhi')
             if not settings.SKIP_CWOG_CACHE_CREATION:
+                pending_entries = {}
                 for docx_file in collected_works_of_gandhi:
+                    vol = get_volume_from_docx_file(docx_file)
+                    if options['volumes'] and int(vol) not in options['volumes']:
+                        continue
+
                     file_path = "./resources/collected_works_of_gandhi/{0}".format(docx_file)
+                    file_hash = get_compiled_volume_hash(file_path)
+                    hash_key = settings.CWOG_VOLUME_HASH_KEY_FORMAT.format(vol=vol)
+                    if options['changed_only'] and cache.get(hash_key) == file_hash:
+                        print("{0} unchanged, skipping...".format(file_path))
+                        continue
+
                     print(file_path)
-                    content = read_word_file(file_path)
-                    split_sections = split_file_content_into_sections(content)
-                    pages, cleaned_sections = clean_the_split_sections(split_sections)
-                    
-                    vol = re.findall(r'mahatma-gandhi-collected-works-volume-(\d+).docx', docx_file)[0]
-                    for section, cleaned_section in enumerate(cleaned_sections):
+                    artifact_path = compile_cwog_volume(file_path, settings.CWOG_COMPILED_CORPUS_DIR)
+
+                    section_count = 0
+                    for record in read_compiled_cwog_volume(artifact_path):
+                        section = record['section']
+                        cleaned_section = record['text']
+
                         key = settings.CWOG_CACHE_KEY_FORMAT.format(vol=vol, section=section)
-                        value = cleaned_section
-                        cache.set(key, value, timeout=None)
+                        value = encode_section(cleaned_section)
+                        pending_entries[key] = value
+
+                        meta_key = settings.CWOG_SECTION_META_KEY_FORMAT.format(vol=vol, section=section)
+                        pending_entries[meta_key] = {'title': record['title'], 'page': record['page']}
+
+                        raw_bytes += len(cleaned_section.encode('utf-8'))
+                        stored_bytes += len(value) if isinstance(value, bytes) else len(value.encode('utf-8'))
+                        loaded_sections += 1
+                        section_count = section + 1
+
+                        if len(pending_entries) >= batch_size:
+                            self.flush(pending_entries)
+
+                    # The volume hash is only recorded once all of its sections are written.
+                    self.flush(pending_entries)
+                    # A volume that now splits into fewer sections leaves the keys of the others behind.
+                    deleted_sections += self.delete_stale_sections(vol, section_count, batch_size)
+                    cache.set(hash_key, file_hash, timeout=None)
         except RuntimeError:
             raise CommandError('Error populating redis cache with CWOG sections.').with_traceback(sys.exception().__traceback__)
 
+        invalidate_semantic_answer_cache()
+
+        elapsed_time = time.time() - start_time
+        used_memory_after = self.get_redis_used_memory()
+        self.stdout.write(
+            "Loaded {0} sections in {1:.1f}s ({2:.1f} sections/sec), deleted {3} stale sections.".format(
+                loaded_sections, elapsed_time, loaded_sections / elapsed_time if elapsed_time else 0,
+                deleted_sections)
+        )
+        self.stdout.write(
+            "Section text: {0:.1f} MB raw, {1:.1f} MB stored ({2} compression).".format(
+                raw_bytes / 1024 / 1024, stored_bytes / 1024 / 1024, settings.CWOG_SECTION_COMPRESSION)
+        )
+        if used_memory_before is not None:
+            self.stdout.write(
+                "Redis used memory: {0:.1f} MB before, {1:.1f} MB after.".format(
+                    used_memory_before / 1024 / 1024, used_memory_after / 1024 / 1024)
+            )
+
         self.stdout.write(
             self.style.SUCCESS('Sucessfully populated redis cache with CWOG sections.')
         )
\ No newline at end of file
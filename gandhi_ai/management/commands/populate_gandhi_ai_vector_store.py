@@ -1,64 +1,176 @@
 import re
 import os
 import sys
-import chromadb
+import time
 import logging
 
-from uuid import uuid4
+from functools import partial
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
 
-from gandhi_ai.utils import (read_word_file, split_section, get_embeddings, 
-                             clean_the_split_sections, split_file_content_into_sections)
+from gandhi_ai.caches import invalidate_semantic_answer_cache
+from gandhi_ai.clients import get_chroma_db_client
+from gandhi_ai.utils import (split_section, get_embeddings, get_embedding_cache, compile_cwog_volume,
+                             read_compiled_cwog_volume, get_chunk_id, get_compiled_volume_hash,
+                             get_volume_from_docx_file, CWOG_SOURCE_URL_FORMAT)
 
 
 logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
-
-    def add_to_db(self, collection, page, section, section_number, docx_file):
+    """Embed the collected works of Gandhi into the chroma vector store.
+
+    Volumes flow through three stages: compiling the .docx volumes into the
+    compiled corpus in a process pool (a no-op for volumes already compiled),
+    embedding requests in a bounded thread pool, and a single writer that
+    adds the embedded chunks to chroma in batches.
+
+    The BM25 lexical index and the quantized vector index are rebuilt from the
+    store once all volumes are written.
+
+    Chunk ids are derived from the volume, section, chunk offset and content, so
+    reruns only embed chunks that are not in the store yet and remove the ones
+    whose text no longer exists.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--parse-workers', type=int, default=os.cpu_count(),
+            help='Number of processes compiling .docx volumes that are missing from the compiled corpus.')
+        parser.add_argument(
+            '--embed-workers', type=int, default=4,
+            help='Number of concurrent embedding requests to Bedrock.')
+        parser.add_argument(
+            '--embed-batch-size', type=int, default=96,
+            help='Number of chunks per embedding request, Cohere accepts at most 96 texts.')
+        parser.add_argument(
+            '--write-batch-size', type=int, default=500,
+            help='Number of chunks upserted to chroma per call.')
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Re-check every volume, e.g. after changing the splitter, instead of skipping '
+                 'volumes whose .docx file and corpus format are unchanged since they were last embedded.')
+
+    def get_section_chunks(self, page, section, section_number, docx_file, section_title):
 
         chunks = split_section(section)
-        max_chunk_size = 50
-
-        for i in range(0, int(len(chunks)/max_chunk_size) + 1):
-            start_index = i*max_chunk_size
-            end_index = min(len(chunks) + 1, start_index + max_chunk_size)
-            sub_chunks = [chunk for chunk in chunks[start_index: end_index] if re.findall(r"[a-zA-Z]", chunk)]
+        doc_volume = get_volume_from_docx_file(docx_file)
 
-            if not sub_chunks:
+        for offset, chunk in enumerate(chunks):
+            if not re.findall(r"[a-zA-Z]", chunk):
                 continue
 
-            embeddings = get_embeddings(sub_chunks)
-            
-            doc_volume = re.findall(r'mahatma-gandhi-collected-works-volume-(\d+).docx', docx_file)[0]
-            metadatas = [
-                {
-                    'source': 'https://www.gandhiashramsevagram.org/gandhi-literature/mahatma-gandhi-collected-works-volume-{0}.pdf'.format(doc_volume), 
-                    'page': page,
-                    'section': section_number
-                }
-                for i in range(len(sub_chunks))
-            ]
-
-            ids = [
-                str(uuid4())
-                for i in range(len(sub_chunks))
-            ]
-            
-            collection.add(
-                documents=sub_chunks, ids=ids, metadatas=metadatas, embeddings=embeddings['embeddings']['float'])
+            metadata = {
+                'source': CWOG_SOURCE_URL_FORMAT.format(doc_volume),
+                'page': page,
+                'section': section_number,
+                'volume': int(doc_volume),
+                'title': section_title
+            }
+
+            yield docx_file, chunk, metadata, get_chunk_id(doc_volume, section_number, offset, chunk)
+
+    def get_existing_chunk_ids(self, collection, docx_file):
+        return set(collection.get(
+            where={"source": CWOG_SOURCE_URL_FORMAT.format(get_volume_from_docx_file(docx_file))},
+            include=[]
+        )['ids'])
+
+    def delete_stale_chunks(self, collection, stale_ids):
+        """Delete the chunks of a volume that this run did not produce, e.g. of sections the splitter dropped."""
+        stale_ids = list(stale_ids)
+        for i in range(0, len(stale_ids), self.write_batch_size):
+            collection.delete(ids=stale_ids[i:i + self.write_batch_size])
+        self.deleted_chunks += len(stale_ids)
+
+    def embed_batch(self, batch):
+        embeddings = get_embeddings([document for docx_file, document, metadata, id in batch])
+        return batch, embeddings['embeddings']['float']
+
+    def submit_embed_batch(self, collection, batch):
+        self.embed_futures.add(self.embed_executor.submit(self.embed_batch, batch))
+
+        # Bound the number of embedding requests waiting for the writer.
+        while len(self.embed_futures) >= self.max_pending_embeddings:
+            done, self.embed_futures = wait(self.embed_futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                self.buffer_embedded_batch(collection, future)
+
+    def write_batches(self, collection, force=False):
+        if not self.write_buffer or (not force and len(self.write_buffer['ids']) < self.write_batch_size):
+            return
+
+        collection.upsert(**self.write_buffer)
+        self.written_chunks += len(self.write_buffer['ids'])
+        self.write_buffer = {}
+
+        self.pending_chunks.subtract(self.buffered_chunks)
+        self.buffered_chunks = Counter()
+        self.checkpoint_volumes()
+
+    def buffer_embedded_batch(self, collection, future):
+        batch, embeddings = future.result()
+        for (docx_file, document, metadata, id), embedding in zip(batch, embeddings):
+            self.write_buffer.setdefault('documents', []).append(document)
+            self.write_buffer.setdefault('metadatas', []).append(metadata)
+            self.write_buffer.setdefault('ids', []).append(id)
+            self.write_buffer.setdefault('embeddings', []).append(embedding)
+            self.buffered_chunks[docx_file] += 1
+        self.embedded_chunks += len(batch)
+        self.embedding_requests += 1
+
+        self.write_batches(collection)
+
+    def checkpoint_volumes(self):
+        # A volume is recorded as embedded only once every one of its chunks is in chroma.
+        for docx_file in list(self.parsed_volumes):
+            if self.pending_chunks[docx_file] == 0:
+                with open('./resources/embedded_cwog_files.txt', 'a') as fp:
+                    fp.write("{0} {1}\n".format(docx_file, self.file_hashes[docx_file]))
+                self.parsed_volumes.remove(docx_file)
+                self.completed_volumes += 1
 
+    def report_progress(self):
+        elapsed_time = time.time() - self.start_time
+        self.stdout.write(
+            "{0} volumes done, {1} chunks embedded in {2} requests, {3} chunks written, {4} unchanged chunks "
+            "skipped, {5} stale chunks deleted in {6:.1f}s ({7:.1f} chunks/sec)".format(
+                self.completed_volumes, self.embedded_chunks, self.embedding_requests, self.written_chunks,
+                self.skipped_chunks, self.deleted_chunks, elapsed_time,
+                self.written_chunks / elapsed_time if elapsed_time else 0)
+        )
+        embedding_cache = get_embedding_cache()
+        if embedding_cache is not None:
+            self.stdout.write("Embedding cache: {0}".format(embedding_cache.stats()))
 
     def handle(self, *args, **options):
+        self.write_batch_size = options['write_batch_size']
+        self.write_buffer = {}
+        self.buffered_chunks = Counter()
+        self.pending_chunks = Counter()
+        self.parsed_volumes = []
+        self.completed_volumes = 0
+        self.embedded_chunks = 0
+        self.embedding_requests = 0
+        self.written_chunks = 0
+        self.skipped_chunks = 0
+        self.deleted_chunks = 0
+        self.file_hashes = {}
+        self.embed_futures = set()
+        self.start_time = time.time()
+
         try:
-            client = chromadb.PersistentClient(path="./gandhi_ai_vector_store")
-            
-            collection = client.get_or_create_collection('collected_works_of_gandhi', metadata={"hnsw:space": "cosine"})
+            client = get_chroma_db_client()
+
+            collection = client.get_or_create_collection(settings.CWOG_COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
 
             collected_works_of_gandhi = os.listdir('./resources/collected_works_of_gandhi')
-            
+
             embedded_cwog_files = []
             try:
                 with open('./resources/embedded_cwog_files.txt', 'r') as fp:
@@ -66,23 +178,66 @@ class Command(BaseCommand):
             except Exception as e:
                 pass
 
+            docx_files = []
             for docx_file in collected_works_of_gandhi:
-                print(docx_file)
-                if docx_file in embedded_cwog_files:
-                    print("File already populated, skipping...")
+                file_hash = get_compiled_volume_hash("./resources/collected_works_of_gandhi/{0}".format(docx_file))
+                self.file_hashes[docx_file] = file_hash
+                if not options['full'] and "{0} {1}".format(docx_file, file_hash) in embedded_cwog_files:
+                    print("{0} already populated, skipping...".format(docx_file))
                     continue
-                file_path = "./resources/collected_works_of_gandhi/{0}".format(docx_file)
-                content = read_word_file(file_path)
-                split_sections = split_file_content_into_sections(content)
-                pages, cleaned_sections = clean_the_split_sections(split_sections)
-                for section_number, cleaned_section in enumerate(cleaned_sections):
-                    self.add_to_db(collection, pages[section_number], cleaned_section, section_number, docx_file) 
-
-                with open('./resources/embedded_cwog_files.txt', 'a') as fp:
-                    fp.write(docx_file + "\n")
+                docx_files.append(docx_file)
+
+            file_paths = ["./resources/collected_works_of_gandhi/{0}".format(docx_file) for docx_file in docx_files]
+            self.max_pending_embeddings = options['embed_workers'] * 2
+
+            with ProcessPoolExecutor(max_workers=options['parse_workers']) as parse_executor, \
+                    ThreadPoolExecutor(max_workers=options['embed_workers']) as embed_executor:
+                self.embed_executor = embed_executor
+
+                # Chunks of consecutive sections and volumes are packed together so that
+                # every embedding request carries as many texts as Cohere accepts.
+                chunk_batch = []
+                artifact_paths = parse_executor.map(
+                    partial(compile_cwog_volume, corpus_dir=settings.CWOG_COMPILED_CORPUS_DIR), file_paths)
+                for docx_file, artifact_path in zip(docx_files, artifact_paths):
+                    print(docx_file)
+                    existing_ids = self.get_existing_chunk_ids(collection, docx_file)
+                    volume_ids = set()
+                    for record in read_compiled_cwog_volume(artifact_path):
+                        for chunk in self.get_section_chunks(
+                                record['page'], record['text'], record['section'], docx_file, record['title']):
+                            volume_ids.add(chunk[3])
+                            if chunk[3] in existing_ids:
+                                self.skipped_chunks += 1
+                                continue
+
+                            self.pending_chunks[docx_file] += 1
+                            chunk_batch.append(chunk)
+                            if len(chunk_batch) == options['embed_batch_size']:
+                                self.submit_embed_batch(collection, chunk_batch)
+                                chunk_batch = []
+                    self.delete_stale_chunks(collection, existing_ids - volume_ids)
+
+                    self.parsed_volumes.append(docx_file)
+                    self.checkpoint_volumes()
+                    self.report_progress()
+
+                if chunk_batch:
+                    self.submit_embed_batch(collection, chunk_batch)
+                for future in self.embed_futures:
+                    self.buffer_embedded_batch(collection, future)
+                self.write_batches(collection, force=True)
+
+            self.report_progress()
+
+            # The lexical and vector indexes are rebuilt from the store so that they cover exactly the same chunks.
+            call_command('build_lexical_index')
+            call_command('export_vector_index')
         except RuntimeError:
             raise CommandError('Error populating embeddings for collected_works_of_gandhi DB.').with_traceback(sys.exception().__traceback__)
 
+        invalidate_semantic_answer_cache()
+
         self.stdout.write(
             self.style.SUCCESS('Sucessfully populated embeddings for collected_works_of_gandhi DB.')
         )
\ No newline at end of file
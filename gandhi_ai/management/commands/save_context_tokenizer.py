@@ -0,0 +1,30 @@
+import sys
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Download a Hugging Face tokenizer to settings.CONTEXT_TOKENIZER, which workers load to count the '
+            'tokens of the packed context.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--name', default='Xenova/gpt-4o',
+            help='Hugging Face tokenizer to download.')
+
+    def handle(self, *args, **options):
+        from tokenizers import Tokenizer
+
+        try:
+            Tokenizer.from_pretrained(options['name']).save(settings.CONTEXT_TOKENIZER)
+        except RuntimeError:
+            raise CommandError('Error saving the context tokenizer.').with_traceback(sys.exception().__traceback__)
+
+        self.stdout.write(
+            self.style.SUCCESS('Sucessfully saved the {0} tokenizer to {1}.'.format(options['name'], settings.CONTEXT_TOKENIZER))
+        )
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import functools
+import contextlib
+import contextvars
+
+from django.conf import settings
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from .caches import QUERY_EMBEDDING_CACHE, SECTION_CACHE, SEMANTIC_ANSWER_CACHE, get_redis_cache_stats
+from .scheduler import get_scheduler_stats
+
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+STAGE_DURATION = Histogram(
+    'gandhi_ai_stage_duration_seconds', 'Time spent in a stage of answering a chat.', ['stage'],
+    buckets=LATENCY_BUCKETS)
+REQUEST_DURATION = Histogram(
+    'gandhi_ai_request_duration_seconds', 'Time until the chat answer stream ended.', ['outcome'],
+    buckets=LATENCY_BUCKETS)
+TIME_TO_FIRST_TOKEN = Histogram(
+    'gandhi_ai_time_to_first_token_seconds', 'Time until the first answer text was streamed.',
+    buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge(
+    'gandhi_ai_requests_in_flight', 'Chats being answered.', multiprocess_mode='livesum')
+REQUEST_ERRORS = Counter(
+    'gandhi_ai_request_errors_total', 'Chats answered with the error response or cut short.', ['stage'])
+
+BACKEND_CALL_DURATION = Histogram(
+    'gandhi_ai_backend_call_duration_seconds', 'Duration of calls to a backend.', ['backend'],
+    buckets=LATENCY_BUCKETS)
+BACKEND_CALLS_IN_FLIGHT = Gauge(
+    'gandhi_ai_backend_calls_in_flight', 'Calls to a backend waiting for its response.', ['backend'],
+    multiprocess_mode='livesum')
+BACKEND_ERRORS = Counter(
+    'gandhi_ai_backend_errors_total', 'Failed calls to a backend.', ['backend', 'error'])
+BACKEND_RETRIES = Counter(
+    'gandhi_ai_backend_retries_total', 'Backend calls retried after a transient error.', ['backend'])
+CIRCUIT_BREAKER_OPEN = Gauge(
+    'gandhi_ai_circuit_breaker_open', 'Whether the circuit breaker of a backend is open.', ['backend'],
+    multiprocess_mode='max')
+CIRCUIT_BREAKER_REJECTIONS = Counter(
+    'gandhi_ai_circuit_breaker_rejections_total', 'Backend calls failed fast by an open circuit.', ['backend'])
+LLM_TOKENS = Counter(
+    'gandhi_ai_llm_tokens_total', 'Tokens of the LLM calls, as reported by the backend.', ['backend', 'kind'])
+
+_request_timing = contextvars.ContextVar('gandhi_ai_request_timing', default=None)
+
+
+class CacheStatsCollector:
+    """Export the hit counters the caches and schedulers already keep, read when the metrics are scraped.
+
+    ``labels`` are added to every metric, e.g. the pid of the worker serving
+    the scrape in multiprocess mode.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+
+    def get_metric_family(self, family_class, name, documentation, labels):
+        return family_class(name, documentation, labels=labels + list(self.labels))
+
+    def add_metric(self, metric_family, labels, value):
+        metric_family.add_metric(labels + list(self.labels.values()), value)
+
+    def collect(self):
+        lookups = self.get_metric_family(
+            CounterMetricFamily, 'gandhi_ai_cache_lookups', 'Cache lookups of this process.',
+            ['cache', 'layer', 'result'])
+        hit_ratio = self.get_metric_family(
+            GaugeMetricFamily, 'gandhi_ai_cache_hit_ratio', 'Share of the cache lookups of this process that hit.',
+            ['cache', 'layer'])
+        entries = self.get_metric_family(
+            GaugeMetricFamily, 'gandhi_ai_cache_entries', 'Entries of an in-process cache.', ['cache'])
+
+        for stats in (QUERY_EMBEDDING_CACHE.stats(), SECTION_CACHE.stats(), SEMANTIC_ANSWER_CACHE.stats()):
+            self.add_metric(lookups, [stats['name'], 'local', 'hit'], stats['hits'])
+            self.add_metric(lookups, [stats['name'], 'local', 'miss'], stats['misses'])
+            self.add_metric(hit_ratio, [stats['name'], 'local'], stats['hit_ratio'])
+            self.add_metric(entries, [stats['name']], stats['entries'])
+
+        for name, stats in get_redis_cache_stats().items():
+            self.add_metric(lookups, [name, 'redis', 'hit'], stats['hits'])
+            self.add_metric(lookups, [name, 'redis', 'miss'], stats['misses'])
+            total = stats['hits'] + stats['misses']
+            self.add_metric(hit_ratio, [name, 'redis'], stats['hits'] / total if total else 0.0)
+
+        queue_depth = self.get_metric_family(
+            GaugeMetricFamily, 'gandhi_ai_scheduler_queue_depth', 'LLM calls waiting for a scheduler slot.',
+            ['backend'])
+        in_flight = self.get_metric_family(
+            GaugeMetricFamily, 'gandhi_ai_scheduler_in_flight', 'LLM calls running on a scheduler.', ['backend'])
+        rejected = self.get_metric_family(
+            CounterMetricFamily, 'gandhi_ai_scheduler_rejected', 'LLM calls rejected by a full scheduler queue.',
+            ['backend'])
+        for stats in get_scheduler_stats():
+            self.add_metric(queue_depth, [stats['name']], stats['queue_depth'])
+            self.add_metric(in_flight, [stats['name']], stats['in_flight'])
+            self.add_metric(rejected, [stats['name']], stats['rejected'])
+
+        return [lookups, hit_ratio, entries, queue_depth, in_flight, rejected]
+
+
+def get_metrics_registry():
+    """The registry to expose, aggregating every worker when prometheus multiprocess mode is configured."""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        # The cache and scheduler stats live in the memory of each worker, so
+        # only those of the worker serving the scrape can be exported.
+        registry.register(CacheStatsCollector({'pid': str(os.getpid())}))
+        return registry
+    return REGISTRY
+
+
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    # In multiprocess mode the registry built for every scrape exports them instead.
+    REGISTRY.register(CacheStatsCollector())
+
+
+def start_request_timing(**fields):
+    """Start collecting the stage timings of the current request, returning them for ``log_request_timing``."""
+    timing = dict(fields, stages={}, start_time=time.perf_counter())
+    _request_timing.set(timing)
+    return timing
+
+
+def record_stage(stage, duration):
+    STAGE_DURATION.labels(stage).observe(duration)
+    timing = _request_timing.get()
+    if timing is not None:
+        timing['stages'][stage] = timing['stages'].get(stage, 0.0) + duration
+
+
+@contextlib.contextmanager
+def track_stage(stage):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start_time)
+
+
+def set_request_timing_field(name, value):
+    timing = _request_timing.get()
+    if timing is not None:
+        timing[name] = value
+
+
+def log_request_timing(timing, outcome):
+    duration = time.perf_counter() - timing['start_time']
+    REQUEST_DURATION.labels(outcome).observe(duration)
+    if not settings.REQUEST_TIMING_LOG:
+        return
+
+    record = {key: value for key, value in timing.items() if key != 'start_time'}
+    record.update(outcome=outcome, duration=round(duration, 4),
+                  stages={stage: round(seconds, 4) for stage, seconds in timing['stages'].items()})
+    logger.info("Request timing: %s", json.dumps(record))
+
+
+def count_backend_error(backend, error):
+    BACKEND_ERRORS.labels(backend, type(error).__name__).inc()
+
+
+def track_backend_call(backend):
+    """Count the calls of a backend client function in flight, their duration and failures."""
+    def decorator(func):
+        @contextlib.contextmanager
+        def tracked_call():
+            start_time = time.perf_counter()
+            with BACKEND_CALLS_IN_FLIGHT.labels(backend).track_inprogress():
+                try:
+                    yield
+                except Exception as e:
+                    count_backend_error(backend, e)
+                    raise
+                finally:
+                    BACKEND_CALL_DURATION.labels(backend).observe(time.perf_counter() - start_time)
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tracked_call():
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracked_call():
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_llm_tokens(backend, prompt_tokens, completion_tokens):
+    LLM_TOKENS.labels(backend, 'prompt').inc(prompt_tokens or 0)
+    LLM_TOKENS.labels(backend, 'completion').inc(completion_tokens or 0)
@@ -0,0 +1,232 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextlib
+import contextvars
+
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+from django.conf import settings
+
+from .metrics import BACKEND_RETRIES, CIRCUIT_BREAKER_REJECTIONS, CIRCUIT_BREAKER_OPEN
+
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_BOTOCORE_ERROR_CODES = frozenset((
+    'ThrottlingException', 'Throttling', 'TooManyRequestsException', 'ServiceUnavailableException',
+    'ServiceUnavailable', 'InternalServerException', 'InternalFailure', 'ModelNotReadyException',
+    'ModelTimeoutException', 'RequestTimeout', 'RequestTimeoutException',
+))
+
+RETRYABLE_HTTP_STATUS_CODES = frozenset((408, 429, 500, 502, 503, 504))
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+_deadline = contextvars.ContextVar('gandhi_ai_deadline', default=None)
+
+
+@contextlib.contextmanager
+def request_deadline(seconds):
+    """Give the backend calls made in this context, including on executor threads, ``seconds`` in total."""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def get_remaining_time():
+    """Seconds left until the deadline of the current request, or None without one."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def is_retryable_error(error):
+    """Throttling, server-side and connection errors are retried, anything else is the caller's to handle."""
+    if isinstance(error, ClientError):
+        response = error.response
+        return (response.get('Error', {}).get('Code') in RETRYABLE_BOTOCORE_ERROR_CODES
+                or response.get('ResponseMetadata', {}).get('HTTPStatusCode') in RETRYABLE_HTTP_STATUS_CODES)
+    if isinstance(error, (BotocoreConnectionError, HTTPClientError, ConnectionError, TimeoutError)):
+        return True
+
+    # Only Gemini raises google api_core errors, which are not worth importing before it was used.
+    google_exceptions = sys.modules.get('google.api_core.exceptions')
+    if google_exceptions is not None and isinstance(error, google_exceptions.GoogleAPICallError):
+        return error.code in RETRYABLE_HTTP_STATUS_CODES
+    return False
+
+
+class CircuitBreaker:
+    """Fail calls to a backend fast after ``failure_threshold`` consecutive transient failures.
+
+    Once open, calls are rejected with ``CircuitOpenError`` for ``reset_timeout``
+    seconds. Then a single trial call is let through, closing the circuit again
+    when it succeeds and re-opening it when it fails. A ``failure_threshold``
+    of None never opens the circuit.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at >= self.reset_timeout and not self._trial_running:
+                self._trial_running = True
+                return
+        CIRCUIT_BREAKER_REJECTIONS.labels(self.name).inc()
+        raise CircuitOpenError("{0} circuit is open after {1} consecutive failures".format(self.name, self._failures))
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("%s circuit closed", self.name)
+                CIRCUIT_BREAKER_OPEN.labels(self.name).set(0)
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or (self._opened_at is None and self.failure_threshold is not None
+                                       and self._failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    logger.warning("%s circuit opened after %d consecutive failures", self.name, self._failures)
+                    CIRCUIT_BREAKER_OPEN.labels(self.name).set(1)
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def record_ignored(self):
+        # Errors caused by the request itself say nothing about the backend, but end a trial call.
+        with self._lock:
+            self._trial_running = False
+
+
+_CIRCUIT_BREAKERS = {}
+_CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+
+def _reset_circuit_breakers_after_fork():
+    global _CIRCUIT_BREAKERS_LOCK
+    _CIRCUIT_BREAKERS.clear()
+    _CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_circuit_breakers_after_fork)
+
+
+def get_circuit_breaker(backend):
+    """Return the process-wide circuit breaker for a backend listed in ``settings.BACKEND_RESILIENCE``."""
+    with _CIRCUIT_BREAKERS_LOCK:
+        if backend not in _CIRCUIT_BREAKERS:
+            config = settings.BACKEND_RESILIENCE[backend]
+            _CIRCUIT_BREAKERS[backend] = CircuitBreaker(backend, config['failure_threshold'], config['reset_timeout'])
+        return _CIRCUIT_BREAKERS[backend]
+
+
+def get_retry_delay(backend, attempt, error):
+    """Seconds to wait before retrying after a failed ``attempt``, or raise ``error`` when it must not be retried.
+
+    Delays grow exponentially with full jitter, so that workers throttled at
+    the same moment do not retry in lockstep, and are never longer than the
+    time left until the request deadline.
+    """
+    config = settings.BACKEND_RESILIENCE[backend]
+    if attempt >= config['max_attempts'] or not is_retryable_error(error):
+        raise error
+
+    delay = random.uniform(0, min(config['max_delay'], config['base_delay'] * 2 ** (attempt - 1)))
+    remaining_time = get_remaining_time()
+    if remaining_time is not None and remaining_time <= delay:
+        raise error
+
+    BACKEND_RETRIES.labels(backend).inc()
+    logger.warning("%s call failed with %r, retrying in %.2fs (attempt %d of %d)",
+                   backend, error, delay, attempt + 1, config['max_attempts'])
+    return delay
+
+
+def is_deadline_exceeded():
+    remaining_time = get_remaining_time()
+    return remaining_time is not None and remaining_time <= 0
+
+
+def check_deadline(backend):
+    if is_deadline_exceeded():
+        raise DeadlineExceeded("No time left to call {0}".format(backend))
+
+
+def call_with_retry(backend, func, *args, **kwargs):
+    """Call a blocking backend function through its circuit breaker, retrying transient errors."""
+    circuit_breaker = get_circuit_breaker(backend)
+    attempt = 0
+    while True:
+        attempt += 1
+        check_deadline(backend)
+        circuit_breaker.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_retryable_error(e):
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_ignored()
+            time.sleep(get_retry_delay(backend, attempt, e))
+        except BaseException:
+            circuit_breaker.record_ignored()
+            raise
+        else:
+            circuit_breaker.record_success()
+            return result
+
+
+async def call_with_retry_async(backend, func, *args, **kwargs):
+    """Await a backend coroutine function like ``call_with_retry``, without blocking a thread between attempts."""
+    circuit_breaker = get_circuit_breaker(backend)
+    attempt = 0
+    while True:
+        attempt += 1
+        check_deadline(backend)
+        circuit_breaker.before_call()
+        try:
+            # An attempt still running at the deadline is abandoned with a TimeoutError.
+            result = await asyncio.wait_for(func(*args, **kwargs), get_remaining_time())
+        except Exception as e:
+            if isinstance(e, TimeoutError) and is_deadline_exceeded():
+                # Running out of time, e.g. after queueing for a slot, says nothing about the backend.
+                circuit_breaker.record_ignored()
+                raise DeadlineExceeded("{0} call did not finish before the deadline".format(backend)) from e
+            if is_retryable_error(e):
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_ignored()
+            await asyncio.sleep(get_retry_delay(backend, attempt, e))
+        except BaseException:
+            circuit_breaker.record_ignored()
+            raise
+        else:
+            circuit_breaker.record_success()
+            return result
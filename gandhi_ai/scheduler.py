@@ -0,0 +1,218 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import functools
+import contextlib
+import contextvars
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerQueueFull(Exception):
+    pass
+
+
+class _Waiter:
+    """A call queued for a slot, woken on its own event loop once the slot was handed to it."""
+
+    def __init__(self, loop, queued):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.queued = queued
+        self.granted = False
+        self.submitted_at = time.monotonic()
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class BackendScheduler:
+    """Process-wide, long-lived executor for the calls made to one LLM backend.
+
+    At most ``max_concurrency`` calls run at once across all requests of the
+    process. Calls waiting for a free slot are queued and get it in the order
+    they arrived; once ``max_queue_size`` calls are waiting, new callers wait up
+    to ``queue_timeout`` seconds for room and then fail with ``SchedulerQueueFull``.
+
+    Coroutines hold a slot on the event loop with ``slot`` or ``call``, blocking
+    calls are run on the scheduler's threads with ``run``. Waiting never polls: a freed
+    slot is handed to the next waiter, which is woken on its own event loop.
+    """
+
+    def __init__(self, name, max_concurrency, max_queue_size, queue_timeout):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout
+
+        # A cancelled run() does not stop its thread, so the threads also bound the calls actually running.
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix='gandhi-ai-{0}'.format(name))
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()
+        self._queue_depth = 0
+        self._max_queue_depth = 0
+        self._in_flight = 0
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def _start(self, submitted_at):
+        wait_time = time.monotonic() - submitted_at
+        self._total_wait_time += wait_time
+        self._max_wait_time = max(self._max_wait_time, wait_time)
+
+    def _remove_waiter(self, waiter):
+        # The first waiter beyond the queue takes the place in it.
+        self._waiters.remove(waiter)
+        if waiter.queued:
+            self._queue_depth -= 1
+            if len(self._waiters) > self._queue_depth:
+                self._waiters[self._queue_depth].queued = True
+                self._queue_depth += 1
+                self._max_queue_depth = max(self._max_queue_depth, self._queue_depth)
+
+    def _release(self):
+        self._completed += 1
+        while self._waiters:
+            waiter = self._waiters[0]
+            self._remove_waiter(waiter)
+            try:
+                waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+            except RuntimeError:
+                continue  # Its event loop was closed.
+            waiter.granted = True
+            self._start(waiter.submitted_at)
+            return
+        self._in_flight -= 1
+
+    async def acquire(self, timeout=None):
+        """Wait for a slot, failing with a ``TimeoutError`` after ``timeout`` seconds."""
+        with self._lock:
+            self._submitted += 1
+            if not self._waiters and self._in_flight < self.max_concurrency:
+                self._in_flight += 1
+                self._start(time.monotonic())
+                return
+
+            waiter = _Waiter(asyncio.get_running_loop(), self._queue_depth < self.max_queue_size)
+            self._waiters.append(waiter)
+            if waiter.queued:
+                self._queue_depth += 1
+                self._max_queue_depth = max(self._max_queue_depth, self._queue_depth)
+
+        slot_deadline = waiter.submitted_at + timeout if timeout is not None else None
+        queue_deadline = waiter.submitted_at + self.queue_timeout
+        try:
+            while True:
+                with self._lock:
+                    if waiter.granted:
+                        return
+                    if not waiter.queued and time.monotonic() >= queue_deadline:
+                        self._remove_waiter(waiter)
+                        self._rejected += 1
+                        raise SchedulerQueueFull(
+                            "{0} scheduler queue is full ({1} calls waiting)".format(self.name, self._queue_depth))
+                    if slot_deadline is not None and time.monotonic() >= slot_deadline:
+                        self._remove_waiter(waiter)
+                        raise TimeoutError(
+                            "No {0} scheduler slot became free in {1:.2f}s".format(self.name, timeout))
+                    deadline = slot_deadline if waiter.queued else min(
+                        queue_deadline, slot_deadline if slot_deadline is not None else queue_deadline)
+
+                await asyncio.wait([waiter.future], timeout=None if deadline is None else deadline - time.monotonic())
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    self._release()
+                else:
+                    self._remove_waiter(waiter)
+            raise
+
+    def release(self):
+        with self._lock:
+            self._release()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, timeout=None):
+        """Hold a slot for as long as the context runs, e.g. while an async response is streamed.
+
+        Waiting for a free slot does not block the event loop and fails with a
+        ``TimeoutError`` after ``timeout`` seconds.
+        """
+        await self.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def call(self, func, *args, **kwargs):
+        """Await a coroutine function once it got a slot."""
+        async with self.slot():
+            return await func(*args, **kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking call on the scheduler's threads once it got a slot."""
+        async with self.slot():
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(contextvars.copy_context().run, func, *args, **kwargs))
+
+    def stats(self):
+        with self._lock:
+            started = self._completed + self._in_flight
+            return {
+                'name': self.name,
+                'max_concurrency': self.max_concurrency,
+                'queue_depth': self._queue_depth,
+                'max_queue_depth': self._max_queue_depth,
+                'in_flight': self._in_flight,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'avg_wait_time': self._total_wait_time / started if started else 0.0,
+                'max_wait_time': self._max_wait_time,
+            }
+
+
+_SCHEDULERS = {}
+_SCHEDULERS_LOCK = threading.Lock()
+
+
+def _reset_schedulers_after_fork():
+    # Executor threads do not survive a fork, so forked workers build their own schedulers.
+    global _SCHEDULERS_LOCK
+    _SCHEDULERS.clear()
+    _SCHEDULERS_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_schedulers_after_fork)
+
+
+def get_scheduler(name):
+    """Return the shared scheduler for a backend listed in ``settings.LLM_SCHEDULERS``."""
+    with _SCHEDULERS_LOCK:
+        if name not in _SCHEDULERS:
+            _SCHEDULERS[name] = BackendScheduler(name, **settings.LLM_SCHEDULERS[name])
+        return _SCHEDULERS[name]
+
+
+def get_scheduler_stats():
+    with _SCHEDULERS_LOCK:
+        schedulers = list(_SCHEDULERS.values())
+    return [scheduler.stats() for scheduler in schedulers]
+
+
+def log_scheduler_stats():
+    for stats in get_scheduler_stats():
+        logger.info("LLM scheduler stats: %s", stats)
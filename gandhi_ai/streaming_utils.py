@@ -7,6 +7,9 @@ from django.conf import settings
 
 
 from .gandhi_ai_rag import get_gandhi_ai_rag_response
+from .resilience import request_deadline
+from .metrics import (start_request_timing, log_request_timing, set_request_timing_field, REQUESTS_IN_FLIGHT,
+                      REQUEST_ERRORS, TIME_TO_FIRST_TOKEN)
 
 def stream_response_to_bytes(response):
     if response:
@@ -34,7 +37,9 @@ def convert_finish_reason(finish_reason):
             "max_tokens": "length",
             "stop_sequence": "stop",
             "complete": "stop",
-            "content_filtered": "content_filter"
+            "content_filtered": "content_filter",
+            "safety": "content_filter",
+            "recitation": "content_filter"
         }
         return finish_reason_mapping.get(finish_reason.lower(), finish_reason.lower())
     return None
@@ -114,7 +119,7 @@ def create_response_stream(model_id, message_id, chunk):
                     'total_tokens': metadata["usage"]["totalTokens"],
                 },
             }
-    if message:
+    if message is not None:
         return {
             'id': message_id,
             'model': model_id,
@@ -132,49 +137,79 @@ def create_response_stream(model_id, message_id, chunk):
     return None
 
 
-def streamed_response(request):
+ERROR_RESPONSE_STREAM = [
+    {'messageStart': {'role': 'assistant'}},
+    {'contentBlockDelta': {'delta': {'text': 'An '}, 'contentBlockIndex': 0}},
+    {'contentBlockDelta': {'delta': {'text': 'issue '}, 'contentBlockIndex': 1}},
+    {'contentBlockDelta': {'delta': {'text': 'occurred '}, 'contentBlockIndex': 2}},
+    {'contentBlockDelta': {'delta': {'text': 'while '}, 'contentBlockIndex': 3}},
+    {'contentBlockDelta': {'delta': {'text': 'generating '}, 'contentBlockIndex': 4}},
+    {'contentBlockDelta': {'delta': {'text': 'the '}, 'contentBlockIndex': 5}},
+    {'contentBlockDelta': {'delta': {'text': 'response, '}, 'contentBlockIndex': 6}},
+    {'contentBlockDelta': {'delta': {'text': 'Please '}, 'contentBlockIndex': 7}},
+    {'contentBlockDelta': {'delta': {'text': 'ask a '}, 'contentBlockIndex': 8}},
+    {'contentBlockDelta': {'delta': {'text': 'different '}, 'contentBlockIndex': 9}},
+    {'contentBlockDelta': {'delta': {'text': 'question.'}, 'contentBlockIndex': 10}},
+    {'contentBlockStop': {'contentBlockIndex': 11}},
+    {'messageStop': {'stopReason': 'end_turn'}},
+    {'metadata': {'usage': {'inputTokens': 100, 'outputTokens': 20, 'totalTokens': 120}, 'metrics': {'latencyMs': 0}}}
+]
+
+
+async def error_response_stream():
+    for chunk in ERROR_RESPONSE_STREAM:
+        yield chunk
+
+
+async def streamed_response(request_data):
+    timing = start_request_timing(request_id=str(uuid.uuid4())[:8], retrieval_mode=settings.RETRIEVAL_MODE)
+    outcome = 'ok'
+    first_token = True
+    REQUESTS_IN_FLIGHT.inc()
 
     try:
-        response = get_gandhi_ai_rag_response(request)
+        try:
+            with request_deadline(settings.REQUEST_DEADLINE):
+                response = await get_gandhi_ai_rag_response(request_data)
+        except Exception as e:
+            traceback.print_exc()
+            outcome = 'error'
+            REQUEST_ERRORS.labels('response').inc()
+            response = {
+                'stream': error_response_stream()
+            }
+
+        async for chunk in response['stream']:
+            stream_response = create_response_stream(request_data['model'], "chatcmpl-" + str(uuid.uuid4())[:8], chunk)
+            if not stream_response:
+                continue
+            if settings.DEBUG:
+                # print("Proxy response :" + json.dumps(stream_response))
+                pass
+            if stream_response.get('choices'):
+                if first_token and stream_response['choices'][0]['delta'].get('content'):
+                    first_token = False
+                    time_to_first_token = time.perf_counter() - timing['start_time']
+                    TIME_TO_FIRST_TOKEN.observe(time_to_first_token)
+                    set_request_timing_field('time_to_first_token', round(time_to_first_token, 4))
+                yield stream_response_to_bytes(stream_response)
+            elif request_data.get('stream_options') and request_data['stream_options'].get('include_usage'):
+                # An empty choices for Usage as per OpenAI doc below:
+                # if you set stream_options: {"include_usage": true}.
+                # an additional chunk will be streamed before the data: [DONE] message.
+                # The usage field on this chunk shows the token usage statistics for the entire request,
+                # and the choices field will always be an empty array.
+                # All other chunks will also include a usage field, but with a null value.
+                yield stream_response_to_bytes(stream_response)
     except Exception as e:
+        # The answer is generated while it is being streamed, so a failure
+        # can only be reported by ending the stream early.
         traceback.print_exc()
-        response = {
-            'stream': [
-                {'messageStart': {'role': 'assistant'}},
-                {'contentBlockDelta': {'delta': {'text': 'An '}, 'contentBlockIndex': 0}},
-                {'contentBlockDelta': {'delta': {'text': 'issue '}, 'contentBlockIndex': 1}},
-                {'contentBlockDelta': {'delta': {'text': 'occurred '}, 'contentBlockIndex': 2}},
-                {'contentBlockDelta': {'delta': {'text': 'while '}, 'contentBlockIndex': 3}},
-                {'contentBlockDelta': {'delta': {'text': 'generating '}, 'contentBlockIndex': 4}},
-                {'contentBlockDelta': {'delta': {'text': 'the '}, 'contentBlockIndex': 5}},
-                {'contentBlockDelta': {'delta': {'text': 'response, '}, 'contentBlockIndex': 6}},
-                {'contentBlockDelta': {'delta': {'text': 'Please '}, 'contentBlockIndex': 7}},
-                {'contentBlockDelta': {'delta': {'text': 'ask a '}, 'contentBlockIndex': 8}},
-                {'contentBlockDelta': {'delta': {'text': 'different '}, 'contentBlockIndex': 9}},
-                {'contentBlockDelta': {'delta': {'text': 'question.'}, 'contentBlockIndex': 10}},
-                {'contentBlockStop': {'contentBlockIndex': 11}},
-                {'messageStop': {'stopReason': 'end_turn'}},
-                {'metadata': {'usage': {'inputTokens': 100, 'outputTokens': 20, 'totalTokens': 120}, 'metrics': {'latencyMs': 0}}}
-            ]
-        }
-
-    for chunk in response['stream']:
-        stream_response = create_response_stream(request.data['model'], "chatcmpl-" + str(uuid.uuid4())[:8], chunk)
-        if not stream_response:
-            continue
-        if settings.DEBUG:
-            # print("Proxy response :" + json.dumps(stream_response))
-            pass
-        if stream_response.get('choices'):
-            yield stream_response_to_bytes(stream_response)
-        elif request.data.get('stream_options') and request.data['stream_options'].get('include_usage'):
-            # An empty choices for Usage as per OpenAI doc below:
-            # if you set stream_options: {"include_usage": true}.
-            # an additional chunk will be streamed before the data: [DONE] message.
-            # The usage field on this chunk shows the token usage statistics for the entire request,
-            # and the choices field will always be an empty array.
-            # All other chunks will also include a usage field, but with a null value.
-            yield stream_response_to_bytes(stream_response)
+        outcome = 'stream_error'
+        REQUEST_ERRORS.labels('stream').inc()
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        log_request_timing(timing, outcome)
 
     # return an [DONE] message at the end.
     yield stream_response_to_bytes(None)
\ No newline at end of file
@@ -1,3 +1,727 @@
-from django.test import TestCase
+import os
+import sys
+import time
+import hashlib
+import shutil
+import asyncio
+import tempfile
+import numpy as np
+import docx
 
-# Create your tests here.
+from unittest import mock
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from django.test import SimpleTestCase, override_settings
+
+from gandhi_ai import legacy_parsing, resilience
+from gandhi_ai.management.commands import load_sections_from_cwog
+from gandhi_ai.scheduler import BackendScheduler, SchedulerQueueFull
+from gandhi_ai import caches
+from gandhi_ai.caches import (LRUCache, SemanticAnswerCache, normalize_query_text, get_cached_query_embeddings,
+                              cache_query_embeddings, get_map_answer_cache_key, get_cached_map_answers,
+                              cache_map_answers, encode_section, decode_section, get_sections)
+from gandhi_ai.resilience import (CircuitBreaker, CircuitOpenError, DeadlineExceeded, call_with_retry_async,
+                                  check_deadline, get_retry_delay, is_retryable_error, request_deadline)
+from gandhi_ai.context_packing import pack_context
+from gandhi_ai.gandhi_ai_rag import get_relevant_sections_with_metadata, get_ranked_chunks, embed_query_for_retrieval, retrieve_relevant_chunks
+from gandhi_ai.lexical_index import build_lexical_index, LexicalIndex, reciprocal_rank_fusion
+from gandhi_ai.vector_index import build_vector_index, VectorIndex
+from gandhi_ai.chunk_index import CurrentIndex
+from gandhi_ai.utils import (split_file_content_into_sections, iter_file_content_sections, get_chunk_id,
+                             iter_cleaned_sections, read_word_file_with_iterparse, read_word_file_with_python_docx)
+
+
+SAMPLE_VOLUME = (
+    "PREFACE\nThe volumes are arranged chronologically.\n"
+    "\n1. LETTER TO DADABHAI NAOROJI\nDURBAN,\nJuly 5, 1894\nDear sir, the Indians here are in need.\n"
+    "\n2. PETITION TO LORD RIPON\n\n3. ADDRESS TO THE NATAL LEGISLATIVE ASSEMBLY\n"
+    "The petitioners respectfully beg to submit.\n"
+    "\nCHAPTER IV\nThe chapter begins here.\n"
+    "\n4. SPEECH AT BOMBAY\nCHAPTER V\nFriends, I thank you.\n"
+    "\n1. SPEECH AT WORKING COMMITTEE MEETING, WARDHA\nThe committee met today.\n"
+    "\nAPPENDIX I\nNotes on the appendix.\n"
+    "\n5. LETTER TO MAGANLAL GANDHI\nMy dear Maganlal, I got your letter.\n"
+)
+
+
+class SectionSplitterTests(SimpleTestCase):
+
+    def test_matches_recursive_split(self):
+        self.assertEqual(
+            split_file_content_into_sections(SAMPLE_VOLUME),
+            legacy_parsing.split_file_content_into_sections(SAMPLE_VOLUME)
+        )
+
+    def test_sections_cover_the_whole_volume(self):
+        self.assertEqual("".join(iter_file_content_sections(SAMPLE_VOLUME)), SAMPLE_VOLUME)
+
+    def test_odd_number_of_pieces(self):
+        content = "\n1. LETTER TO DADABHAI NAOROJI\nDear sir.\n\n2. PETITION TO LORD RIPON\n"
+        with self.assertRaises(IndexError):
+            legacy_parsing.split_file_content_into_sections(content)
+
+        self.assertEqual(
+            split_file_content_into_sections(content),
+            ["\n1. LETTER TO DADABHAI NAOROJI\nDear sir.", "\n\n2. PETITION TO LORD RIPON\n"]
+        )
+
+
+# Sections with each kind of page footer, several footers in one section and sections without any.
+SAMPLE_FOOTER_SECTIONS = [
+    "\n1. LETTER TO DADABHAI NAOROJI\nDear sir,\n\nVOL. 1 : 1884 - 30 NOVEMBER, 1896\t45\n\nthe Indians.",
+    "\n2. PETITION TO LORD RIPON\nThe petitioners.",
+    "\n3. ADDRESS\nFirst page.\n47 THE COLLECTED WORKS OF MAHATMA GANDHI\nSecond page.\n"
+    "46\tTHE COLLECTED WORKS OF MAHATMA GANDNI\n\nThird.",
+    "\n4. SPEECH AT BOMBAY\nFriends.\nVOL. 2 : 1 DECEMBER, 1896 - 31 DECEMBER, 1897\t9\n",
+    "\n5. LETTER TO MAGANLAL GANDHI\nMy dear Maganlal.\n",
+    "\n6. NOTES\nThe last section.",
+]
+
+
+class SectionCleaningTests(SimpleTestCase):
+
+    def test_matches_legacy_cleaning(self):
+        pages, cleaned_sections = legacy_parsing.clean_the_split_sections(SAMPLE_FOOTER_SECTIONS)
+        self.assertEqual(list(iter_cleaned_sections(iter(SAMPLE_FOOTER_SECTIONS))),
+                         list(zip(pages, cleaned_sections)))
+
+    def test_pages(self):
+        self.assertEqual([page for page, cleaned_section in iter_cleaned_sections(SAMPLE_FOOTER_SECTIONS)],
+                         [45, 46, 46, 9, None, None])
+
+    def test_footers_are_removed(self):
+        for page, cleaned_section in iter_cleaned_sections(SAMPLE_FOOTER_SECTIONS):
+            self.assertNotIn("VOL.", cleaned_section)
+            self.assertNotIn("COLLECTED WORKS", cleaned_section)
+        self.assertEqual(next(iter_cleaned_sections(SAMPLE_FOOTER_SECTIONS[2:]))[1],
+                         "\n3. ADDRESS\nFirst page.Second page.Third.")
+
+
+class WordFileTests(SimpleTestCase):
+
+    def write_document(self):
+        document = docx.Document()
+        document.add_paragraph("THE COLLECTED WORKS OF MAHATMA GANDHI", style='Title')
+        document.add_paragraph("LETTER TO DADABHAI NAOROJI", style='Heading 1')
+        paragraph = document.add_paragraph("DURBAN,")
+        paragraph.add_run().add_break()
+        paragraph.add_run("July 5, 1894\tDear sir.")
+        document.add_paragraph("1. SPEECH AT WORKING COMMITTEE MEETING", style='Heading 2')
+        document.add_paragraph("VOL. 1 : 1884 - 30 NOVEMBER, 1896\t45")
+
+        # A paragraph style id naming a character style falls back to the default paragraph style.
+        paragraph = document.add_paragraph("PETITION TO LORD RIPON", style='Heading 1')
+        paragraph._p.pPr.pStyle.val = 'Strong'
+
+        # Paragraphs of tables are not part of the text.
+        table = document.add_table(rows=1, cols=2)
+        table.cell(0, 0).text = "In a table"
+        table.cell(0, 1).add_paragraph("ADDRESS", style='Heading 1')
+
+        document.add_paragraph("")
+        document.add_paragraph("APPENDIX I", style='Heading 3')
+
+        document_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, document_dir)
+        file_path = os.path.join(document_dir, "mahatma-gandhi-collected-works-volume-1.docx")
+        document.save(file_path)
+        return file_path
+
+    def test_matches_python_docx(self):
+        file_path = self.write_document()
+        content = read_word_file_with_iterparse(file_path)
+        self.assertEqual(content, read_word_file_with_python_docx(file_path))
+        self.assertIn("\n2. LETTER TO DADABHAI NAOROJI\n", content)
+        self.assertIn("DURBAN,\nJuly 5, 1894\tDear sir.", content)
+        self.assertNotIn("In a table", content)
+        self.assertNotIn("ADDRESS", content)
+
+
+# Six paragraphs that split_section makes one 552 character chunk each.
+SAMPLE_PARAGRAPHS = ["Paragraph {0}. ".format(i) + "word{0} ".format(i) * 90 for i in range(6)]
+SAMPLE_SECTION = "\n\n".join(SAMPLE_PARAGRAPHS)
+
+
+# Token counts are character counts, so that budgets do not depend on the tokenizer.
+@mock.patch('gandhi_ai.context_packing.count_tokens', len)
+class PackContextTests(SimpleTestCase):
+
+    def test_grows_around_the_best_chunk(self):
+        packed_context = pack_context([('a', 3)], {'a': SAMPLE_SECTION}, 552 * 3)
+        self.assertEqual(packed_context, [('a', "\n\n".join(SAMPLE_PARAGRAPHS[2:5]).strip())])
+
+    def test_skips_neighbours_over_budget(self):
+        packed_context = pack_context([('a', 3)], {'a': SAMPLE_SECTION}, 552 * 2)
+        self.assertEqual(packed_context, [('a', "\n\n".join(SAMPLE_PARAGRAPHS[2:4]).strip())])
+
+        packed_context = pack_context([('a', 3)], {'a': SAMPLE_SECTION}, 552 * 2 - 1)
+        self.assertEqual(packed_context, [('a', SAMPLE_PARAGRAPHS[3].strip())])
+
+    def test_stops_counting_once_no_chunk_fits(self):
+        sections = {'a': SAMPLE_SECTION, 'b': SAMPLE_SECTION.replace("word", "term")}
+        with mock.patch('gandhi_ai.context_packing.count_tokens', side_effect=len) as count_tokens:
+            packed_context = pack_context([('a', 0), ('b', 0)], sections, 552 * 2 + 100)
+        self.assertEqual([section_key for section_key, text in packed_context], ['a', 'b'])
+        # Both chunks were counted, none of their neighbours.
+        self.assertEqual(count_tokens.call_count, 2)
+
+    def test_takes_every_chunk_before_neighbours(self):
+        other_paragraphs = [paragraph.replace("word", "term") for paragraph in SAMPLE_PARAGRAPHS]
+        sections = {'a': SAMPLE_SECTION, 'b': "\n\n".join(other_paragraphs)}
+        packed_context = pack_context([('b', 0), ('a', 5)], sections, 552 * 3)
+        self.assertEqual(packed_context, [
+            ('b', "\n\n".join(other_paragraphs[:2]).strip()),
+            ('a', SAMPLE_PARAGRAPHS[5].strip()),
+        ])
+
+    def test_joins_distant_chunks_of_a_section(self):
+        packed_context = pack_context([('a', 0), ('a', 5), ('missing', 0)], {'a': SAMPLE_SECTION}, 552 * 2)
+        self.assertEqual(packed_context, [
+            ('a', SAMPLE_PARAGRAPHS[0].strip() + " ... " + SAMPLE_PARAGRAPHS[5].strip())])
+
+
+@override_settings(CWOG_CACHE_KEY_FORMAT="vol:{vol}-section:{section}")
+class RankedChunksTests(SimpleTestCase):
+
+    def get_chunks(self, ids, documents=None):
+        chunks = {
+            'ids': [ids],
+            'metadatas': [[{'source': "vol-1", 'volume': 1, 'section': 2} for chunk_id in ids]],
+        }
+        if documents is not None:
+            chunks['documents'] = [documents]
+        return chunks
+
+    def test_offsets_from_chunk_ids(self):
+        chunk_id = get_chunk_id(1, 2, 4, SAMPLE_PARAGRAPHS[4].strip())
+        self.assertEqual(
+            get_ranked_chunks(self.get_chunks([chunk_id]), {"vol:1-section:2": SAMPLE_SECTION}),
+            [("vol:1-section:2", 4)])
+
+    def test_locates_chunks_of_other_ids_by_their_text(self):
+        chunks = self.get_chunks(["a3c0e2b4-uuid"], [SAMPLE_PARAGRAPHS[3].strip()])
+        self.assertEqual(get_ranked_chunks(chunks, {"vol:1-section:2": SAMPLE_SECTION}), [("vol:1-section:2", 3)])
+
+    def test_unlocatable_chunks(self):
+        sections = {"vol:1-section:2": SAMPLE_SECTION}
+        self.assertIsNone(get_ranked_chunks(self.get_chunks(["a3c0e2b4-uuid"]), sections))
+        self.assertIsNone(get_ranked_chunks(self.get_chunks(["a3c0e2b4-uuid"], [None]), sections))
+
+
+@override_settings(CWOG_CACHE_KEY_FORMAT="vol:{vol}-section:{section}",
+                   CWOG_SECTION_META_KEY_FORMAT="vol:{vol}-section:{section}-meta")
+class RelevantSectionsTests(SimpleTestCase):
+
+    def test_meta_keys_only_fetched_for_chunks_without_titles(self):
+        metadatas = [
+            {'source': "vol-1", 'volume': 1, 'section': 2, 'page': 5, 'title': "LETTER TO DADABHAI NAOROJI"},
+            {'source': "vol-1", 'volume': 1, 'section': 3, 'page': 6},
+            {'source': "vol-1", 'volume': 1, 'section': 2, 'page': 5, 'title': "LETTER TO DADABHAI NAOROJI"},
+        ]
+        sections = {
+            "vol:1-section:2": "1. LETTER TO DADABHAI NAOROJI\nDear sir.",
+            "vol:1-section:3": "2. PETITION TO LORD RIPON\nThe petitioners.",
+            "vol:1-section:3-meta": {'title': "PETITION TO LORD RIPON"},
+        }
+        with mock.patch('gandhi_ai.gandhi_ai_rag.get_sections', return_value=sections) as get_sections:
+            relevant_sections, section_keys, sections_meta = get_relevant_sections_with_metadata(
+                {'metadatas': [metadatas]})
+        get_sections.assert_called_once_with(["vol:1-section:2", "vol:1-section:3", "vol:1-section:3-meta"])
+        self.assertEqual(section_keys, ["vol:1-section:2", "vol:1-section:3"])
+        self.assertEqual([section_meta['title'] for section_meta in sections_meta],
+                         ["LETTER TO DADABHAI NAOROJI", "PETITION TO LORD RIPON"])
+
+
+class VectorIndexTests(SimpleTestCase):
+
+    def build(self, vectors, **kwargs):
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir)
+        metadata = {'source': 'volume', 'volume': 1, 'section': 1, 'page': None}
+        build_vector_index([(str(i), vector, metadata) for i, vector in enumerate(vectors)], index_dir, **kwargs)
+        return CurrentIndex(VectorIndex).get(index_dir)
+
+    def test_empty_index(self):
+        vector_index = self.build([])
+        self.assertEqual(vector_index.query([[1.0, 0.0]], 3, probes=2)['ids'], [[]])
+
+    def test_probed_search_finds_the_closest_vectors(self):
+        vectors = np.random.default_rng(0).normal(size=(500, 16))
+        vector_index = self.build(vectors, n_lists=10)
+        self.assertEqual(vector_index.manifest['lists'], 10)
+        for quantization in ('int8', 'float16'):
+            vector_index = self.build(vectors, quantization=quantization, n_lists=10)
+            for i, query in enumerate(vectors[:20]):
+                self.assertEqual(vector_index.query([query], 1)['ids'], [[str(i)]])
+                self.assertEqual(vector_index.query([query], 1, probes=2)['ids'], [[str(i)]])
+
+    def test_batched_search_matches_single_queries(self):
+        vectors = np.random.default_rng(0).normal(size=(500, 16))
+        vector_index = self.build(vectors, n_lists=10)
+        queries = np.random.default_rng(1).normal(size=(30, 16))
+        batched = vector_index.search(queries, 5, probes=3)
+        single = [vector_index.search([query], 5, probes=3)[0] for query in queries]
+        self.assertEqual(
+            [[document for document, score in matches] for matches in batched],
+            [[document for document, score in matches] for matches in single])
+        np.testing.assert_allclose(
+            [[score for document, score in matches] for matches in batched],
+            [[score for document, score in matches] for matches in single], rtol=1e-5)
+
+    def test_rescore_uses_the_float32_vectors(self):
+        vectors = np.random.default_rng(0).normal(size=(500, 16))
+        vector_index = self.build(vectors, n_lists=10)
+        self.assertIsNone(vector_index.vectors)
+
+        vector_index = self.build(vectors, n_lists=10, rescore_vectors=True)
+        query = np.random.default_rng(1).normal(size=16)
+        normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        exact_scores = normalized @ (query / np.linalg.norm(query))
+        exact = [str(i) for i in np.argsort(-exact_scores)[:5]]
+        result = vector_index.query([query], 5, rescore_candidates=50)
+        self.assertEqual(result['ids'], [exact])
+        np.testing.assert_allclose(result['distances'][0], 1 - np.sort(exact_scores)[::-1][:5], rtol=1e-5)
+
+
+def get_client_error(code, status_code=400):
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status_code}}, 'InvokeModel')
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.circuit_breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+
+    def test_opens_after_consecutive_failures(self):
+        self.circuit_breaker.record_failure()
+        self.circuit_breaker.before_call()
+        self.circuit_breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            self.circuit_breaker.before_call()
+
+    def test_success_resets_the_failures(self):
+        self.circuit_breaker.record_failure()
+        self.circuit_breaker.record_success()
+        self.circuit_breaker.record_failure()
+        self.circuit_breaker.before_call()
+
+    def test_trial_call_after_reset_timeout(self):
+        with mock.patch('time.monotonic', return_value=100):
+            self.circuit_breaker.record_failure()
+            self.circuit_breaker.record_failure()
+        with mock.patch('time.monotonic', return_value=131):
+            self.circuit_breaker.before_call()
+            # Only a single trial call is let through.
+            with self.assertRaises(CircuitOpenError):
+                self.circuit_breaker.before_call()
+            self.circuit_breaker.record_success()
+            self.circuit_breaker.before_call()
+            self.circuit_breaker.before_call()
+
+    def test_failed_trial_reopens(self):
+        with mock.patch('time.monotonic', return_value=100):
+            self.circuit_breaker.record_failure()
+            self.circuit_breaker.record_failure()
+        with mock.patch('time.monotonic', return_value=131):
+            self.circuit_breaker.before_call()
+            self.circuit_breaker.record_failure()
+        with mock.patch('time.monotonic', return_value=160):
+            with self.assertRaises(CircuitOpenError):
+                self.circuit_breaker.before_call()
+
+    def test_without_threshold_never_opens(self):
+        circuit_breaker = CircuitBreaker('test', failure_threshold=None, reset_timeout=0)
+        for i in range(100):
+            circuit_breaker.record_failure()
+        circuit_breaker.before_call()
+
+
+class RetryableErrorTests(SimpleTestCase):
+
+    def test_throttling_and_server_errors(self):
+        self.assertTrue(is_retryable_error(get_client_error('ThrottlingException', 429)))
+        self.assertTrue(is_retryable_error(get_client_error('SomethingNew', 503)))
+        self.assertFalse(is_retryable_error(get_client_error('ValidationException')))
+        self.assertFalse(is_retryable_error(get_client_error('AccessDeniedException', 403)))
+
+    def test_connection_errors(self):
+        self.assertTrue(is_retryable_error(EndpointConnectionError(endpoint_url='https://bedrock')))
+        self.assertTrue(is_retryable_error(ConnectionResetError()))
+        self.assertTrue(is_retryable_error(TimeoutError()))
+        self.assertFalse(is_retryable_error(ValueError()))
+
+
+@override_settings(BACKEND_RESILIENCE={'test': {
+    'max_attempts': 3, 'base_delay': 1.0, 'max_delay': 1.0, 'failure_threshold': 1, 'reset_timeout': 30}})
+class DeadlineTests(SimpleTestCase):
+
+    def setUp(self):
+        self.addCleanup(resilience._CIRCUIT_BREAKERS.pop, 'test', None)
+
+    def test_retry_delay_within_the_deadline(self):
+        error = get_client_error('ThrottlingException', 429)
+        with request_deadline(10):
+            self.assertLessEqual(get_retry_delay('test', 1, error), 1.0)
+        with request_deadline(0.5), mock.patch('random.uniform', return_value=0.8):
+            with self.assertRaises(ClientError):
+                get_retry_delay('test', 1, error)
+        with self.assertRaises(ClientError):
+            get_retry_delay('test', 3, error)
+
+    def test_check_deadline(self):
+        check_deadline('test')
+        with request_deadline(0):
+            with self.assertRaises(DeadlineExceeded):
+                check_deadline('test')
+
+    async def test_own_deadline_does_not_open_the_circuit(self):
+        async def slow_call():
+            await asyncio.sleep(1)
+
+        with request_deadline(0.01):
+            with self.assertRaises(DeadlineExceeded):
+                await call_with_retry_async('test', slow_call)
+        resilience.get_circuit_breaker('test').before_call()
+
+    @override_settings(BACKEND_RESILIENCE={'test': {
+        'max_attempts': 3, 'base_delay': 1.0, 'max_delay': 1.0, 'failure_threshold': 3, 'reset_timeout': 30}})
+    async def test_backoff_holds_no_slot(self):
+        scheduler = BackendScheduler('test', max_concurrency=1, max_queue_size=1, queue_timeout=1)
+        self.addCleanup(scheduler._executor.shutdown)
+        attempts = []
+
+        async def flaky_call():
+            attempts.append(scheduler.stats()['in_flight'])
+            if len(attempts) == 1:
+                raise ConnectionResetError()
+
+        with mock.patch('random.uniform', return_value=0.05):
+            task = asyncio.ensure_future(call_with_retry_async('test', scheduler.call, flaky_call))
+            await asyncio.sleep(0.02)
+            self.assertEqual(scheduler.stats()['in_flight'], 0)
+            await task
+        self.assertEqual(attempts, [1, 1])
+
+
+class BackendSchedulerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.scheduler = BackendScheduler('test', max_concurrency=1, max_queue_size=3, queue_timeout=0.05)
+        self.addCleanup(self.scheduler._executor.shutdown)
+
+    async def test_cancelled_queued_calls_leave_the_queue(self):
+        running = asyncio.ensure_future(self.scheduler.run(time.sleep, 0.1))
+        queued = [asyncio.ensure_future(self.scheduler.run(time.sleep, 0)) for i in range(2)]
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.scheduler.stats()['queue_depth'], 2)
+
+        for task in queued:
+            task.cancel()
+        await asyncio.gather(*queued, return_exceptions=True)
+        await running
+
+        stats = self.scheduler.stats()
+        self.assertEqual((stats['queue_depth'], stats['in_flight']), (0, 0))
+        await self.scheduler.run(time.sleep, 0)
+
+    async def test_slots_are_handed_out_in_order(self):
+        order = []
+
+        async def call(i):
+            async with self.scheduler.slot():
+                order.append(i)
+                await asyncio.sleep(0.001)
+
+        await asyncio.gather(*[call(i) for i in range(4)])
+        self.assertEqual(order, [0, 1, 2, 3])
+        self.assertEqual(self.scheduler.stats()['completed'], 4)
+
+    async def test_full_queue(self):
+        async def hold():
+            async with self.scheduler.slot():
+                await asyncio.sleep(0.2)
+
+        tasks = [asyncio.ensure_future(hold()) for i in range(4)]
+        await asyncio.sleep(0.01)
+        with self.assertRaises(SchedulerQueueFull):
+            await self.scheduler.acquire()
+        with self.assertRaises(TimeoutError):
+            async with self.scheduler.slot(0.01):
+                pass
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        stats = self.scheduler.stats()
+        self.assertEqual((stats['queue_depth'], stats['in_flight'], stats['rejected']), (0, 0, 1))
+
+
+def build_test_lexical_index(test_case, documents):
+    index_dir = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, index_dir)
+    build_lexical_index(
+        [(str(i), document, {'source': 'volume', 'volume': 1, 'section': i, 'page': None})
+         for i, document in enumerate(documents)], index_dir)
+    return CurrentIndex(LexicalIndex).get(index_dir)
+
+
+class LexicalIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.lexical_index = build_test_lexical_index(self, [
+            "The salt tax weighs heavily on the poorest villagers of the whole country.",
+            "Truth is God, and truth alone endures.",
+            "We made salt against the salt tax and the salt law.",
+            "Spinning khadi every day is a sacrament.",
+        ])
+
+    def test_scoring_order(self):
+        self.assertEqual([document for document, score in self.lexical_index.search("salt tax", 10)], [2, 0])
+        self.assertEqual([document for document, score in self.lexical_index.search("truth khadi", 10)], [1, 3])
+
+    def test_unknown_terms(self):
+        self.assertEqual(self.lexical_index.search("railway", 10), [])
+        self.assertEqual(self.lexical_index.query("railway", 10)['ids'], [[]])
+
+    def test_query_result(self):
+        result = self.lexical_index.query("truth", 1)
+        self.assertEqual(result['ids'], [['1']])
+        self.assertEqual(result['metadatas'][0][0]['section'], 1)
+
+
+class ReciprocalRankFusionTests(SimpleTestCase):
+
+    def test_fuses_by_rank(self):
+        vector_results = {'ids': [['a', 'b', 'c']], 'metadatas': [[{'n': 'a'}, {'n': 'b'}, {'n': 'c'}]],
+                          'documents': [['text a', 'text b', 'text c']]}
+        lexical_results = {'ids': [['c', 'd', 'b']], 'metadatas': [[{'n': 'c2'}, {'n': 'd'}, {'n': 'b2'}]]}
+        fused = reciprocal_rank_fusion([vector_results, lexical_results], 3, k=60)
+
+        # b and c are found by both, c ranks higher there than b.
+        self.assertEqual(fused['ids'], [['c', 'b', 'a']])
+        self.assertEqual(fused['metadatas'], [[{'n': 'c'}, {'n': 'b'}, {'n': 'a'}]])
+        self.assertEqual(fused['documents'], [['text c', 'text b', 'text a']])
+
+    def test_documents_missing_from_every_result(self):
+        lexical_results = {'ids': [['d']], 'metadatas': [[{'n': 'd'}]]}
+        self.assertEqual(reciprocal_rank_fusion([lexical_results], 2)['documents'], [[None]])
+
+
+@override_settings(RETRIEVAL_MODE='hybrid', QUERY_EMBEDDING_TIMEOUT=0.05)
+class LexicalFallbackTests(SimpleTestCase):
+
+    def setUp(self):
+        self.scheduler = BackendScheduler('bedrock', max_concurrency=1, max_queue_size=8, queue_timeout=1)
+        self.addCleanup(self.scheduler._executor.shutdown)
+        for target, value in (('get_scheduler', self.scheduler), ('get_cached_query_embeddings', None)):
+            patcher = mock.patch('gandhi_ai.gandhi_ai_rag.' + target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_slow_embedding_falls_back_to_the_lexical_index(self):
+        with mock.patch('gandhi_ai.gandhi_ai_rag.get_query_embeddings', side_effect=lambda text: time.sleep(0.2)):
+            embeddings = await asyncio.gather(*[
+                embed_query_for_retrieval("What is truth?", mock.Mock()) for i in range(3)])
+        self.assertEqual(embeddings, [None, None, None])
+
+        # The calls cut short while queued do not stay counted.
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+
+        lexical_index = build_test_lexical_index(self, ["Truth is God.", "The salt tax."])
+        chunks = await retrieve_relevant_chunks("What is truth?", None, lexical_index, 5)
+        self.assertEqual(chunks['ids'], [['0']])
+
+    async def test_failed_embedding_falls_back_to_the_lexical_index(self):
+        with mock.patch('gandhi_ai.gandhi_ai_rag.get_query_embeddings', side_effect=ValueError):
+            self.assertIsNone(await embed_query_for_retrieval("What is truth?", mock.Mock()))
+
+    async def test_without_lexical_index_failures_are_raised(self):
+        with mock.patch('gandhi_ai.gandhi_ai_rag.get_query_embeddings', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                await embed_query_for_retrieval("What is truth?", None)
+
+
+class LRUCacheTests(SimpleTestCase):
+
+    def test_evicts_the_least_recently_used_entries(self):
+        lru_cache = LRUCache('test', max_entries=2)
+        lru_cache.set('a', 1)
+        lru_cache.set('b', 2)
+        self.assertEqual(lru_cache.get('a'), 1)
+        lru_cache.set('c', 3)
+        self.assertIsNone(lru_cache.get('b'))
+        self.assertEqual((lru_cache.get('a'), lru_cache.get('c')), (1, 3))
+
+    def test_evicts_by_size(self):
+        value = "x" * 1000
+        size = sys.getsizeof(value)
+        lru_cache = LRUCache('test', max_entries=10, max_bytes=size * 2)
+        for key in ('a', 'b', 'c'):
+            lru_cache.set(key, value)
+        self.assertEqual(lru_cache.stats()['entries'], 2)
+        self.assertEqual(lru_cache.stats()['bytes'], size * 2)
+        self.assertIsNone(lru_cache.get('a'))
+
+        # Values larger than the whole cache are not stored.
+        lru_cache.set('d', "x" * (size * 2))
+        self.assertIsNone(lru_cache.get('d'))
+        self.assertEqual(lru_cache.get('c'), value)
+
+    def test_expiry_and_stats(self):
+        lru_cache = LRUCache('test', max_entries=1, timeout=10)
+        with mock.patch('time.monotonic', return_value=100):
+            lru_cache.set('a', 1)
+            lru_cache.set('b', 2)
+            self.assertEqual(lru_cache.get('b'), 2)
+        with mock.patch('time.monotonic', return_value=111):
+            self.assertIsNone(lru_cache.get('b'))
+        self.assertEqual(lru_cache.stats(), {
+            'name': 'test', 'entries': 0, 'bytes': 0, 'hits': 1, 'misses': 1, 'evictions': 1, 'hit_ratio': 0.5})
+
+
+# A local memory cache standing in for redis.
+LOCAL_MEMORY_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES)
+class QueryEmbeddingCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        caches.QUERY_EMBEDDING_CACHE.clear()
+        self.addCleanup(caches.QUERY_EMBEDDING_CACHE.clear)
+
+    def test_normalize_query_text(self):
+        self.assertEqual(normalize_query_text("  What is TRUTH?\n"), "what is truth")
+        self.assertEqual(normalize_query_text("Satyagraha, ahimsa!"), normalize_query_text("satyagraha ahimsa"))
+
+    def test_round_trip_through_the_local_cache_and_redis(self):
+        embedding = [0.1, -0.2, 0.3]
+        self.assertIsNone(get_cached_query_embeddings("What is truth?"))
+        cache_query_embeddings("What is truth?", [embedding])
+
+        key = caches.get_query_embedding_cache_key("what is truth")
+        self.assertEqual(caches.cache.get(key), np.array(embedding, dtype=np.float32).tobytes())
+        np.testing.assert_array_equal(get_cached_query_embeddings("WHAT is truth"), [np.float32(embedding)])
+
+        # Another worker only finds it in redis, and keeps a local copy.
+        caches.QUERY_EMBEDDING_CACHE.clear()
+        redis_hits = caches.get_redis_cache_stats()['query_embedding']['hits']
+        np.testing.assert_array_equal(get_cached_query_embeddings("What is truth?"), [np.float32(embedding)])
+        self.assertEqual(caches.get_redis_cache_stats()['query_embedding']['hits'], redis_hits + 1)
+        self.assertIsNotNone(caches.QUERY_EMBEDDING_CACHE.get(key))
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES)
+class MapAnswerCacheTests(SimpleTestCase):
+
+    def test_cache_key(self):
+        key = get_map_answer_cache_key("What is truth?", "vol:1-section:2", 4000, "Truth is God.")
+        self.assertEqual(key, "map-answer:{0}:vol:1-section:2:4000:{1}".format(
+            hashlib.sha1(b"what is truth").hexdigest(), hashlib.sha1(b"Truth is God.").hexdigest()))
+
+        self.assertEqual(key, get_map_answer_cache_key("what is TRUTH", "vol:1-section:2", 4000, "Truth is God."))
+        # An edited section is mapped again.
+        self.assertNotEqual(key, get_map_answer_cache_key("What is truth?", "vol:1-section:2", 4000, "God is Truth."))
+        self.assertNotEqual(key, get_map_answer_cache_key("What is truth?", "vol:1-section:2", 0, "Truth is God."))
+
+    def test_cached_map_answers(self):
+        keys = [get_map_answer_cache_key("What is truth?", "vol:1-section:2", offset, "Truth is God.")
+                for offset in (0, 4000)]
+        cache_map_answers({keys[0]: "Truth is God."})
+        self.assertEqual(get_cached_map_answers(keys), {keys[0]: "Truth is God."})
+
+
+class SectionCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        caches.SECTION_CACHE.clear()
+        self.addCleanup(caches.SECTION_CACHE.clear)
+
+    @override_settings(CWOG_SECTION_COMPRESSION='zlib')
+    def test_compressed_sections(self):
+        value = encode_section(SAMPLE_SECTION)
+        self.assertTrue(value.startswith(b"CWZ1"))
+        self.assertLess(len(value), len(SAMPLE_SECTION))
+        self.assertEqual(decode_section(value), SAMPLE_SECTION)
+
+    @override_settings(CWOG_SECTION_COMPRESSION='none')
+    def test_uncompressed_sections(self):
+        self.assertEqual(encode_section(SAMPLE_SECTION), SAMPLE_SECTION)
+        # Sections stored before compression was enabled are still read.
+        self.assertEqual(decode_section(SAMPLE_SECTION), SAMPLE_SECTION)
+
+    @override_settings(CWOG_SECTION_COMPRESSION='zlib')
+    def test_missing_sections_are_fetched_in_one_round_trip(self):
+        redis = mock.Mock()
+        redis.get_many.return_value = {'vol:1-section:1': encode_section("First."), 'vol:1-section:2': "Second."}
+        with mock.patch('gandhi_ai.caches.cache', redis):
+            self.assertEqual(get_sections(['vol:1-section:1', 'vol:1-section:2', 'vol:1-section:3']), {
+                'vol:1-section:1': "First.", 'vol:1-section:2': "Second."})
+            redis.get_many.assert_called_once_with(['vol:1-section:1', 'vol:1-section:2', 'vol:1-section:3'])
+
+            # Sections already read are served from the local cache.
+            redis.get_many.reset_mock()
+            redis.get_many.return_value = {}
+            self.assertEqual(get_sections(['vol:1-section:1', 'vol:1-section:3']), {'vol:1-section:1': "First."})
+            redis.get_many.assert_called_once_with(['vol:1-section:3'])
+
+            redis.get_many.reset_mock()
+            get_sections(['vol:1-section:1', 'vol:1-section:2'])
+            redis.get_many.assert_not_called()
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES)
+class StaleSectionTests(SimpleTestCase):
+
+    def test_sections_past_the_new_count_are_deleted(self):
+        for section in range(7):
+            caches.cache.set("vol:1-section:{0}".format(section), "Section {0}.".format(section))
+            caches.cache.set("vol:1-section:{0}-meta".format(section), {'title': "TITLE", 'page': 1})
+        caches.cache.set("vol:2-section:5", "Another volume.")
+
+        command = load_sections_from_cwog.Command()
+        self.assertEqual(command.delete_stale_sections('1', 3, batch_size=2), 4)
+        self.assertEqual(sorted(caches.cache.get_many(
+            ["vol:1-section:{0}{1}".format(section, suffix) for section in range(7) for suffix in ("", "-meta")])), [
+            "vol:1-section:0", "vol:1-section:0-meta", "vol:1-section:1", "vol:1-section:1-meta",
+            "vol:1-section:2", "vol:1-section:2-meta"])
+        self.assertEqual(caches.cache.get("vol:2-section:5"), "Another volume.")
+        self.assertEqual(command.delete_stale_sections('1', 3, batch_size=2), 0)
+
+
+class SemanticAnswerCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = SemanticAnswerCache(max_entries=2, timeout=60, similarity_threshold=0.9)
+
+    def test_similarity_threshold(self):
+        self.cache.set([1.0, 0.0], 'packed', "Truth is God.", 'g1')
+        self.assertEqual(self.cache.get([2.0, 0.1], 'packed', 'g1'), "Truth is God.")
+        self.assertIsNone(self.cache.get([1.0, 1.0], 'packed', 'g1'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_answers_only_match_their_variant(self):
+        self.cache.set([1.0, 0.0], ('vector', 'packed'), "Packed answer.", 'g1')
+        self.assertIsNone(self.cache.get([1.0, 0.0], ('vector', 'map_reduce'), 'g1'))
+        self.assertIsNone(self.cache.get([1.0, 0.0], ('hybrid', 'packed'), 'g1'))
+
+        self.cache.set([1.0, 0.01], ('vector', 'map_reduce'), "Mapped answer.", 'g1')
+        self.assertEqual(self.cache.get([1.0, 0.0], ('vector', 'packed'), 'g1'), "Packed answer.")
+        self.assertEqual(self.cache.get([1.0, 0.0], ('vector', 'map_reduce'), 'g1'), "Mapped answer.")
+
+    def test_new_generation_clears_the_answers(self):
+        self.cache.set([1.0, 0.0], 'packed', "Truth is God.", 'g1')
+        self.assertIsNone(self.cache.get([1.0, 0.0], 'packed', 'g2'))
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_least_recently_used_answer_is_evicted(self):
+        self.cache.set([1.0, 0.0, 0.0], 'packed', "First.", 'g1')
+        self.cache.set([0.0, 1.0, 0.0], 'packed', "Second.", 'g1')
+        self.assertEqual(self.cache.get([1.0, 0.0, 0.0], 'packed', 'g1'), "First.")
+
+        self.cache.set([0.0, 0.0, 1.0], 'packed', "Third.", 'g1')
+        self.assertIsNone(self.cache.get([0.0, 1.0, 0.0], 'packed', 'g1'))
+        self.assertEqual(self.cache.get([1.0, 0.0, 0.0], 'packed', 'g1'), "First.")
+        self.assertEqual(self.cache.stats()['evictions'], 1)
@@ -1,8 +1,9 @@
 from django.urls import path
-from .views import models, chat
+from .views import models, chat, metrics
 
 
 urlpatterns = [
     path('models', models),
-    path('chat/completions', chat)
+    path('chat/completions', chat),
+    path('metrics', metrics)
 ]
\ No newline at end of file
@@ -1,13 +1,77 @@
+import os
 import re
 import json
 import docx
+import hashlib
+import zipfile
+import threading
 
+from lxml import etree
 from django.conf import settings
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from .clients import get_bedrock_client
+from .embedding_cache import EmbeddingCache
+from .decorators import retry_backend_call
+
+
+CWOG_SOURCE_URL_FORMAT = 'https://www.gandhiashramsevagram.org/gandhi-literature/mahatma-gandhi-collected-works-volume-{0}.pdf'
+
+CWOG_SOURCE_URL_PATTERN = re.compile(
+    r'https://www.gandhiashramsevagram.org/gandhi-literature/mahatma-gandhi-collected-works-volume-(\d+).pdf')
+
+CWOG_DOCX_FILE_PATTERN = re.compile(r'mahatma-gandhi-collected-works-volume-(\d+).docx')
+
+CWOG_CHUNK_ID_PATTERN = re.compile(r'-chunk:(\d+)-')
+
+# Bump whenever reading, splitting or cleaning changes the compiled corpus output.
+CWOG_CORPUS_FORMAT_VERSION = 1
+
+# Volume and page footers left in the text by the .docx conversion, the page number
+# is the last group of each alternative. The newlines around a footer are removed
+# with it, see clean_the_split_sections.
+CWOG_FOOTNOTE_PATTERN = re.compile(
+    r"VOL\.\s*\d+\s*:\s*\d{4}\s*-\s*\d+\s*[A-Z]+\s*,*\s*\d{4}\s*\.*\s*\t*(\d+)\n*"
+    r"|VOL\.\s*\d+\s*:\s*\d+\s*[A-Z]+\s*,*\s*\d{4}\s*-\s*\d+\s*[A-Z]+\s*,*\s*\d{4}\s*\.*\s*\t*(\d+)\n*"
+    r"|(\d+)\s*\t*THE COLLECTED WORKS OF MAHATMA GAND[HN]I\n*"
+)
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+# Applied one after the other by iter_section_pieces, each one only within the
+# pieces left by the previous ones.
+CWOG_SECTION_SPLIT_PATTERNS = [
+    re.compile(r"(\n1. SPEECH AT WORKING COMMITTEE MEETING, )"),
+    re.compile(r"(\n\s*[0-9]+\s*\.\s*[^a-z]+\s*\n)"),
+    re.compile(r"(\n\s*CHAPTER [IVXLCDM]+\s*\n)"),
+    re.compile(r"(\n\s*APPENDIX [IVXLCDM]+\s*\n)")
+]
+
+WORDPROCESSINGML = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+PACKAGE_RELATIONSHIPS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+OFFICE_DOCUMENT_RELATIONSHIP = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+
+STYLES_RELATIONSHIP = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles"
+
+SECTION_TITLE_PATTERNS = [
+    re.compile(r"(\n1. SPEECH AT WORKING COMMITTEE MEETING, )"),
+    re.compile(r"(\n\s*[0-9]+\s*\.\s*[^a-z]+\s*\n)"),
+    re.compile(r"(\n\s*CHAPTER\s*[IVXLCDM]+\s*\n)"),
+    re.compile(r"(\n\s*APPENDIX\s*[IVXLCDM]+\s*\n)")
+]
+
 
 def read_word_file(file_path):
+    if settings.CWOG_DOCX_READER == 'python-docx':
+        return read_word_file_with_python_docx(file_path)
+    return read_word_file_with_iterparse(file_path)
+
+
+def read_word_file_with_python_docx(file_path):
     # Load the document
     doc = docx.Document(file_path)
     
@@ -23,14 +87,229 @@ def read_word_file(file_path):
     return '\n'.join(full_text)
 
 
+def get_docx_part_path(docx_zip, part_path, relationship_type):
+    """Resolve the path of the part related to ``part_path`` by ``relationship_type``, or None."""
+    part_dir, part_name = os.path.split(part_path)
+    try:
+        relationships = etree.fromstring(docx_zip.read(os.path.join(part_dir, '_rels', part_name + '.rels')))
+    except KeyError:
+        return None
+
+    for relationship in relationships.iter(PACKAGE_RELATIONSHIPS + 'Relationship'):
+        if relationship.get('Type') == relationship_type:
+            return os.path.normpath(os.path.join(part_dir, relationship.get('Target'))).lstrip('/')
+    return None
+
+
+def get_docx_heading_styles(docx_zip, document_path):
+    """Return the ids of the heading paragraph styles and whether the default paragraph style is a heading."""
+    styles_path = get_docx_part_path(docx_zip, document_path, STYLES_RELATIONSHIP)
+    if styles_path is None:
+        return {}, False
+
+    styles = {}
+    default_is_heading = False
+    for style in etree.fromstring(docx_zip.read(styles_path)).iter(WORDPROCESSINGML + 'style'):
+        name = style.find(WORDPROCESSINGML + 'name')
+        name = name.get(WORDPROCESSINGML + 'val', '') if name is not None else ''
+        # python-docx shows the built-in 'heading N' styles as 'Heading N'.
+        is_heading = name.startswith('Heading') or re.fullmatch(r'heading [1-9]', name) is not None
+        is_paragraph_style = style.get(WORDPROCESSINGML + 'type') == 'paragraph'
+
+        # The first style with an id wins, a style that is not a paragraph style falls back to the default.
+        styles.setdefault(style.get(WORDPROCESSINGML + 'styleId'), is_heading if is_paragraph_style else None)
+        if is_paragraph_style and style.get(WORDPROCESSINGML + 'default') in ('1', 'true', 'on'):
+            default_is_heading = is_heading
+
+    return styles, default_is_heading
+
+
+def get_docx_run_text(run):
+    text = []
+    for element in run:
+        if element.tag == WORDPROCESSINGML + 't':
+            text.append(element.text or "")
+        elif element.tag in (WORDPROCESSINGML + 'tab', WORDPROCESSINGML + 'ptab'):
+            text.append("\t")
+        elif element.tag == WORDPROCESSINGML + 'br':
+            if element.get(WORDPROCESSINGML + 'type', 'textWrapping') == 'textWrapping':
+                text.append("\n")
+        elif element.tag == WORDPROCESSINGML + 'cr':
+            text.append("\n")
+        elif element.tag == WORDPROCESSINGML + 'noBreakHyphen':
+            text.append("-")
+    return "".join(text)
+
+
+def read_word_file_with_iterparse(file_path):
+    """Extract the same text as ``read_word_file_with_python_docx`` by streaming the document XML.
+
+    Body paragraphs are parsed one at a time and dropped once read, and the
+    heading styles are resolved once from the styles part.
+    """
+    with zipfile.ZipFile(file_path) as docx_zip:
+        document_path = get_docx_part_path(docx_zip, '', OFFICE_DOCUMENT_RELATIONSHIP) or 'word/document.xml'
+        heading_styles, default_is_heading = get_docx_heading_styles(docx_zip, document_path)
+
+        full_text = []
+        counter = 0
+        with docx_zip.open(document_path) as document:
+            for _, paragraph in etree.iterparse(document, events=('end',), tag=WORDPROCESSINGML + 'p'):
+                body = paragraph.getparent()
+                if body.tag != WORDPROCESSINGML + 'body':
+                    # Paragraphs of tables and other containers are not part of the text.
+                    continue
+
+                text = []
+                for element in paragraph:
+                    if element.tag == WORDPROCESSINGML + 'r':
+                        text.append(get_docx_run_text(element))
+                    elif element.tag == WORDPROCESSINGML + 'hyperlink':
+                        text.extend(get_docx_run_text(run) for run in element.iterchildren(WORDPROCESSINGML + 'r'))
+                text = "".join(text)
+
+                style = paragraph.find(WORDPROCESSINGML + 'pPr/' + WORDPROCESSINGML + 'pStyle')
+                is_heading = heading_styles.get(style.get(WORDPROCESSINGML + 'val')) if style is not None else None
+                if is_heading is None:
+                    is_heading = default_is_heading
+
+                counter += 1
+                if is_heading and not re.findall(r'[0-1]\s*.', text):
+                    full_text.append("\n" + str(counter) + ". " + text + "\n")
+                else:
+                    full_text.append(text)
+
+                paragraph.clear()
+                while paragraph.getprevious() is not None:
+                    del body[0]
+
+    return '\n'.join(full_text)
+
+
+def compile_cwog_volume(file_path, corpus_dir):
+    """Write the cleaned sections of a volume to a JSONL artifact in ``corpus_dir``.
+
+    The artifact name carries the hash of the source .docx file and the corpus
+    format version, so an existing artifact is reused until either changes.
+    Returns the path of the artifact.
+    """
+    volume_name = os.path.splitext(os.path.basename(file_path))[0]
+    artifact_path = os.path.join(corpus_dir, "{0}.{1}.jsonl".format(volume_name, get_compiled_volume_hash(file_path)))
+    if os.path.exists(artifact_path):
+        return artifact_path
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    content = read_word_file(file_path)
+
+    temporary_path = artifact_path + ".tmp{0}".format(os.getpid())
+    with open(temporary_path, 'w', encoding='utf-8') as fp:
+        cleaned_sections = iter_cleaned_sections(iter_file_content_sections(content))
+        for section_number, (page, cleaned_section) in enumerate(cleaned_sections):
+            fp.write(json.dumps({
+                'section': section_number,
+                'page': page,
+                'title': get_section_title(cleaned_section),
+                'text': cleaned_section,
+            }) + "\n")
+    os.replace(temporary_path, artifact_path)
+
+    # Drop the artifacts compiled from older versions of this volume.
+    for file_name in os.listdir(corpus_dir):
+        if file_name.startswith(volume_name + ".") and file_name.endswith(".jsonl") \
+                and os.path.join(corpus_dir, file_name) != artifact_path:
+            os.remove(os.path.join(corpus_dir, file_name))
+
+    return artifact_path
+
+
+def read_compiled_cwog_volume(artifact_path):
+    """Lazily yield the section records of a compiled volume."""
+    with open(artifact_path, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            yield json.loads(line)
+
+
+def get_volume_from_docx_file(docx_file):
+    return CWOG_DOCX_FILE_PATTERN.findall(docx_file)[0]
+
+
+def get_volume_from_source(source):
+    return CWOG_SOURCE_URL_PATTERN.findall(source)[0]
+
+
+def get_section_title(section):
+    for title_pattern in SECTION_TITLE_PATTERNS:
+        title_match = title_pattern.search(section)
+        if title_match:
+            return title_match.group(1).strip()
+    return ""
+
+
+def get_chunk_id(volume, section_number, offset, chunk):
+    """Deterministic chunk id, so re-ingesting unchanged text maps onto the same vector store entry."""
+    content_hash = hashlib.sha256(chunk.encode('utf-8')).hexdigest()[:16]
+    return "vol:{0}-section:{1}-chunk:{2}-{3}".format(volume, section_number, offset, content_hash)
+
+
+def get_chunk_offset(chunk_id):
+    """Offset of a chunk within its section, see get_chunk_id, or None for ids of another format."""
+    match = CWOG_CHUNK_ID_PATTERN.search(chunk_id)
+    return int(match.group(1)) if match else None
+
+
+def get_file_hash(file_path):
+    with open(file_path, 'rb') as fp:
+        return hashlib.file_digest(fp, 'sha256').hexdigest()
+
+
+def get_compiled_volume_hash(file_path):
+    """Hash of a .docx volume and the corpus format version, which changes whenever its sections could change."""
+    return hashlib.sha256(
+        "{0}:{1}".format(CWOG_CORPUS_FORMAT_VERSION, get_file_hash(file_path)).encode('utf-8')).hexdigest()[:16]
+
+
+def get_embedding_cache():
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None and settings.EMBEDDING_CACHE_PATH:
+            _embedding_cache = EmbeddingCache(settings.EMBEDDING_CACHE_PATH)
+        return _embedding_cache
+
+
 def get_embeddings(chunks):
+    """Embed document chunks, reusing vectors from the on-disk embedding cache when possible."""
+    embedding_cache = get_embedding_cache()
+    if embedding_cache is None:
+        return request_embeddings(chunks)
+
+    keys = [
+        EmbeddingCache.get_key(settings.COHERE_EMBED_ENGLISH_MODEL_ID, 'search_document', chunk)
+        for chunk in chunks
+    ]
+    vectors = embedding_cache.get_many(keys)
+
+    missing_chunks = list(dict.fromkeys(chunk for key, chunk in zip(keys, chunks) if key not in vectors))
+    if missing_chunks:
+        response = request_embeddings(missing_chunks)
+        new_vectors = {
+            EmbeddingCache.get_key(settings.COHERE_EMBED_ENGLISH_MODEL_ID, 'search_document', chunk): vector
+            for chunk, vector in zip(missing_chunks, response['embeddings']['float'])
+        }
+        embedding_cache.set_many(new_vectors)
+        vectors.update(new_vectors)
+
+    return {'embeddings': {'float': [vectors[key] for key in keys]}}
+
+
+@retry_backend_call('bedrock_ingestion')
+def request_embeddings(chunks):
     request_body = json.dumps({
         'texts': chunks,
         'input_type': 'search_document',
         'embedding_types': ["float"]
     })
 
-    response = settings.BEDROCK_CLIENT.invoke_model(
+    response = get_bedrock_client().invoke_model(
         modelId=settings.COHERE_EMBED_ENGLISH_MODEL_ID, 
         body=request_body,
         accept = '*/*',
@@ -45,76 +324,84 @@ def split_section(section):
 
 
 
-def clean_the_split_sections(split_sections):
-    vol_footnote_pattern1 = r"\n*VOL\.\s*\d+\s*:\s*\d{4}\s*-\s*\d+\s*[A-Z]+\s*,*\s*\d{4}\s*\.*\s*\t*(\d+)\n*"
-    vol_footnote_pattern2 = r"\n*VOL\.\s*\d+\s*:\s*\d+\s*[A-Z]+\s*,*\s*\d{4}\s*-\s*\d+\s*[A-Z]+\s*,*\s*\d{4}\s*\.*\s*\t*(\d+)\n*"
-    work_footnote_pattern1 = r"\n*(\d+)\s*\t*THE COLLECTED WORKS OF MAHATMA GANDHI\n*"
-    work_footnote_pattern2 = r"\n*(\d+)\s*\t*THE COLLECTED WORKS OF MAHATMA GANDNI\n*"
+def iter_cleaned_sections(split_sections):
+    """Strip the page footers from the sections, yielding ``(page, cleaned_section)`` pairs.
 
-    pages = []
-    cleaned_sections = []
+    A section gets the smallest page number found in its own footers or, when it
+    has none, the one of the next section that has footers. Only the sections
+    still waiting for a page are held in memory.
+    """
+    sections_without_page = []
 
-    for i, section in enumerate(split_sections):
-        p1 = re.findall(vol_footnote_pattern1, section) 
-        p2 = re.findall(vol_footnote_pattern2, section) 
-        p3 = re.findall(work_footnote_pattern1, section)
-        p4 = re.findall(work_footnote_pattern2, section)
-        
-        p = [int(n) for n in p1] + [int(n) for n in p2] + [int(n) for n in p3] + [int(n) for n in p4] + [1000000000]
-        
-        min_page_number = min(p)
-        
-        cleaned_section = re.sub(vol_footnote_pattern1, "", section)
-        cleaned_section = re.sub(vol_footnote_pattern2, "", cleaned_section)
-        cleaned_section = re.sub(work_footnote_pattern1, "", cleaned_section)
-        cleaned_section = re.sub(work_footnote_pattern2, "", cleaned_section)
-        
-        pages.append(None)
-        cleaned_sections.append(cleaned_section)
+    for section in split_sections:
+        section_pages = []
+        pieces = []
+        position = 0
+
+        for match in CWOG_FOOTNOTE_PATTERN.finditer(section):
+            # Footers also take the newlines right before them, searching for those
+            # only around a match is what keeps the scan fast.
+            start = match.start()
+            while start > position and section[start - 1] == "\n":
+                start -= 1
+
+            pieces.append(section[position:start])
+            section_pages.append(int(match.group(match.lastindex)))
+            position = match.end()
+
+        pieces.append(section[position:])
+        sections_without_page.append("".join(pieces))
 
-        if min_page_number == 1000000000:
-            continue
-        
-        j = i
-        while j>=0 and pages[j] == None:
-            pages[j] = min_page_number
-            j = j-1
+        if section_pages:
+            page = min(section_pages)
+            for cleaned_section in sections_without_page:
+                yield page, cleaned_section
+            sections_without_page = []
 
+    for cleaned_section in sections_without_page:
+        yield None, cleaned_section
+
+
+def clean_the_split_sections(split_sections):
+    pages = []
+    cleaned_sections = []
+    for page, cleaned_section in iter_cleaned_sections(split_sections):
+        pages.append(page)
+        cleaned_sections.append(cleaned_section)
     return pages, cleaned_sections
 
 
-# Define recursive function for splitting
-def recursive_split(text, patterns):
+def iter_section_pieces(content, patterns, start=0, end=None):
+    """Yield the spans of ``content`` split by each pattern in turn, then by the next ones within every piece.
+
+    Separators are kept as pieces of their own and empty pieces are dropped.
+    Splitting works on positions in ``content``, so no copy of the text is made.
+    """
+    if end is None:
+        end = len(content)
     if not patterns:
-        return [text]  # Base case: If no patterns left, return the text as a single item.
-    
-    pattern = patterns[0]  # Take the first pattern.
-    result = []
-    
-    # Split text using the current pattern
-    split_text = re.split(pattern, text)
-    
-    # For each part, recursively apply the remaining patterns
-    for part in split_text:
-        if part:  # Skip empty strings
-            result.extend(recursive_split(part, patterns[1:]))  # Recurse on the remaining patterns.
-    
-    return result
+        yield start, end
+        return
 
-def split_file_content_into_sections(content):
-    patterns = [
-        r"(\n1. SPEECH AT WORKING COMMITTEE MEETING, )",
-        r"(\n\s*[0-9]+\s*\.\s*[^a-z]+\s*\n)",
-        r"(\n\s*CHAPTER [IVXLCDM]+\s*\n)",
-        r"(\n\s*APPENDIX [IVXLCDM]+\s*\n)"
-    ]
-    
-    split_sections = recursive_split(content, patterns)
+    position = start
+    for match in patterns[0].finditer(content, start, end):
+        for piece_start, piece_end in ((position, match.start()), match.span()):
+            if piece_start < piece_end:
+                yield from iter_section_pieces(content, patterns[1:], piece_start, piece_end)
+        position = match.end()
+
+    if position < end:
+        yield from iter_section_pieces(content, patterns[1:], position, end)
 
-    combined_sections = []
-    for i in range(0, len(split_sections), 2):
-        combined = split_sections[i] + split_sections[i+1]
 
-        combined_sections.append(combined)
+def iter_file_content_sections(content):
+    """Lazily yield the sections of a volume, every two consecutive pieces make one section."""
+    pieces = iter_section_pieces(content, CWOG_SECTION_SPLIT_PATTERNS)
+    for start, end in pieces:
+        # Pieces are contiguous, a lone last piece becomes a section of its own.
+        next_start, next_end = next(pieces, (start, end))
+        yield content[start:next_end]
 
-    return combined_sections
\ No newline at end of file
+
+def split_file_content_into_sections(content):
+    return list(iter_file_content_sections(content))
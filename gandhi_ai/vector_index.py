@@ -0,0 +1,243 @@
+import os
+import math
+import logging
+import numpy as np
+
+from django.conf import settings
+
+from .chunk_index import ChunkArrays, ChunkIndex, CurrentIndex, write_index_build
+
+
+logger = logging.getLogger(__name__)
+
+VECTOR_INDEX_FORMAT_VERSION = 2
+
+QUANTIZATIONS = ('float16', 'int8')
+
+# Number of vectors converted to float32 and scored at a time, small enough for the block to stay in cache.
+SEARCH_BLOCK_SIZE = 256
+
+# Number of vectors assigned to their closest centroids at a time while building.
+ASSIGN_BLOCK_SIZE = 4096
+
+# The centroids are trained on a sample of this many vectors per list.
+KMEANS_SAMPLE_PER_LIST = 64
+KMEANS_ITERATIONS = 10
+
+
+def get_default_lists(documents):
+    return max(1, round(math.sqrt(documents)))
+
+
+def assign_lists(vectors, centroids):
+    """Return the closest centroid of every normalized vector."""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BLOCK_SIZE):
+        assignments[start:start + ASSIGN_BLOCK_SIZE] = np.argmax(
+            vectors[start:start + ASSIGN_BLOCK_SIZE] @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors, n_lists, seed=0):
+    """Spherical k-means of a sample of the normalized vectors, returning ``n_lists`` normalized centroids."""
+    rng = np.random.default_rng(seed)
+    sample = vectors[np.sort(rng.choice(
+        len(vectors), min(len(vectors), n_lists * KMEANS_SAMPLE_PER_LIST), replace=False))]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+
+    for iteration in range(KMEANS_ITERATIONS):
+        assignments = assign_lists(sample, centroids)
+        order = np.argsort(assignments, kind='stable')
+        assigned_lists, starts = np.unique(assignments[order], return_index=True)
+
+        centroids = sample[rng.choice(len(sample), n_lists)]  # Lists left empty are seeded again.
+        centroids[assigned_lists] = np.add.reduceat(sample[order], starts)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids /= np.where(norms > 0, norms, 1)
+    return centroids
+
+
+def build_vector_index(chunks, index_dir, quantization='int8', n_lists=None, rescore_vectors=False):
+    """Build a cosine index of ``(id, embedding, metadata)`` chunks and make it the current one in ``index_dir``.
+
+    Vectors are normalized, quantized to float16 or to int8 with a scale per
+    vector, and partitioned into ``n_lists`` lists around k-means centroids
+    (about the square root of the number of chunks by default), stored one
+    after the other so that searching a list reads one contiguous block.
+    With ``rescore_vectors`` a float32 copy of the vectors is stored too, for
+    re-scoring the best quantized hits exactly.
+    See ``write_index_build`` for how builds are stored. Returns the number of
+    indexed chunks.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError("Unknown vector index quantization {0!r}".format(quantization))
+
+    vectors = []
+    chunk_arrays = ChunkArrays()
+
+    for chunk_id, embedding, metadata in chunks:
+        vectors.append(np.asarray(embedding, dtype=np.float32))
+        chunk_arrays.append(chunk_id, metadata)
+
+    vectors = np.stack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.where(norms > 0, norms, 1)
+
+    if len(vectors):
+        centroids = train_centroids(vectors, min(n_lists or get_default_lists(len(vectors)), len(vectors)))
+        assignments = assign_lists(vectors, centroids)
+    else:
+        centroids = np.zeros((0, 0), dtype=np.float32)
+        assignments = np.zeros(0, dtype=np.int64)
+    order = np.argsort(assignments, kind='stable')
+    list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignments, minlength=len(centroids)), out=list_offsets[1:])
+    vectors = vectors[order]
+
+    if quantization == 'int8':
+        scales = np.abs(vectors).max(axis=1, initial=0) / 127
+        scales[scales == 0] = 1
+        quantized_vectors = np.round(vectors / scales[:, None]).astype(np.int8)
+    else:
+        scales = np.ones(len(vectors), dtype=np.float32)
+        quantized_vectors = vectors.astype(np.float16)
+
+    arrays = {
+        'centroids': centroids,
+        'list_offsets': list_offsets,
+        'quantized_vectors': quantized_vectors,
+        'scales': scales.astype(np.float32),
+    }
+    if rescore_vectors:
+        arrays['vectors'] = vectors
+    arrays.update(chunk_arrays.get_arrays(order))
+    write_index_build(index_dir, arrays, {
+        'format_version': VECTOR_INDEX_FORMAT_VERSION,
+        'quantization': quantization,
+        'documents': len(chunk_arrays),
+        'dimensions': vectors.shape[1],
+        'lists': len(centroids),
+        'rescore_vectors': rescore_vectors,
+    })
+
+    return len(chunk_arrays)
+
+
+class VectorIndex(ChunkIndex):
+    """Read-only cosine index over memory-mapped arrays, see ``build_vector_index``."""
+
+    ARRAYS = ('centroids', 'list_offsets', 'quantized_vectors', 'scales')
+
+    def __init__(self, build_dir):
+        super().__init__(build_dir)
+        # The float32 copy is only written, and mapped, when re-scoring was enabled at export.
+        self.vectors = None
+        if self.manifest.get('rescore_vectors'):
+            self.vectors = np.load(os.path.join(build_dir, 'vectors.npy'), mmap_mode='r')
+
+    def get_top_candidates(self, queries, n_candidates):
+        """Score every vector in blocks, keeping the ``n_candidates`` best documents of every query."""
+        documents = self.manifest['documents']
+        scores = np.empty((len(queries), documents), dtype=np.float32)
+        block = np.empty((min(SEARCH_BLOCK_SIZE, documents), self.manifest['dimensions']), dtype=np.float32)
+        for start in range(0, documents, SEARCH_BLOCK_SIZE):
+            end = min(start + SEARCH_BLOCK_SIZE, documents)
+            np.copyto(block[:end - start], self.quantized_vectors[start:end], casting='unsafe')
+            np.matmul(queries, block[:end - start].T, out=scores[:, start:end])
+        scores *= self.scales
+
+        candidates = np.argpartition(-scores, n_candidates - 1, axis=1)[:, :n_candidates]
+        return candidates, np.take_along_axis(scores, candidates, axis=1)
+
+    def get_probed_candidates(self, queries, probed_lists, n_candidates):
+        """Score the vectors of the lists every query probes, keeping the ``n_candidates`` best documents of each.
+
+        Every list probed by any of the queries is read once and scored for all of them.
+        """
+        documents = [[] for query in queries]
+        scores = [[] for query in queries]
+
+        # Lists are read in storage order, which keeps the reads of the mapped vectors sequential.
+        list_numbers = probed_lists.ravel()
+        list_queries = np.repeat(np.arange(len(queries)), probed_lists.shape[1])
+        order = np.argsort(list_numbers, kind='stable')
+        list_numbers, list_queries = list_numbers[order], list_queries[order]
+        unique_lists, starts = np.unique(list_numbers, return_index=True)
+
+        block = np.empty((SEARCH_BLOCK_SIZE, self.manifest['dimensions']), dtype=np.float32)
+        for list_number, query_numbers in zip(unique_lists, np.split(list_queries, starts[1:])):
+            list_start, list_end = self.list_offsets[list_number], self.list_offsets[list_number + 1]
+            for start in range(list_start, list_end, SEARCH_BLOCK_SIZE):
+                end = min(start + SEARCH_BLOCK_SIZE, list_end)
+                np.copyto(block[:end - start], self.quantized_vectors[start:end], casting='unsafe')
+                block_scores = (block[:end - start] @ queries[query_numbers].T) * self.scales[start:end, None]
+                for i, query_number in enumerate(query_numbers):
+                    documents[query_number].append(np.arange(start, end))
+                    scores[query_number].append(block_scores[:, i])
+
+        for query_documents, query_scores in zip(documents, scores):
+            query_documents = np.concatenate(query_documents) if query_documents else np.zeros(0, dtype=np.int64)
+            query_scores = np.concatenate(query_scores) if query_scores else np.zeros(0, dtype=np.float32)
+            if len(query_documents) > n_candidates:
+                best = np.argpartition(-query_scores, n_candidates - 1)[:n_candidates]
+                query_documents, query_scores = query_documents[best], query_scores[best]
+            yield query_documents, query_scores
+
+    def rescore(self, query, documents):
+        """Score ``documents`` exactly with their float32 vectors."""
+        documents = np.sort(documents)
+        # Rows are read in storage order, which keeps the reads of the mapped vectors sequential.
+        return documents, np.asarray(self.vectors[documents]) @ query
+
+    def search(self, query_embeddings, n_results, probes=None, rescore_candidates=0):
+        """Return the ``(document, similarity)`` pairs of the closest chunks of every query, best first.
+
+        Only the lists of the ``probes`` centroids closest to a query are
+        searched, every list when ``probes`` is not given. With
+        ``rescore_candidates`` that many of the best quantized hits are scored
+        again with the float32 vectors, when the index was built with them.
+        """
+        if not self.manifest['documents']:
+            return [[] for query in np.atleast_2d(query_embeddings)]
+
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.manifest['dimensions'])
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms > 0, norms, 1)
+
+        if rescore_candidates and self.vectors is None:
+            logger.warning("The vector index was built without float32 vectors, its hits are not re-scored.")
+            rescore_candidates = 0
+        n_candidates = min(max(n_results, rescore_candidates), self.manifest['documents'])
+
+        if not probes or probes >= self.manifest['lists']:
+            candidates = zip(*self.get_top_candidates(queries, n_candidates))
+        else:
+            probed_lists = np.argpartition(-(queries @ self.centroids.T), probes - 1, axis=1)[:, :probes]
+            candidates = self.get_probed_candidates(queries, probed_lists, n_candidates)
+
+        results = []
+        for query, (query_candidates, query_scores) in zip(queries, candidates):
+            if rescore_candidates:
+                query_candidates, query_scores = self.rescore(query, query_candidates)
+            order = np.lexsort((query_candidates, -query_scores))[:n_results]
+            results.append([(int(query_candidates[i]), float(query_scores[i])) for i in order])
+        return results
+
+    def query(self, query_embeddings, n_results, probes=None, rescore_candidates=0):
+        """Search the index, returning the ids, metadatas and cosine distances in the shape of a chroma query result."""
+        matches = self.search(query_embeddings, n_results, probes, rescore_candidates)
+        return {
+            'ids': [[self.get_chunk_id(document) for document, score in query_matches]
+                    for query_matches in matches],
+            'metadatas': [[self.get_metadata(document) for document, score in query_matches]
+                          for query_matches in matches],
+            'distances': [[1 - score for document, score in query_matches] for query_matches in matches],
+        }
+
+
+_current_vector_index = CurrentIndex(VectorIndex)
+
+
+def get_vector_index():
+    """Return the current vector index, reloading it after a rebuild, or None when none was exported."""
+    return _current_vector_index.get(settings.VECTOR_INDEX_DIR)
@@ -1,14 +1,23 @@
+import json
 import logging
 
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from django.http.response import StreamingHttpResponse
+from django.http.response import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.conf import settings
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from .streaming_utils import streamed_response
+from .metrics import get_metrics_registry
 
 
 logger = logging.getLogger(__name__)
 
+def metrics(request):
+    return HttpResponse(generate_latest(get_metrics_registry()), content_type=CONTENT_TYPE_LATEST)
+
+
 @api_view(['GET'])
 def models(request):
     return Response([
@@ -19,10 +28,18 @@ def models(request):
     ])
 
 
-@api_view(['POST'])
-def chat(request):
+# DRF's api_view does not support coroutine views, so the chat endpoint is a plain
+# async Django view that parses the JSON body itself.
+@csrf_exempt
+@require_POST
+async def chat(request):
+    try:
+        request_data = json.loads(request.body)
+    except json.JSONDecodeError as e:
+        return JsonResponse({'detail': 'JSON parse error - {0}'.format(e)}, status=400)
+
     try:
-        return StreamingHttpResponse(streamed_response(request), content_type='text/event-stream')
+        return StreamingHttpResponse(streamed_response(request_data), content_type='text/event-stream')
     except Exception as e:
         logger.error("Exception ",exc_info=1)
         raise e
@@ -0,0 +1,18 @@
+# Answers are streamed by an async view, which WSGI workers buffer until the
+# whole answer was generated, so the ASGI application is served by uvicorn workers.
+wsgi_app = 'aws_bedrock_access_gateway.asgi:application'
+worker_class = 'uvicorn.workers.UvicornWorker'
+
+
+def post_worker_init(worker):
+    # Runs in every worker once it loaded the application, also when it was preloaded before forking.
+    # ASGI workers warm the clients up on the lifespan startup event instead, see asgi.py.
+    if worker.cfg.worker_class_str.startswith('uvicorn.'):
+        return
+
+    from django.conf import settings
+
+    if settings.WARM_UP_CLIENTS:
+        from gandhi_ai.clients import warm_up_clients
+
+        warm_up_clients()